@@ -1,18 +1,39 @@
 # app.py
 
 import os
+import base64
+import binascii
+import hashlib
+import io
+import collections
 import json
 import random
 import re
+import socket
+import sqlite3
+import math
 import string
+import threading
+import time
+import urllib.parse
 import requests
-from flask import Flask, render_template, request, jsonify, url_for
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from flask import Flask, Response, g, has_request_context, make_response, redirect, render_template, request, jsonify, send_file, stream_with_context, url_for
+from datetime import datetime, timedelta, timezone
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import ProgrammingError
+from sqlalchemy import and_, or_, event as sqlalchemy_event
+from sqlalchemy.exc import IntegrityError, ProgrammingError, SQLAlchemyError
+from sqlalchemy.orm import joinedload
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from qbittorrentapi import Client, exceptions as qbittorrent_exceptions
 
+try:
+    from PIL import Image
+except ImportError:  # Pillow не обязателен: без него все варианты постера совпадают с оригиналом
+    Image = None
+
 # --- Конфигурация ---
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
@@ -23,12 +44,136 @@ if db_uri and db_uri.startswith("postgres://"):
 app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
+AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE', '1') != '0'
+
+# --- Конфигурация лотерей ---
+BULK_LOTTERY_MAX = int(os.environ.get('BULK_LOTTERY_MAX', '100'))
+
+# --- Конфигурация постраничной выдачи ---
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '24'))
+LIBRARY_PAGE_SIZE = int(os.environ.get('LIBRARY_PAGE_SIZE', '24'))
+MAX_PAGE_SIZE = 100
 
 # --- Конфигурация qBittorrent ---
 QBIT_HOST = os.environ.get('QBIT_HOST')
 QBIT_PORT = os.environ.get('QBIT_PORT')
 QBIT_USERNAME = os.environ.get('QBIT_USERNAME')
 QBIT_PASSWORD = os.environ.get('QBIT_PASSWORD')
+QBIT_CONNECT_TIMEOUT = float(os.environ.get('QBIT_CONNECT_TIMEOUT', '3.05'))
+QBIT_READ_TIMEOUT = float(os.environ.get('QBIT_READ_TIMEOUT', '10'))
+TORRENT_SYNC_ENABLED = os.environ.get('TORRENT_SYNC_ENABLED', '1') != '0'
+TORRENT_SYNC_INTERVAL = float(os.environ.get('TORRENT_SYNC_INTERVAL', '2'))
+TORRENT_SNAPSHOT_MAX_AGE = float(os.environ.get('TORRENT_SNAPSHOT_MAX_AGE', '10'))
+# После QBIT_BREAKER_FAILURES ошибок подряд вызовы отклоняются сразу, без
+# ожидания таймаута, и только через QBIT_BREAKER_RESET_TIMEOUT секунд
+# пропускается одна пробная попытка.
+QBIT_BREAKER_FAILURES = int(os.environ.get('QBIT_BREAKER_FAILURES', '3'))
+QBIT_BREAKER_RESET_TIMEOUT = float(os.environ.get('QBIT_BREAKER_RESET_TIMEOUT', '15'))
+# Одинаковые одновременные чтения (torrents_info) объединяются в один вызов,
+# а его результат ещё QBIT_READ_CACHE_TTL секунд отдаётся без запроса.
+QBIT_READ_CACHE_TTL = float(os.environ.get('QBIT_READ_CACHE_TTL', '0.5'))
+
+# --- Конфигурация потокового воспроизведения ---
+# Если запрошенные куски ещё не скачаны, запрос ждёт их до STREAM_WAIT_TIMEOUT
+# секунд, а затем отвечает 416 с Retry-After.
+STREAM_WAIT_TIMEOUT = float(os.environ.get('STREAM_WAIT_TIMEOUT', '3'))
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', '0.5'))
+STREAM_RETRY_AFTER = int(os.environ.get('STREAM_RETRY_AFTER', '3'))
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', str(256 * 1024)))
+# Соответствие путей qBittorrent локальным, если он видит файлы иначе
+# (например, в Docker): "/downloads=/mnt/torrents;/incomplete=/mnt/incomplete"
+STREAM_PATH_MAP = [
+    tuple(part.strip() for part in pair.split('=', 1))
+    for pair in os.environ.get('STREAM_PATH_MAP', '').split(';') if '=' in pair
+]
+
+# --- Конфигурация очереди задач ---
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '6'))
+JOB_RETRY_BASE = float(os.environ.get('JOB_RETRY_BASE', '2'))
+JOB_RETRY_MAX = float(os.environ.get('JOB_RETRY_MAX', '300'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1'))
+JOB_LEASE_TIMEOUT = float(os.environ.get('JOB_LEASE_TIMEOUT', '300'))
+# Выполнять задачи прямо в запросе (тесты и отладка без фоновых потоков)
+JOBS_EAGER = os.environ.get('JOBS_EAGER', '0') == '1'
+
+# --- Конфигурация планировщика загрузок ---
+# Одновременно в qBittorrent не больше DOWNLOAD_MAX_ACTIVE загрузок
+# (0 - без ограничения), остальные ждут своей очереди по приоритету.
+DOWNLOAD_MAX_ACTIVE = int(os.environ.get('DOWNLOAD_MAX_ACTIVE', '3'))
+DOWNLOAD_SCHEDULER_INTERVAL = float(os.environ.get('DOWNLOAD_SCHEDULER_INTERVAL', '10'))
+# Торрент, который так и не появился в клиенте (или был удалён вручную),
+# освобождает место через DOWNLOAD_MISSING_GRACE секунд после запуска.
+DOWNLOAD_MISSING_GRACE = float(os.environ.get('DOWNLOAD_MISSING_GRACE', '120'))
+# Ограничения скорости каждого торрента в КиБ/с; 0 - не задавать
+DOWNLOAD_RATE_LIMIT_KIB = int(os.environ.get('DOWNLOAD_RATE_LIMIT_KIB', '0'))
+UPLOAD_RATE_LIMIT_KIB = int(os.environ.get('UPLOAD_RATE_LIMIT_KIB', '0'))
+
+# --- Конфигурация хранения загрузок ---
+# Докачанные торренты категорий lottery-*/library-* удаляются вместе с
+# файлами по политикам ниже; 0 отключает политику. Пока не задана ни одна,
+# ничего не удаляется.
+RETENTION_MAX_TOTAL_GB = float(os.environ.get('RETENTION_MAX_TOTAL_GB', '0'))
+RETENTION_MIN_FREE_GB = float(os.environ.get('RETENTION_MIN_FREE_GB', '0'))
+RETENTION_MAX_AGE_DAYS = float(os.environ.get('RETENTION_MAX_AGE_DAYS', '0'))
+RETENTION_KEEP_LIBRARY = os.environ.get('RETENTION_KEEP_LIBRARY', '1') != '0'
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', '3600'))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '50'))
+
+# --- Конфигурация потока событий ---
+EVENT_HEARTBEAT_INTERVAL = float(os.environ.get('EVENT_HEARTBEAT_INTERVAL', '15'))
+EVENT_HISTORY_SIZE = int(os.environ.get('EVENT_HISTORY_SIZE', '500'))
+EVENT_STREAM_MAX_DURATION = float(os.environ.get('EVENT_STREAM_MAX_DURATION', '300'))
+RESULTS_LONG_POLL_MAX = float(os.environ.get('RESULTS_LONG_POLL_MAX', '25'))
+# Шина событий внутрипроцессная: розыгрыш в другом воркере виден только через базу
+EVENT_DRAW_POLL_INTERVAL = float(os.environ.get('EVENT_DRAW_POLL_INTERVAL', '5'))
+RESULTS_BATCH_MAX = int(os.environ.get('RESULTS_BATCH_MAX', '200'))
+
+# --- Конфигурация общего кэша ---
+# local - память процесса; sqlite - файл, общий для воркеров одного хоста;
+# redis - сервер Redis или совместимый (см. раздел "Общий кэш")
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'local')
+CACHE_PREFIX = os.environ.get('CACHE_PREFIX', 'movie-lottery')
+CACHE_DEFAULT_TTL = int(os.environ.get('CACHE_DEFAULT_TTL', '300'))
+# Как долго воркер может не замечать сброс пространства кэша другим воркером
+CACHE_VERSION_TTL = float(os.environ.get('CACHE_VERSION_TTL', '1'))
+CACHE_LOCAL_SIZE = int(os.environ.get('CACHE_LOCAL_SIZE', '2048'))
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH') or os.path.join(app.instance_path, 'cache.sqlite3')
+CACHE_SQLITE_MMAP_SIZE = int(os.environ.get('CACHE_SQLITE_MMAP_SIZE', str(64 * 1024 * 1024)))
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+CACHE_REDIS_TIMEOUT = float(os.environ.get('CACHE_REDIS_TIMEOUT', '0.5'))
+CACHE_PAGE_TTL = int(os.environ.get('CACHE_PAGE_TTL', '600'))
+
+# --- Конфигурация Кинопоиска ---
+KINOPOISK_API_URL = os.environ.get('KINOPOISK_API_URL', 'https://api.kinopoisk.dev/v1.4')
+KINOPOISK_CACHE_TTL = int(os.environ.get('KINOPOISK_CACHE_TTL', str(7 * 24 * 3600)))
+KINOPOISK_NEGATIVE_CACHE_TTL = int(os.environ.get('KINOPOISK_NEGATIVE_CACHE_TTL', '3600'))
+KINOPOISK_CONNECT_TIMEOUT = float(os.environ.get('KINOPOISK_CONNECT_TIMEOUT', '3.05'))
+KINOPOISK_READ_TIMEOUT = float(os.environ.get('KINOPOISK_READ_TIMEOUT', '10'))
+KINOPOISK_BATCH_WORKERS = int(os.environ.get('KINOPOISK_BATCH_WORKERS', '4'))
+KINOPOISK_BATCH_MAX_QUERIES = int(os.environ.get('KINOPOISK_BATCH_MAX_QUERIES', '50'))
+
+# --- Конфигурация поиска торрентов ---
+# Через запятую; порядок влияет только на порядок запросов, не на ранжирование
+TORRENT_SEARCH_PROVIDERS = [name.strip() for name in os.environ.get('TORRENT_SEARCH_PROVIDERS', 'apibay').split(',') if name.strip()]
+TORRENT_SEARCH_TIMEOUT = float(os.environ.get('TORRENT_SEARCH_TIMEOUT', '8'))
+TORRENT_SEARCH_CACHE_TTL = int(os.environ.get('TORRENT_SEARCH_CACHE_TTL', '600'))
+TORRENT_SEARCH_CACHE_SIZE = int(os.environ.get('TORRENT_SEARCH_CACHE_SIZE', '256'))
+TORRENT_SEARCH_MIN_SEEDERS = int(os.environ.get('TORRENT_SEARCH_MIN_SEEDERS', '1'))
+APIBAY_URL = os.environ.get('APIBAY_URL', 'https://apibay.org')
+
+# --- Конфигурация фонового коллажа ---
+BACKGROUND_PHOTOS_LIMIT = int(os.environ.get('BACKGROUND_PHOTOS_LIMIT', '20'))
+BACKGROUND_CACHE_TTL = float(os.environ.get('BACKGROUND_CACHE_TTL', '60'))
+
+# --- Конфигурация прокси постеров ---
+POSTER_PROXY_ENABLED = os.environ.get('POSTER_PROXY_ENABLED', '1') != '0'
+POSTER_CACHE_DIR = os.environ.get('POSTER_CACHE_DIR') or os.path.join(app.instance_path, 'poster_cache')
+POSTER_CACHE_MAX_BYTES = int(os.environ.get('POSTER_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+POSTER_SOURCE_MAX_BYTES = int(os.environ.get('POSTER_SOURCE_MAX_BYTES', str(10 * 1024 * 1024)))
+POSTER_BROWSER_MAX_AGE = int(os.environ.get('POSTER_BROWSER_MAX_AGE', str(30 * 24 * 3600)))
+# Размеры (ширина, высота) вариантов: карточки галерей, фоновый коллаж и модальное окно
+POSTER_VARIANTS = {'card': (300, 450), 'collage': (240, 360), 'modal': (600, 900)}
 
 
 # --- Модели Данных ---
@@ -36,6 +181,7 @@ class MovieIdentifier(db.Model):
     __tablename__ = 'movie_identifier'
     kinopoisk_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
     magnet_link = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class Lottery(db.Model):
     id = db.Column(db.String(6), primary_key=True)
@@ -43,15 +189,26 @@ class Lottery(db.Model):
     result_name = db.Column(db.String(200), nullable=True)
     result_poster = db.Column(db.String(500), nullable=True)
     result_year = db.Column(db.String(10), nullable=True)
-    movies = db.relationship('Movie', backref='lottery', lazy=True, cascade="all, delete-orphan")
+    # Версия растёт при каждом изменении лотереи (розыгрыше); из неё строится ETag
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Победитель хранится ссылкой на фильм; result_* остаются снимком для
+    # страниц, которым нужны только название, постер и год.
+    winner_movie_id = db.Column(
+        db.Integer, db.ForeignKey('movie.id', use_alter=True, name='fk_lottery_winner_movie_id', ondelete='SET NULL'),
+        nullable=True,
+    )
+    movies = db.relationship('Movie', backref='lottery', lazy=True, cascade="all, delete-orphan", foreign_keys='Movie.lottery_id')
+    winner = db.relationship('Movie', foreign_keys=[winner_movie_id], post_update=True)
+    __table_args__ = (db.Index('ix_lottery_created_at_id', 'created_at', 'id'),)
 
 class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    kinopoisk_id = db.Column(db.Integer, nullable=True)
+    kinopoisk_id = db.Column(db.Integer, nullable=True, index=True)
     name = db.Column(db.String(200), nullable=False)
     poster = db.Column(db.String(500), nullable=True)
     year = db.Column(db.String(10), nullable=False)
-    lottery_id = db.Column(db.String(6), db.ForeignKey('lottery.id'), nullable=False)
+    lottery_id = db.Column(db.String(6), db.ForeignKey('lottery.id'), nullable=False, index=True)
     description = db.Column(db.Text, nullable=True)
     rating_kp = db.Column(db.Float, nullable=True)
     genres = db.Column(db.String(200), nullable=True)
@@ -70,6 +227,17 @@ class LibraryMovie(db.Model):
     genres = db.Column(db.String(200), nullable=True)
     countries = db.Column(db.String(200), nullable=True)
     added_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_library_movie_added_at_id', 'added_at', 'id'),
+        db.Index('ix_library_movie_name_year', 'name', 'year'),
+    )
+
+class KinopoiskCacheEntry(db.Model):
+    __tablename__ = 'kinopoisk_cache'
+    cache_key = db.Column(db.String(300), primary_key=True)
+    kinopoisk_id = db.Column(db.Integer, nullable=True, index=True)
+    payload = db.Column(db.Text, nullable=True)  # None - фильм не найден (негативный кэш)
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 class BackgroundPhoto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -78,109 +246,3120 @@ class BackgroundPhoto(db.Model):
     pos_left = db.Column(db.Float, nullable=False)
     rotation = db.Column(db.Integer, nullable=False)
     z_index = db.Column(db.Integer, nullable=False)
-    added_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    added_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
 
-# --- Вспомогательные функции ---
+class Job(db.Model):
+    """Задача для фонового воркера: добавление или удаление торрента в qBittorrent."""
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=1)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    idempotency_key = db.Column(db.String(200), unique=True, nullable=True)
+    result = db.Column(db.Text, nullable=True)  # JSON
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
 
-def get_active_torrents_map():
+class DownloadRequest(db.Model):
+    """Загрузка в очереди планировщика (см. DownloadScheduler)."""
+    __tablename__ = 'download_request'
+    id = db.Column(db.Integer, primary_key=True)
+    category = db.Column(db.String(100), nullable=False)
+    magnet_link = db.Column(db.Text, nullable=True)
+    kinopoisk_id = db.Column(db.Integer, nullable=True)
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, active, completed, failed, cancelled
+    job_id = db.Column(db.Integer, nullable=True)
+    torrent_hash = db.Column(db.String(64), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    idempotency_key = db.Column(db.String(200), nullable=True)
+    __table_args__ = (
+        db.Index('ix_download_request_status_priority', 'status', 'priority', 'created_at'),
+        db.Index('ix_download_request_idempotency_key', 'idempotency_key', unique=True),
+    )
+
+class TorrentAccess(db.Model):
+    """Когда загрузку категории последний раз смотрели или запрашивали (для LRU при очистке)."""
+    __tablename__ = 'torrent_access'
+    category = db.Column(db.String(100), primary_key=True)
+    last_access = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class ServiceLease(db.Model):
     """
-    Подключается к qBittorrent, получает все торренты и возвращает словарь,
-    где ключ - kinopoisk_id (из тега), а значение - хеш торрента.
+    Аренда периодической службы: пока expires_at не наступил, службу
+    выполняет только воркер holder (см. acquire_lease). В state служба
+    хранит результат последнего прохода (JSON), общий для всех воркеров.
     """
-    active_torrents = {}
-    qbt_client = None
+    __tablename__ = 'service_lease'
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100), nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    state = db.Column(db.Text, nullable=True)
+
+class SchemaMigration(db.Model):
+    """Журнал применённых миграций схемы (см. run_migrations)."""
+    __tablename__ = 'schema_migration'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# --- Миграции схемы ---
+# Каждая миграция - функция от соединения, которая только добавляет объекты
+# и безопасна при повторном запуске. Номер применённой миграции пишется в
+# schema_migration, так что на существующей БД выполняются только новые шаги.
+
+def _create_indexes(connection, *index_names):
+    indexes = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+    for name in index_names:
+        indexes[name].create(connection, checkfirst=True)
+
+def _create_missing_tables(connection):
+    # create_all по умолчанию пропускает уже существующие таблицы
+    db.metadata.create_all(connection)
+
+HOT_LOOKUP_INDEXES = (
+    'ix_movie_kinopoisk_id', 'ix_movie_lottery_id', 'ix_lottery_created_at_id',
+    'ix_library_movie_added_at_id', 'ix_library_movie_name_year', 'ix_background_photo_added_at',
+)
+
+def _create_hot_lookup_indexes(connection):
+    _create_indexes(connection, *HOT_LOOKUP_INDEXES)
+
+def _add_lottery_winner(connection):
+    columns = {column['name'] for column in db.inspect(connection).get_columns('lottery')}
+    if 'winner_movie_id' not in columns:
+        connection.execute(db.text(
+            'ALTER TABLE lottery ADD COLUMN winner_movie_id INTEGER '
+            'REFERENCES movie (id) ON DELETE SET NULL'
+        ))
+    # Старые лотереи: победитель - фильм этой лотереи с названием из result_name
+    connection.execute(db.text(
+        'UPDATE lottery SET winner_movie_id = ('
+        ' SELECT MIN(movie.id) FROM movie'
+        ' WHERE movie.lottery_id = lottery.id AND movie.name = lottery.result_name'
+        ') WHERE winner_movie_id IS NULL AND result_name IS NOT NULL'
+    ))
+
+def _add_version_columns(connection):
+    lottery_columns = {column['name'] for column in db.inspect(connection).get_columns('lottery')}
+    if 'version' not in lottery_columns:
+        connection.execute(db.text('ALTER TABLE lottery ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+    if 'updated_at' not in lottery_columns:
+        connection.execute(db.text('ALTER TABLE lottery ADD COLUMN updated_at TIMESTAMP'))
+    connection.execute(db.text('UPDATE lottery SET updated_at = created_at WHERE updated_at IS NULL'))
+    identifier_columns = {column['name'] for column in db.inspect(connection).get_columns('movie_identifier')}
+    if 'updated_at' not in identifier_columns:
+        connection.execute(db.text('ALTER TABLE movie_identifier ADD COLUMN updated_at TIMESTAMP'))
+
+def _add_download_idempotency_key(connection):
+    columns = {column['name'] for column in db.inspect(connection).get_columns('download_request')}
+    if 'idempotency_key' not in columns:
+        connection.execute(db.text('ALTER TABLE download_request ADD COLUMN idempotency_key VARCHAR(200)'))
+    for index in DownloadRequest.__table__.indexes:
+        if index.name == 'ix_download_request_idempotency_key':
+            index.create(connection, checkfirst=True)
+
+MIGRATIONS = [
+    (1, 'Недостающие таблицы', _create_missing_tables),
+    (2, 'Индексы для частых выборок', _create_hot_lookup_indexes),
+    (3, 'Ссылка лотереи на фильм-победитель', _add_lottery_winner),
+    (4, 'Очередь задач qBittorrent', lambda connection: Job.__table__.create(connection, checkfirst=True)),
+    (5, 'Версии лотерей и magnet-ссылок для ETag', _add_version_columns),
+    (6, 'Очередь загрузок', lambda connection: DownloadRequest.__table__.create(connection, checkfirst=True)),
+    (7, 'Последний доступ к загрузкам', lambda connection: TorrentAccess.__table__.create(connection, checkfirst=True)),
+    (8, 'Ключ идемпотентности загрузок', _add_download_idempotency_key),
+    (9, 'Аренды фоновых служб', lambda connection: ServiceLease.__table__.create(connection, checkfirst=True)),
+]
+
+def run_migrations():
+    """Применяет ещё не выполненные миграции по порядку. Возвращает список их номеров."""
+    with db.engine.begin() as connection:
+        SchemaMigration.__table__.create(connection, checkfirst=True)
+        applied = set(connection.execute(db.select(SchemaMigration.version)).scalars())
+
+    done = []
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with db.engine.begin() as connection:
+                migrate(connection)
+                connection.execute(SchemaMigration.__table__.insert().values(
+                    version=version, name=name, applied_at=datetime.utcnow(),
+                ))
+        except IntegrityError:
+            # Параллельный воркер успел применить эту миграцию раньше
+            continue
+        print(f"Применена миграция {version}: {name}")
+        done.append(version)
+    return done
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Обновляет схему БД без удаления данных."""
+    applied = run_migrations()
+    print(f"Применено миграций: {len(applied)}" if applied else "Схема БД уже актуальна.")
+
+# --- Метрики (Prometheus) ---
+# Небольшой собственный реестр метрик в текстовом формате Prometheus:
+# внешних зависимостей и сервисов не нужно, /metrics можно открыть
+# браузером или отдать локальному Prometheus. Значения живут в памяти
+# процесса, поэтому при нескольких воркерах каждый отдаёт свои.
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class GaugeMetric(Metric):
+    """Значение выставляется через set() или вычисляется при каждом чтении функцией collect."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        try:
+            collected = self.collect()
+        except Exception as e:
+            print(f"Не удалось собрать метрику {self.name}: {e}")
+            return []
+        if not isinstance(collected, dict):
+            collected = {(): collected}
+        return [(self.name, tuple(map(str, key)), (), value) for key, value in sorted(collected.items()) if value is not None]
+
+
+class CallbackCounterMetric(GaugeMetric):
+    """Счётчик, значения которого уже накапливает другой объект (например, collections.Counter)."""
+
+    kind = 'counter'
+
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][index] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def snapshot(self, **labels):
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return {"sum": state["sum"], "count": state["count"]} if state else {"sum": 0.0, "count": 0}
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, state["counts"]):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", key, (("le", _format_value(bound)),), cumulative))
+                samples.append((f"{self.name}_sum", key, (), state["sum"]))
+                samples.append((f"{self.name}_count", key, (), state["count"]))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(CounterMetric(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self.register(GaugeMetric(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self.register(HistogramMetric(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS = metrics.counter(
+    'movie_lottery_http_requests_total', 'HTTP-запросы по endpoint, методу и статусу.', ('endpoint', 'method', 'status'))
+HTTP_LATENCY = metrics.histogram(
+    'movie_lottery_http_request_duration_seconds', 'Время обработки HTTP-запроса.', ('endpoint', 'method'))
+HTTP_SQL_QUERIES = metrics.histogram(
+    'movie_lottery_http_request_sql_queries', 'Число SQL-запросов на один HTTP-запрос.', ('endpoint',), SQL_COUNT_BUCKETS)
+HTTP_SQL_TIME = metrics.histogram(
+    'movie_lottery_http_request_sql_duration_seconds', 'Суммарное время SQL-запросов за один HTTP-запрос.', ('endpoint',))
+SQL_QUERIES = metrics.counter('movie_lottery_sql_queries_total', 'Все SQL-запросы, включая фоновые потоки.')
+QBIT_REQUESTS = metrics.counter(
+    'movie_lottery_qbittorrent_requests_total', 'Вызовы API qBittorrent; outcome - ok или класс ошибки.', ('operation', 'outcome'))
+QBIT_LATENCY = metrics.histogram(
+    'movie_lottery_qbittorrent_request_duration_seconds', 'Время вызова API qBittorrent.', ('operation',))
+QBIT_COALESCED = metrics.counter(
+    'movie_lottery_qbittorrent_coalesced_total',
+    'Чтения qBittorrent, обслуженные без своего вызова; source - inflight или cache.', ('operation', 'source'))
+RETENTION_DELETED = metrics.counter(
+    'movie_lottery_retention_deleted_torrents_total', 'Торренты, удалённые политикой хранения.', ('reason',))
+RETENTION_FREED = metrics.counter(
+    'movie_lottery_retention_freed_bytes_total', 'Место, освобождённое политикой хранения.', ('reason',))
+KINOPOISK_REQUESTS = metrics.counter(
+    'movie_lottery_kinopoisk_requests_total', 'Запросы к API Кинопоиска; outcome - ok, not_found или класс ошибки.', ('outcome',))
+KINOPOISK_LATENCY = metrics.histogram(
+    'movie_lottery_kinopoisk_request_duration_seconds', 'Время запроса к API Кинопоиска.')
+CACHE_REQUESTS = metrics.counter(
+    'movie_lottery_cache_requests_total', 'Обращения к общему кэшу; result - hit, miss или error.', ('namespace', 'result'))
+
+
+def _time_call(counter, histogram, func, *args, labels=None, **kwargs):
+    """Вызывает func, записывая время в histogram и исход (ok/класс ошибки) в counter."""
+    labels = labels or {}
+    started = time.perf_counter()
+    outcome = 'ok'
     try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        torrents = qbt_client.torrents_info()
-        for torrent in torrents:
-            tags = torrent.tags.split(',')
-            for tag in tags:
-                tag = tag.strip()
-                if tag.startswith('kp-'):
-                    try:
-                        kp_id = int(tag.replace('kp-', ''))
-                        active_torrents[kp_id] = torrent.hash
-                        break 
-                    except (ValueError, TypeError):
-                        continue
-    except (qbittorrent_exceptions.APIConnectionError, requests.exceptions.RequestException) as e:
-        print(f"Ошибка подключения к qBittorrent: {e}")
-        return {} # Возвращаем пустой словарь в случае ошибки подключения
+        return func(*args, **kwargs)
     except Exception as e:
-        print(f"Неизвестная ошибка при работе с qBittorrent: {e}")
-        return {}
+        outcome = type(e).__name__
+        raise
     finally:
-        if qbt_client and qbt_client.is_logged_in:
-            try:
-                qbt_client.auth_log_out()
-            except Exception:
-                pass
-    return active_torrents
+        histogram.observe(time.perf_counter() - started, **labels)
+        counter.inc(outcome=outcome, **labels)
 
 
-def get_movie_data_from_kinopoisk(query):
-    headers = {"X-API-KEY": os.environ.get('KINOPOISK_API_TOKEN')}
-    params = {}
-    kinopoisk_id_match = re.search(r'kinopoisk\.ru/(?:film|series)/(\d+)/', query)
-    if kinopoisk_id_match:
-        movie_id = kinopoisk_id_match.group(1)
-        search_url = f"https://api.kinopoisk.dev/v1.4/movie/{movie_id}"
-    else:
-        search_url = "https://api.kinopoisk.dev/v1.4/movie/search"
-        params['query'] = query
-        params['limit'] = 1
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    SQL_QUERIES.inc()
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_time += time.perf_counter() - started
+
+
+with app.app_context():
+    # Движок Flask-SQLAlchemy создаётся в init_app, соединения при этом не открываются
+    sqlalchemy_event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+    sqlalchemy_event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_time = 0.0
+
+
+@app.after_request
+def _record_request_metrics(response):
+    if 'request_started' in g:
+        endpoint = request.endpoint or 'unmatched'
+        HTTP_LATENCY.observe(time.perf_counter() - g.request_started, endpoint=endpoint, method=request.method)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        HTTP_SQL_QUERIES.observe(g.sql_queries, endpoint=endpoint)
+        HTTP_SQL_TIME.observe(g.sql_time, endpoint=endpoint)
+    return response
+
+
+# --- Общий клиент qBittorrent ---
+
+_qbit_client = None
+_qbit_client_lock = threading.Lock()
+
+
+def _create_qbit_client():
+    client = Client(
+        host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD,
+        REQUESTS_ARGS={'timeout': (QBIT_CONNECT_TIMEOUT, QBIT_READ_TIMEOUT)},
+    )
+    client.auth_log_in()
+    return client
+
+
+def get_qbit_client():
+    """
+    Возвращает общий для процесса клиент qBittorrent. Клиент создаётся и
+    авторизуется один раз, после чего все маршруты используют его сессию
+    (keep-alive соединения), без логина и логаута на каждый запрос.
+    """
+    global _qbit_client
+    client = _qbit_client
+    if client is not None:
+        return client
+    with _qbit_client_lock:
+        if _qbit_client is None:
+            _qbit_client = _create_qbit_client()
+        return _qbit_client
+
+
+def reset_qbit_client(client=None):
+    """Сбрасывает общий клиент, чтобы следующий вызов создал его заново."""
+    global _qbit_client
+    with _qbit_client_lock:
+        if client is None or _qbit_client is client:
+            _qbit_client = None
+
+
+class _Flight:
+    def __init__(self, generation):
+        self.generation = generation
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных чтений: первый поток выполняет
+    вызов, остальные с тем же ключом ждут его результата (или ошибки).
+    Успешный результат ещё ttl секунд отдаётся из микрокэша. invalidate()
+    сбрасывает кэш и не даёт уже идущим чтениям сохранить устаревший ответ.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._cache = {}
+        self._generation = 0
+
+    def do(self, key, func, on_shared=None):
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                if on_shared:
+                    on_shared('cache')
+                return cached[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(self._generation)
+
+        if not leader:
+            if on_shared:
+                on_shared('inflight')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+                if flight.error is None and self.ttl > 0 and flight.generation == self._generation:
+                    self._cache[key] = (time.monotonic() + self.ttl, flight.result)
+            flight.done.set()
+        return flight.result
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+
+# Операции только для чтения, которые можно объединять; любые другие
+# вызовы (добавление, удаление) сбрасывают микрокэш чтений.
+QBIT_COALESCED_OPERATIONS = frozenset({'torrents_info', 'torrents_files', 'torrents_properties', 'torrents_piece_states'})
+qbit_reads = SingleFlight(QBIT_READ_CACHE_TTL)
+
+
+def qbit_request(operation, *args, **kwargs):
+    """
+    Вызывает метод `operation` общего клиента qBittorrent.
+    Если сессия истекла (401/403), клиент заново авторизуется и повторяет
+    вызов один раз. При обрыве соединения клиент сбрасывается и будет
+    пересоздан при следующем обращении. Одинаковые одновременные чтения
+    выполняются одним вызовом (см. SingleFlight).
+    """
+    def call():
+        return _time_call(QBIT_REQUESTS, QBIT_LATENCY, _qbit_call, operation, *args, labels={'operation': operation}, **kwargs)
+
+    if operation not in QBIT_COALESCED_OPERATIONS:
+        try:
+            return call()
+        finally:
+            if operation != 'sync_maindata':
+                qbit_reads.invalidate()
+
+    key = (operation, args, tuple(sorted(kwargs.items())))
+    result = qbit_reads.do(key, call, on_shared=lambda source: QBIT_COALESCED.inc(operation=operation, source=source))
+    # Список общий для всех ожидавших потоков: каждому отдаём свою копию
+    return list(result) if isinstance(result, list) else result
+
+
+class CircuitOpenError(qbittorrent_exceptions.APIConnectionError):
+    """Вызов отклонён без попытки соединения: qBittorrent помечен недоступным."""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса, общий для всех маршрутов и потоков.
+    closed - вызовы идут как обычно; после failure_threshold ошибок подряд
+    переходит в open и сразу отклоняет вызовы CircuitOpenError; через
+    reset_timeout - half_open: пропускает одну пробную попытку, по её
+    исходу снова closed или open.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self._trial_in_flight = False
+
+    def retry_in(self):
+        if self.state != 'open':
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def before_call(self):
+        with self._lock:
+            if self.state == 'open' and self.retry_in() <= 0:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            if self.state != 'closed':
+                raise CircuitOpenError(
+                    f"qBittorrent недоступен ({self.last_error}), повторная попытка через {self.retry_in():.0f} с"
+                )
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print("Связь с qBittorrent восстановлена.")
+            self.state, self.failures, self._trial_in_flight = 'closed', 0, False
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self._trial_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"qBittorrent недоступен, вызовы приостановлены на {self.reset_timeout:.0f} с: {error}")
+                self.state, self.opened_at = 'open', time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self.state, "failures": self.failures,
+                "retry_in": round(self.retry_in(), 1), "last_error": self.last_error,
+            }
+
+
+qbit_breaker = CircuitBreaker(QBIT_BREAKER_FAILURES, QBIT_BREAKER_RESET_TIMEOUT)
+# Ошибки, означающие недоступность qBittorrent (а не отказ в конкретной операции)
+QBIT_UNAVAILABLE_ERRORS = (
+    qbittorrent_exceptions.APIConnectionError, qbittorrent_exceptions.HTTP5XXError, requests.exceptions.RequestException,
+)
+
+
+def _qbit_call(operation, *args, **kwargs):
+    qbit_breaker.before_call()
     try:
-        response = requests.get(search_url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        if 'docs' in data and data['docs']: movie_data = data['docs'][0]
-        elif 'id' in data: movie_data = data
-        else: return None
-        genres = [g['name'] for g in movie_data.get('genres', [])[:3]]
-        countries = [c['name'] for c in movie_data.get('countries', [])[:3]]
-        return {
-            "kinopoisk_id": movie_data.get('id'),
-            "name": movie_data.get('name', 'Название не найдено'), "poster": movie_data.get('poster', {}).get('url'),
-            "year": str(movie_data.get('year', '')), "description": movie_data.get('description', 'Описание отсутствует.'),
-            "rating_kp": movie_data.get('rating', {}).get('kp', 0.0), "genres": ", ".join(genres), "countries": ", ".join(countries)
-        }
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при запросе к API Кинопоиска: {e}")
-        return None
+        result = _qbit_call_unguarded(operation, *args, **kwargs)
+    except QBIT_UNAVAILABLE_ERRORS as e:
+        qbit_breaker.record_failure(e)
+        raise
+    except Exception:
+        # qBittorrent ответил, пусть и ошибкой (4xx) - он доступен
+        qbit_breaker.record_success()
+        raise
+    qbit_breaker.record_success()
+    return result
 
-def generate_unique_id(length=6):
-    while True:
-        lottery_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
-        if not Lottery.query.get(lottery_id): return lottery_id
 
-def get_background_photos():
+def _qbit_call_unguarded(operation, *args, **kwargs):
+    client = get_qbit_client()
     try:
-        photos = BackgroundPhoto.query.order_by(BackgroundPhoto.added_at.desc()).limit(20).all()
-        return [
-            {
-                "poster_url": photo.poster_url, "pos_top": photo.pos_top,
-                "pos_left": photo.pos_left, "rotation": photo.rotation, "z_index": photo.z_index,
-            } for photo in photos
-        ]
-    except ProgrammingError:
-        return []
+        return getattr(client, operation)(*args, **kwargs)
+    except (qbittorrent_exceptions.Forbidden403Error, qbittorrent_exceptions.Unauthorized401Error):
+        with _qbit_client_lock:
+            client.auth_log_in()
+        return getattr(client, operation)(*args, **kwargs)
+    except qbittorrent_exceptions.HTTPError:
+        raise
+    except (qbittorrent_exceptions.APIConnectionError, requests.exceptions.RequestException):
+        reset_qbit_client(client)
+        raise
+
+
+# --- Снимок состояния торрентов ---
+
+class SnapshotTorrent(dict):
+    """Торрент из снимка: поля sync/maindata с доступом через атрибуты."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class TorrentSnapshot:
+    """
+    Живой снимок всех торрентов qBittorrent в памяти процесса.
+    Обновляется дельтами протокола sync/maindata (по rid) и держит индексы
+    по хешу, тегу kp-<id> и категории, чтобы маршруты читали их за O(1).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._torrents = {}
+        self._by_kinopoisk = {}
+        self._by_category = {}
+        self.rid = 0
+        self.version = 0
+        # Меняется, только когда меняется kinopoisk_map() (а не прогресс загрузок)
+        self.kinopoisk_version = 0
+        self._kinopoisk_digest = None
+        self.updated_at = None
+        self.last_error = None
+        # server_state из sync/maindata: свободное место на диске и т.п.
+        self.server_state = {}
+
+    def _index(self, torrent):
+        kp_id = _extract_kinopoisk_id(torrent.get('tags'))
+        if kp_id:
+            self._by_kinopoisk.setdefault(kp_id, set()).add(torrent['hash'])
+        self._by_category.setdefault(torrent.get('category') or '', set()).add(torrent['hash'])
+
+    def _unindex(self, torrent):
+        kp_id = _extract_kinopoisk_id(torrent.get('tags'))
+        if kp_id and kp_id in self._by_kinopoisk:
+            self._by_kinopoisk[kp_id].discard(torrent['hash'])
+            if not self._by_kinopoisk[kp_id]:
+                del self._by_kinopoisk[kp_id]
+        category = torrent.get('category') or ''
+        if category in self._by_category:
+            self._by_category[category].discard(torrent['hash'])
+            if not self._by_category[category]:
+                del self._by_category[category]
+
+    def apply_maindata(self, data):
+        """
+        Применяет ответ sync/maindata (полный или дельту) к снимку.
+        Возвращает пары (торрент, удалён ли он) для всех изменившихся торрентов.
+        """
+        with self._lock:
+            changes = []
+            torrents = data.get('torrents') or {}
+            removed = list(data.get('torrents_removed') or [])
+            if data.get('full_update'):
+                removed += [h for h in self._torrents if h not in torrents]
+            kinopoisk_changed = False
+            for torrent_hash, fields in torrents.items():
+                torrent = self._torrents.get(torrent_hash)
+                if torrent is None:
+                    torrent = SnapshotTorrent(hash=torrent_hash)
+                    self._torrents[torrent_hash] = torrent
+                    old_kp_id = None
+                else:
+                    old_kp_id = _extract_kinopoisk_id(torrent.get('tags'))
+                    self._unindex(torrent)
+                torrent.update(fields)
+                self._index(torrent)
+                kinopoisk_changed |= old_kp_id != _extract_kinopoisk_id(torrent.get('tags'))
+                changes.append((torrent, False))
+            for torrent_hash in removed:
+                torrent = self._torrents.pop(torrent_hash, None)
+                if torrent is not None:
+                    self._unindex(torrent)
+                    kinopoisk_changed |= _extract_kinopoisk_id(torrent.get('tags')) is not None
+                    changes.append((torrent, True))
+            self.server_state.update(data.get('server_state') or {})
+            self.rid = data.get('rid', self.rid)
+            self.updated_at = time.monotonic()
+            self.last_error = None
+            if changes:
+                self.version += 1
+            if kinopoisk_changed:
+                self.kinopoisk_version += 1
+            return changes
+
+    def mark_error(self, error):
+        with self._lock:
+            self.last_error = str(error)
+
+    def age(self):
+        """Возраст снимка в секундах или None, если он ещё ни разу не загружался."""
+        if self.updated_at is None:
+            return None
+        return time.monotonic() - self.updated_at
+
+    def by_hash(self, torrent_hash):
+        with self._lock:
+            return self._torrents.get(torrent_hash)
+
+    def by_kinopoisk(self, kinopoisk_id):
+        with self._lock:
+            return [self._torrents[h] for h in self._by_kinopoisk.get(kinopoisk_id, ())]
+
+    def by_category(self, category):
+        with self._lock:
+            return [self._torrents[h] for h in self._by_category.get(category, ())]
+
+    def all(self):
+        with self._lock:
+            return list(self._torrents.values())
+
+    def kinopoisk_digest(self):
+        """
+        Короткий хеш kinopoisk_map(): одинаков во всех воркерах с одинаковым
+        снимком, поэтому годится для ETag. Пересчитывается только при смене
+        kinopoisk_version.
+        """
+        with self._lock:
+            cached = self._kinopoisk_digest
+            if cached is None or cached[0] != self.kinopoisk_version:
+                items = sorted((kp_id, min(hashes)) for kp_id, hashes in self._by_kinopoisk.items())
+                cached = (self.kinopoisk_version, hashlib.sha1(repr(items).encode()).hexdigest()[:16])
+                self._kinopoisk_digest = cached
+            return cached[1]
+
+    def kinopoisk_map(self):
+        """Словарь kinopoisk_id -> хеш торрента (как раньше отдавал get_active_torrents_map)."""
+        with self._lock:
+            return {kp_id: min(hashes) for kp_id, hashes in self._by_kinopoisk.items()}
+
+
+class TorrentSynchronizer:
+    """
+    Фоновый поток, который каждые `interval` секунд подтягивает дельту
+    sync/maindata в снимок. Если поток не запущен (тесты, отдельные
+    скрипты), снимок обновляется синхронно при чтении устаревших данных.
+    """
+
+    def __init__(self, snapshot, interval, max_age):
+        self.snapshot = snapshot
+        self.interval = interval
+        self.max_age = max_age
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def refresh(self):
+        with self._refresh_lock:
+            try:
+                data = qbit_request('sync_maindata', rid=self.snapshot.rid)
+            except Exception as e:
+                print(f"Ошибка синхронизации торрентов с qBittorrent: {e}")
+                self.snapshot.mark_error(e)
+                return False
+            changes = self.snapshot.apply_maindata(data)
+            for torrent, removed in changes:
+                event_broker.publish('torrent', _torrent_event_payload(torrent, removed))
+            download_scheduler.torrents_changed(changes)
+            return True
+
+    def ensure_fresh(self):
+        """Синхронно обновляет снимок, если фоновый поток не успевает или не запущен."""
+        age = self.snapshot.age()
+        if age is not None and age <= (self.max_age if self.is_running else self.interval):
+            return
+        self.refresh()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.refresh()
+            self._stop_event.wait(self.interval)
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='torrent-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def _torrent_event_payload(torrent, removed=False):
+    try:
+        payload = {"status": "not_found"} if removed else _format_torrent_status(torrent)
+    except (AttributeError, TypeError):
+        payload = {"status": torrent.get('state', 'unknown')}
+    payload.update({
+        "hash": torrent['hash'],
+        "category": torrent.get('category') or '',
+        "kinopoisk_id": _extract_kinopoisk_id(torrent.get('tags')),
+    })
+    return payload
+
+
+# --- Шина событий (SSE) ---
+
+class EventBroker:
+    """
+    Внутрипроцессная шина событий для /api/events. Последние события
+    хранятся в кольцевом буфере, поэтому клиент может продолжить поток
+    с Last-Event-ID после переподключения.
+    """
+
+    def __init__(self, history_size):
+        self._condition = threading.Condition()
+        self._events = collections.deque(maxlen=history_size)
+        self.last_id = 0
+
+    def publish(self, event_type, data):
+        with self._condition:
+            self.last_id += 1
+            event = {"id": self.last_id, "type": event_type, "data": data}
+            self._events.append(event)
+            self._condition.notify_all()
+        return event
+
+    def events_since(self, last_id):
+        """
+        События с id больше last_id. Возвращает None, если часть из них уже
+        вытеснена из буфера и клиенту нужно перечитать состояние целиком.
+        """
+        with self._condition:
+            if last_id > self.last_id:
+                return None
+            if self._events and last_id < self._events[0]["id"] - 1:
+                return None
+            return [event for event in self._events if event["id"] > last_id]
+
+    def wait(self, last_id, timeout):
+        """Ждёт появления события новее last_id не дольше timeout секунд."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.last_id > last_id, timeout)
+
+
+event_broker = EventBroker(EVENT_HISTORY_SIZE)
+torrent_snapshot = TorrentSnapshot()
+torrent_sync = TorrentSynchronizer(torrent_snapshot, TORRENT_SYNC_INTERVAL, TORRENT_SNAPSHOT_MAX_AGE)
+
+
+# --- Общий кэш ---
+# Под gunicorn у каждого воркера своя память, поэтому кэш в процессе
+# дублируется и сбрасывается несогласованно. Кэшируемые чтения (ответы
+# Кинопоиска, поиск торрентов, фоновый коллаж, собранные страницы) идут
+# через Cache со сменным бэкендом: local - LRU в памяти процесса, sqlite -
+# файл, общий для воркеров одного хоста, redis - сервер по протоколу RESP.
+# Снимок торрентов и объединение чтений qBittorrent остаются в процессе:
+# их обновляет собственный поток синхронизации каждого воркера.
+
+class LRUCache:
+    """Потокобезопасный LRU-словарь ограниченного размера."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class CacheBackendError(Exception):
+    """Ошибка бэкенда кэша (например, ответ -ERR от Redis)."""
+
+
+class LocalCacheBackend:
+    """
+    LRU в памяти процесса. Значения - строки, срок жизни проверяется при
+    чтении. Счётчики версий лежат отдельно, чтобы LRU их не вытеснял.
+    """
+
+    name = 'local'
+
+    def __init__(self, max_entries):
+        self._items = LRUCache(max_entries)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at is not None and expires_at <= time.time():
+            self._items.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._items.set(key, (time.time() + ttl if ttl else None, value))
+
+    def delete(self, key):
+        self._items.delete(key)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteCacheBackend:
+    """
+    Кэш в файле SQLite, общий для всех воркеров одного хоста. WAL позволяет
+    читать параллельно с записью, mmap_size отображает файл в память, так
+    что горячие чтения не копируют страницы через read(). Соединение своё
+    у каждого потока и пересоздаётся после fork (gunicorn --preload).
+    Просроченные записи удаляются раз в purge_every записей.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, mmap_size=64 * 1024 * 1024, timeout=5.0, purge_every=500):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.timeout = timeout
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entry '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_entry_expires_at ON cache_entry (expires_at)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        return conn
+
+    def _connection(self):
+        pid, conn = getattr(self._local, 'conn', (None, None))
+        if conn is None or pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = (os.getpid(), conn)
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM cache_entry WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache_entry (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, value, time.time() + ttl if ttl else None),
+        )
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            conn.execute('DELETE FROM cache_entry WHERE expires_at <= ?', (time.time(),))
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+
+    def counter(self, key):
+        return int(self.get(key) or 0)
+
+    def incr(self, key):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT value FROM cache_entry WHERE key = ?', (key,)).fetchone()
+            value = int(row[0]) + 1 if row else 1
+            conn.execute('INSERT OR REPLACE INTO cache_entry (key, value, expires_at) VALUES (?, ?, NULL)', (key, str(value)))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return value
+
+
+class RedisCacheBackend:
+    """
+    Кэш в Redis (или совместимом сервере: KeyDB, Valkey, Dragonfly) через
+    протокол RESP - клиентская библиотека не нужна. URL вида
+    redis://[:пароль@]хост[:порт][/номер_базы]. Соединение своё у каждого
+    потока; после сетевой ошибки оно закрывается и открывается заново при
+    следующем обращении. Счётчики версий хранятся без TTL - при политиках
+    вытеснения volatile-* сервер их не удалит.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url, timeout=0.5):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ('redis', ''):
+            raise ValueError(f"Неподдерживаемая схема адреса Redis: {parsed.scheme}")
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.strip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @staticmethod
+    def _encode(args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(parts)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Redis закрыл соединение")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b'+':
+            return body.decode('utf-8')
+        if prefix == b'-':
+            raise CacheBackendError(body.decode('utf-8', 'replace'))
+        if prefix == b':':
+            return int(body)
+        if prefix == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Redis закрыл соединение")
+            return data[:-2]
+        if prefix == b'*':
+            length = int(body)
+            return None if length < 0 else [self._read_reply(reader) for _ in range(length)]
+        raise CacheBackendError(f"Неожиданный ответ Redis: {line!r}")
+
+    def _roundtrip(self, conn, args):
+        sock, reader = conn
+        sock.sendall(self._encode(args))
+        return self._read_reply(reader)
+
+    def _connection(self):
+        pid, conn = getattr(self._local, 'conn', (None, None))
+        if conn is not None and pid == os.getpid():
+            return conn
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        conn = (sock, sock.makefile('rb'))
+        try:
+            if self.password:
+                self._roundtrip(conn, ('AUTH', self.password))
+            if self.db:
+                self._roundtrip(conn, ('SELECT', self.db))
+        except BaseException:
+            sock.close()
+            raise
+        self._local.conn = (os.getpid(), conn)
+        return conn
+
+    def _disconnect(self):
+        _, conn = getattr(self._local, 'conn', (None, None))
+        self._local.conn = (None, None)
+        if conn is not None:
+            try:
+                conn[1].close()
+                conn[0].close()
+            except OSError:
+                pass
+
+    def command(self, *args):
+        conn = self._connection()
+        try:
+            return self._roundtrip(conn, args)
+        except CacheBackendError:
+            raise  # -ERR: протокол не рассинхронизирован, соединение остаётся
+        except BaseException:
+            self._disconnect()
+            raise
+
+    def get(self, key):
+        value = self.command('GET', key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.command('SET', key, value, 'PX', max(1, int(ttl * 1000)))
+        else:
+            self.command('SET', key, value)
+
+    def delete(self, key):
+        self.command('DEL', key)
+
+    def counter(self, key):
+        return int(self.get(key) or 0)
+
+    def incr(self, key):
+        return self.command('INCR', key)
+
+
+CACHE_BACKEND_ERRORS = (CacheBackendError, OSError, sqlite3.Error, ValueError)
+_CACHE_MISSING = object()
+
+
+class Cache:
+    """
+    Кэш с пространствами имён поверх сменного бэкенда. Значения хранятся
+    в JSON, ключ в бэкенде - <prefix>:<namespace>:v<версия>:<key>.
+    invalidate(namespace) одним атомарным INCR увеличивает версию
+    пространства в самом бэкенде: старые записи становятся недостижимы для
+    всех воркеров сразу и дальше вытесняются по TTL или LRU. Версию воркер
+    перечитывает из бэкенда не чаще раза в version_ttl секунд - это предел
+    расхождения между воркерами после сброса. Ошибки бэкенда не ломают
+    запросы: чтение считается промахом, запись пропускается.
+    """
+
+    def __init__(self, backend, prefix='movie-lottery', default_ttl=300, version_ttl=1.0):
+        self.backend = backend
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+        self.version_ttl = version_ttl
+        self._versions = {}  # namespace -> (версия, monotonic до перепроверки)
+        self._lock = threading.Lock()
+        self._failing = False
+
+    def namespace(self, name, ttl=None):
+        return CacheNamespace(self, name, ttl)
+
+    def _report(self, action, error):
+        CACHE_REQUESTS.inc(namespace=action, result='error')
+        if not self._failing:
+            print(f"Кэш ({self.backend.name}) недоступен, работаем без него: {error}")
+        self._failing = True
+
+    def _version_key(self, namespace):
+        return f"{self.prefix}:{namespace}:version"
+
+    def version(self, namespace):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(namespace)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        try:
+            version = self.backend.counter(self._version_key(namespace))
+        except CACHE_BACKEND_ERRORS as e:
+            self._report(namespace, e)
+            # Без бэкенда держим последнюю известную версию
+            return cached[0] if cached is not None else 0
+        with self._lock:
+            self._versions[namespace] = (version, now + self.version_ttl)
+        return version
+
+    def _key(self, namespace, key, version=None):
+        if version is None:
+            version = self.version(namespace)
+        return f"{self.prefix}:{namespace}:v{version}:{key}"
+
+    def get(self, namespace, key, default=None):
+        try:
+            raw = self.backend.get(self._key(namespace, key))
+        except CACHE_BACKEND_ERRORS as e:
+            self._report(namespace, e)
+            return default
+        self._failing = False
+        CACHE_REQUESTS.inc(namespace=namespace, result='hit' if raw is not None else 'miss')
+        return json.loads(raw) if raw is not None else default
+
+    def set(self, namespace, key, value, ttl=None, version=None):
+        """version - версия, прочитанная до сборки значения: если пространство за это время сбросили, запись уйдёт в уже устаревшую версию."""
+        try:
+            self.backend.set(
+                self._key(namespace, key, version), json.dumps(value, ensure_ascii=False),
+                ttl if ttl is not None else self.default_ttl,
+            )
+        except CACHE_BACKEND_ERRORS as e:
+            self._report(namespace, e)
+
+    def delete(self, namespace, key):
+        try:
+            self.backend.delete(self._key(namespace, key))
+        except CACHE_BACKEND_ERRORS as e:
+            self._report(namespace, e)
+
+    def invalidate(self, namespace):
+        try:
+            version = self.backend.incr(self._version_key(namespace))
+        except CACHE_BACKEND_ERRORS as e:
+            self._report(namespace, e)
+            with self._lock:
+                # Хотя бы этот воркер перестаёт видеть старые записи
+                version = self._versions.get(namespace, (0, 0))[0] + 1
+        with self._lock:
+            self._versions[namespace] = (version, time.monotonic() + self.version_ttl)
+
+
+class CacheNamespace:
+    """Пространство имён общего кэша со своим TTL по умолчанию."""
+
+    def __init__(self, cache, name, ttl=None):
+        self.cache = cache
+        self.name = name
+        self.ttl = ttl
+
+    def version(self):
+        return self.cache.version(self.name)
+
+    def get(self, key, default=None):
+        return self.cache.get(self.name, key, default)
+
+    def set(self, key, value, ttl=None, version=None):
+        self.cache.set(self.name, key, value, ttl if ttl is not None else self.ttl, version)
+
+    def delete(self, key):
+        self.cache.delete(self.name, key)
+
+    def clear(self):
+        """Сбрасывает всё пространство во всех воркерах (увеличивает версию)."""
+        self.cache.invalidate(self.name)
+
+    def get_or_set(self, key, build, ttl=None):
+        value = self.get(key, _CACHE_MISSING)
+        if value is _CACHE_MISSING:
+            version = self.version()
+            value = build()
+            self.set(key, value, ttl, version)
+        return value
+
+
+CACHE_BACKEND_FACTORIES = {
+    'local': lambda: LocalCacheBackend(CACHE_LOCAL_SIZE),
+    'sqlite': lambda: SQLiteCacheBackend(CACHE_SQLITE_PATH, CACHE_SQLITE_MMAP_SIZE),
+    'redis': lambda: RedisCacheBackend(CACHE_REDIS_URL, CACHE_REDIS_TIMEOUT),
+}
+
+
+def create_cache_backend(name):
+    """Бэкенд по имени; при неизвестном имени или ошибке настройки - local."""
+    factory = CACHE_BACKEND_FACTORIES.get(name)
+    if factory is None:
+        print(f"Неизвестный бэкенд кэша {name!r}, используется local")
+        return CACHE_BACKEND_FACTORIES['local']()
+    try:
+        return factory()
+    except CACHE_BACKEND_ERRORS as e:
+        print(f"Не удалось подключить кэш {name}: {e}. Используется local")
+        return CACHE_BACKEND_FACTORIES['local']()
+
+
+shared_cache = Cache(create_cache_backend(CACHE_BACKEND), CACHE_PREFIX, CACHE_DEFAULT_TTL, CACHE_VERSION_TTL)
+
+
+# --- Кэш Кинопоиска ---
+
+KINOPOISK_URL_RE = re.compile(r'kinopoisk\.ru/(?:film|series)/(\d+)/')
+
+
+def _create_kinopoisk_session():
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504), allowed_methods=('GET',))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+kinopoisk_session = _create_kinopoisk_session()
+kinopoisk_executor = ThreadPoolExecutor(max_workers=KINOPOISK_BATCH_WORKERS, thread_name_prefix='kinopoisk')
+
+
+class KinopoiskCache:
+    """
+    Двухуровневый кэш ответов Кинопоиска: пространство общего кэша перед
+    таблицей kinopoisk_cache. Хранит и найденные фильмы (KINOPOISK_CACHE_TTL),
+    и отрицательные ответы "не найдено" (KINOPOISK_NEGATIVE_CACHE_TTL).
+    """
+
+    def __init__(self, memory, ttl, negative_ttl):
+        self.memory = memory
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = collections.Counter()
+
+    def _ttl(self, payload):
+        return self.ttl if payload is not None else self.negative_ttl
+
+    def _is_fresh(self, payload, fetched_at):
+        return (datetime.utcnow() - fetched_at).total_seconds() < self._ttl(payload)
+
+    def _remember(self, key, payload, fetched_at):
+        # В общем кэше запись живёт столько, сколько ей осталось по TTL
+        remaining = self._ttl(payload) - (datetime.utcnow() - fetched_at).total_seconds()
+        if remaining > 0:
+            self.memory.set(key, {"payload": payload, "fetched_at": fetched_at.isoformat()}, ttl=remaining)
+
+    def get(self, key):
+        """Возвращает (найдено_в_кэше, данные). Данные None - закэшированное "не найдено"."""
+        cached = self.memory.get(key)
+        if cached is not None:
+            fetched_at = datetime.fromisoformat(cached['fetched_at'])
+            if self._is_fresh(cached['payload'], fetched_at):
+                self.stats['memory_hits'] += 1
+                return True, cached['payload']
+
+        try:
+            entry = db.session.get(KinopoiskCacheEntry, key)
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"Ошибка чтения кэша Кинопоиска: {e}")
+            entry = None
+        if entry is not None and self._is_fresh(entry.payload, entry.fetched_at):
+            payload = json.loads(entry.payload) if entry.payload else None
+            self._remember(key, payload, entry.fetched_at)
+            self.stats['db_hits'] += 1
+            return True, payload
+
+        self.stats['misses'] += 1
+        return False, None
+
+    def set(self, key, payload):
+        fetched_at = datetime.utcnow()
+        self._remember(key, payload, fetched_at)
+        try:
+            entry = db.session.get(KinopoiskCacheEntry, key) or KinopoiskCacheEntry(cache_key=key)
+            entry.kinopoisk_id = payload.get('kinopoisk_id') if payload else None
+            entry.payload = json.dumps(payload, ensure_ascii=False) if payload is not None else None
+            entry.fetched_at = fetched_at
+            db.session.add(entry)
+            db.session.commit()
+        except IntegrityError:
+            # Тот же ключ только что записал параллельный запрос - его запись не хуже
+            db.session.rollback()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"Ошибка записи в кэш Кинопоиска: {e}")
+
+    def snapshot_stats(self):
+        lookups = self.stats['memory_hits'] + self.stats['db_hits'] + self.stats['misses']
+        hits = self.stats['memory_hits'] + self.stats['db_hits'] + self.stats['warm_hits']
+        return {**self.stats, "cache_backend": self.memory.cache.backend.name, "hit_ratio": round(hits / lookups, 3) if lookups else None}
+
+
+kinopoisk_cache = KinopoiskCache(shared_cache.namespace('kinopoisk'), KINOPOISK_CACHE_TTL, KINOPOISK_NEGATIVE_CACHE_TTL)
+
+
+def _normalize_kinopoisk_query(query):
+    return ' '.join(query.lower().replace('ё', 'е').split())
+
+
+def _kinopoisk_cache_key(query):
+    kinopoisk_id_match = KINOPOISK_URL_RE.search(query)
+    if kinopoisk_id_match:
+        return f"id:{int(kinopoisk_id_match.group(1))}"
+    return f"q:{_normalize_kinopoisk_query(query)}"
+
+
+def _movie_row_to_kinopoisk_data(movie):
+    return {
+        "kinopoisk_id": movie.kinopoisk_id, "name": movie.name, "poster": movie.poster,
+        "year": movie.year or '', "description": movie.description or 'Описание отсутствует.',
+        "rating_kp": movie.rating_kp if movie.rating_kp is not None else 0.0,
+        "genres": movie.genres or '', "countries": movie.countries or '',
+    }
+
+
+def _find_stored_movie_data(kinopoisk_id):
+    """Данные о фильме из уже сохранённых строк LibraryMovie/Movie (тёплый источник кэша)."""
+    stored = (
+        LibraryMovie.query.filter_by(kinopoisk_id=kinopoisk_id).first()
+        or Movie.query.filter_by(kinopoisk_id=kinopoisk_id).order_by(Movie.id.desc()).first()
+    )
+    if stored is None or not stored.name or not stored.poster or not stored.description:
+        return None
+    return _movie_row_to_kinopoisk_data(stored)
+
+
+def _parse_kinopoisk_movie(movie_data):
+    genres = [g['name'] for g in movie_data.get('genres', [])[:3]]
+    countries = [c['name'] for c in movie_data.get('countries', [])[:3]]
+    return {
+        "kinopoisk_id": movie_data.get('id'),
+        "name": movie_data.get('name', 'Название не найдено'), "poster": (movie_data.get('poster') or {}).get('url'),
+        "year": str(movie_data.get('year', '')), "description": movie_data.get('description', 'Описание отсутствует.'),
+        "rating_kp": (movie_data.get('rating') or {}).get('kp', 0.0), "genres": ", ".join(genres), "countries": ", ".join(countries)
+    }
+
+
+# --- Фоновый коллаж ---
+
+class BackgroundCollage:
+    """
+    Кэш набора постеров для фона в общем кэше. Запись в BackgroundPhoto
+    сбрасывает пространство (invalidate) сразу во всех воркерах, и
+    следующий get() перечитывает БД. Без записей набор перечитывается не
+    чаще раза в ttl секунд.
+    """
+
+    def __init__(self, cache, limit, ttl):
+        self.cache = cache
+        self.limit = limit
+        self.ttl = ttl
+
+    def invalidate(self):
+        self.cache.clear()
+
+    def get(self):
+        """Возвращает (photos, etag)."""
+        cached = self.cache.get('collage')
+        if cached is not None:
+            return cached['photos'], cached['etag']
+
+        version = self.cache.version()
+        photos = self._load()
+        etag = hashlib.sha1(json.dumps(photos, sort_keys=True).encode('utf-8')).hexdigest()
+        # Если за время чтения была запись, результат уйдёт в устаревшую версию
+        self.cache.set('collage', {"photos": photos, "etag": etag}, ttl=self.ttl, version=version)
+        return photos, etag
+
+    def _load(self):
+        try:
+            photos = BackgroundPhoto.query.order_by(BackgroundPhoto.added_at.desc()).limit(self.limit).all()
+        except ProgrammingError:
+            db.session.rollback()
+            return []
+        return [
+            {
+                "poster_url": photo.poster_url, "pos_top": photo.pos_top,
+                "pos_left": photo.pos_left, "rotation": photo.rotation, "z_index": photo.z_index,
+            } for photo in photos
+        ]
+
+
+background_collage = BackgroundCollage(shared_cache.namespace('background'), BACKGROUND_PHOTOS_LIMIT, BACKGROUND_CACHE_TTL)
+
+# --- Прокси постеров ---
+
+class HttpPosterFetcher:
+    """Скачивает оригинал постера по HTTP(S). Возвращает (bytes, content_type)."""
+
+    def __init__(self, max_bytes, timeout=(3.05, 15)):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def fetch(self, url):
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            if not content_type.startswith('image/'):
+                raise ValueError(f"Ответ не похож на изображение: {content_type or 'без Content-Type'}")
+            chunks, size = [], 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ValueError(f"Постер больше {self.max_bytes} байт")
+                chunks.append(chunk)
+        return b''.join(chunks), content_type
+
+
+def _resize_poster(data, mimetype, size):
+    """Уменьшает постер до size и пережимает в JPEG. Без Pillow возвращает оригинал."""
+    if Image is None:
+        return data, mimetype
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail(size)
+            buffer = io.BytesIO()
+            image.convert('RGB').save(buffer, 'JPEG', quality=82, optimize=True, progressive=True)
+    except (OSError, ValueError) as e:
+        print(f"Не удалось уменьшить постер: {e}")
+        return data, mimetype
+    resized = buffer.getvalue()
+    # Маленький оригинал после пережатия может стать только больше
+    return (resized, 'image/jpeg') if len(resized) < len(data) else (data, mimetype)
+
+
+class PosterCache:
+    """
+    Дисковый кэш постеров. Файлы лежат по sha256 содержимого
+    (blobs/ab/<digest>), поэтому одинаковые картинки хранятся один раз, а
+    digest служит сильным ETag. Ссылки refs/<sha256 url>.<вариант> хранят
+    digest и MIME-тип. Чтение обновляет mtime файла; при превышении
+    max_bytes удаляются файлы, которые дольше всех не читали.
+    """
+
+    def __init__(self, root, max_bytes, fetcher, variants):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher
+        self.variants = variants
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _ref_path(self, url, variant):
+        url_key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, 'refs', url_key[:2], f"{url_key}.{variant}")
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def lookup(self, url, variant):
+        """Возвращает (digest, mimetype, path) или None, если варианта нет в кэше."""
+        try:
+            with open(self._ref_path(url, variant), encoding='utf-8') as f:
+                digest, mimetype = f.read().split(' ', 1)
+            path = self._blob_path(digest)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return digest, mimetype, path
+
+    def _store(self, url, variant, data, mimetype):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            self._write_atomic(path, data)
+            with self._lock:
+                if self._size is not None:
+                    self._size += len(data)
+        self._write_atomic(self._ref_path(url, variant), f"{digest} {mimetype}".encode('utf-8'))
+        return digest
+
+    def fetch(self, url, variant):
+        """Скачивает оригинал (если его ещё нет), строит все варианты и возвращает запрошенный."""
+        cached = self.lookup(url, 'original')
+        if cached:
+            with open(cached[2], 'rb') as f:
+                data, mimetype = f.read(), cached[1]
+        else:
+            data, mimetype = self.fetcher.fetch(url)
+            self._store(url, 'original', data, mimetype)
+        for name, size in self.variants.items():
+            self._store(url, name, *_resize_poster(data, mimetype, size))
+
+        result = self.lookup(url, variant)
+        self._evict(keep={result[0]} if result else set())
+        return result
+
+    def _blobs(self):
+        blobs_root = os.path.join(self.root, 'blobs')
+        for directory, _, files in os.walk(blobs_root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, name, path
+
+    def _evict(self, keep=()):
+        with self._lock:
+            if self._size is not None and self._size <= self.max_bytes:
+                return
+            blobs = sorted(self._blobs())
+            size = sum(blob[1] for blob in blobs)
+            # Чистим с запасом, чтобы не сканировать каталог на каждой записи
+            target = self.max_bytes * 0.9 if size > self.max_bytes else size
+            for _, blob_size, name, path in blobs:
+                if size <= target:
+                    break
+                if name in keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= blob_size
+            self._size = size
+
+
+poster_cache = PosterCache(
+    POSTER_CACHE_DIR, POSTER_CACHE_MAX_BYTES,
+    HttpPosterFetcher(POSTER_SOURCE_MAX_BYTES), POSTER_VARIANTS,
+)
+
+
+def _is_known_poster(url):
+    """Прокси отдаёт только постеры, которые уже есть в БД, а не любые адреса."""
+    for column in (Movie.poster, LibraryMovie.poster, BackgroundPhoto.poster_url):
+        if db.session.query(db.select(column).where(column == url).exists()).scalar():
+            return True
+    return False
+
+
+@app.template_filter('poster')
+def poster_filter(url, variant='card'):
+    """Адрес постера через прокси: {{ movie.poster|poster('modal') }}."""
+    if not url:
+        return ''
+    return url_for('poster_proxy', variant=variant, url=url)
+
+# --- Поиск торрентов ---
+# Поиск раздачи для фильма-победителя. Запрос уходит параллельно во все
+# провайдеры, у каждого свой таймаут; ответившие вовремя результаты
+# объединяются, ранжируются и кэшируются по нормализованному запросу.
+
+SEARCH_YEAR_RE = re.compile(r'\s*\(?\b((?:19|20)\d{2})\)?\s*$')
+PUBLIC_TRACKERS = (
+    'udp://tracker.opentrackr.org:1337/announce',
+    'udp://open.stealth.si:80/announce',
+    'udp://tracker.torrent.eu.org:451/announce',
+    'udp://exodus.desync.com:6969/announce',
+)
+GIB = 1024 ** 3
+
+
+def _create_search_session():
+    session = requests.Session()
+    retry = Retry(total=1, backoff_factor=0.2, status_forcelist=(502, 503, 504), allowed_methods=('GET',))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def build_magnet(info_hash, name=None, trackers=PUBLIC_TRACKERS):
+    parts = [f"magnet:?xt=urn:btih:{info_hash.lower()}"]
+    if name:
+        parts.append(f"dn={urllib.parse.quote(name)}")
+    parts.extend(f"tr={urllib.parse.quote(tracker, safe='')}" for tracker in trackers)
+    return '&'.join(parts)
+
+
+class TorrentSearchProvider:
+    """
+    Источник результатов поиска. search(query, timeout) возвращает список
+    словарей {title, magnet, seeders, leechers, size}; любое исключение
+    считается отказом провайдера и не мешает остальным.
+    """
+
+    name = 'base'
+
+    def search(self, query, timeout):
+        raise NotImplementedError
+
+
+class ApibayProvider(TorrentSearchProvider):
+    """JSON API apibay.org (The Pirate Bay), категория 200 - видео."""
+
+    name = 'apibay'
+    EMPTY_HASH = '0' * 40
+
+    def __init__(self, base_url, session=None):
+        self.base_url = base_url.rstrip('/')
+        self.session = session or _create_search_session()
+
+    def search(self, query, timeout):
+        response = self.session.get(f"{self.base_url}/q.php", params={'q': query, 'cat': '200'}, timeout=timeout)
+        response.raise_for_status()
+        results = []
+        for item in response.json():
+            info_hash = item.get('info_hash', '')
+            if not info_hash or info_hash == self.EMPTY_HASH:  # заглушка "No results returned"
+                continue
+            results.append({
+                "title": item.get('name', ''), "magnet": build_magnet(info_hash, item.get('name')),
+                "seeders": int(item.get('seeders') or 0), "leechers": int(item.get('leechers') or 0),
+                "size": int(item.get('size') or 0),
+            })
+        return results
+
+
+TORRENT_SEARCH_PROVIDER_FACTORIES = {
+    'apibay': lambda: ApibayProvider(APIBAY_URL),
+}
+
+
+def _normalize_search_text(text):
+    return ' '.join(re.sub(r'[^\w]+', ' ', text.lower().replace('ё', 'е')).split())
+
+
+def _split_search_query(query):
+    """'Название 1980' -> ('название', '1980'); год необязателен."""
+    match = SEARCH_YEAR_RE.search(query)
+    if match:
+        return _normalize_search_text(query[:match.start()]), match.group(1)
+    return _normalize_search_text(query), None
+
+
+def _score_torrent(result, title, year):
+    """
+    Оценка результата: совпадение названия и года важнее всего, затем
+    число сидов (логарифм, чтобы 5000 сидов не перевешивали неверный фильм),
+    затем размер - предпочитаем обычные рипы (1-20 ГиБ), а не сэмплы и ремуксы.
+    """
+    result_text = _normalize_search_text(result.get('title', ''))
+    result_words = set(result_text.split())
+    title_words = title.split()
+    title_match = sum(word in result_words for word in title_words) / len(title_words) if title_words else 0
+    score = 20 * title_match
+    if year:
+        score += 5 if year in result_words else -3
+    score += 2 * math.log10(1 + result.get('seeders', 0))
+    size = result.get('size', 0)
+    if size and size < 0.3 * GIB:
+        score -= 5
+    elif size > 40 * GIB:
+        score -= 2
+    elif 1 * GIB <= size <= 20 * GIB:
+        score += 1
+    return score
+
+
+def rank_torrents(results, query, min_seeders=0):
+    """Убирает дубликаты (по info-hash) и мёртвые раздачи, сортирует по убыванию оценки."""
+    title, year = _split_search_query(query)
+    unique = {}
+    for result in results:
+        if not result.get('magnet') or result.get('seeders', 0) < min_seeders:
+            continue
+        key = result['magnet'].split('&', 1)[0].lower()
+        if key not in unique or result.get('seeders', 0) > unique[key].get('seeders', 0):
+            unique[key] = result
+    scored = [{**result, "score": round(_score_torrent(result, title, year), 3)} for result in unique.values()]
+    return sorted(scored, key=lambda result: (-result['score'], -result.get('seeders', 0)))
+
+
+class TorrentSearch:
+    """
+    Параллельный поиск по провайдерам с общим дедлайном timeout и
+    TTL-кэшем по нормализованному запросу. Кэш - пространство общего кэша
+    (cache) или, если оно не передано, свой LRU на cache_size запросов.
+    Провайдеры можно заменить (например, локальными заглушками в тестах)
+    через атрибут providers.
+    """
+
+    def __init__(self, providers, timeout, cache_ttl, cache_size, min_seeders=0, cache=None):
+        self.providers = providers
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.min_seeders = min_seeders
+        self.cache = cache or Cache(LocalCacheBackend(cache_size)).namespace('torrent_search')
+        self.stats = collections.Counter()
+        self._executor = ThreadPoolExecutor(max_workers=max(len(providers), 4), thread_name_prefix='torrent-search')
+
+    @staticmethod
+    def cache_key(query):
+        return _normalize_search_text(query)
+
+    def search(self, query):
+        key = self.cache_key(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.stats['cache_hits'] += 1
+            return cached
+        self.stats['cache_misses'] += 1
+
+        futures = {self._executor.submit(provider.search, query, self.timeout): provider for provider in self.providers}
+        done, not_done = wait_futures(futures, timeout=self.timeout)
+        results, answered = [], 0
+        for future in done:
+            provider = futures[future]
+            try:
+                results.extend(dict(result, provider=provider.name) for result in future.result())
+                answered += 1
+            except Exception as e:
+                self.stats[f'{provider.name}_errors'] += 1
+                print(f"Ошибка поиска торрентов ({provider.name}): {e}")
+        for future in not_done:
+            future.cancel()
+            self.stats[f'{futures[future].name}_timeouts'] += 1
+            print(f"Провайдер поиска торрентов {futures[future].name} не ответил за {self.timeout} с")
+
+        ranked = rank_torrents(results, query, self.min_seeders)
+        if answered:  # полный отказ всех провайдеров не кэшируем
+            self.cache.set(key, ranked, ttl=self.cache_ttl)
+        return ranked
+
+
+torrent_search = TorrentSearch(
+    [TORRENT_SEARCH_PROVIDER_FACTORIES[name]() for name in TORRENT_SEARCH_PROVIDERS if name in TORRENT_SEARCH_PROVIDER_FACTORIES],
+    TORRENT_SEARCH_TIMEOUT, TORRENT_SEARCH_CACHE_TTL, TORRENT_SEARCH_CACHE_SIZE, TORRENT_SEARCH_MIN_SEEDERS,
+    cache=shared_cache.namespace('torrent_search'),
+)
+
+
+def _search_torrents(query):
+    """Ранжированные результаты поиска раздач (лучший - первый)."""
+    return torrent_search.search(query)
+
+
+# --- Очередь задач qBittorrent ---
+# Изменения в клиенте (добавление и удаление торрентов) выполняются не в
+# HTTP-запросе, а воркерами из таблицы job. Запись задачи коммитится вместе
+# с остальными изменениями запроса (outbox), поэтому задача не теряется,
+# даже если qBittorrent недоступен или процесс перезапустился.
+
+class PermanentJobError(Exception):
+    """Ошибка, после которой повторять задачу бессмысленно."""
+
+
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+@job_handler('torrent_add')
+def _run_torrent_add(payload):
+    try:
+        qbit_request('torrents_add', **payload['options'])
+    except qbittorrent_exceptions.HTTP4XXError as e:
+        raise PermanentJobError(f"qBittorrent отклонил торрент: {e}")
+    return {"message": "Загрузка началась!"}
+
+@job_handler('torrent_delete')
+def _run_torrent_delete(payload):
+    hashes = payload.get('hashes')
+    if category := payload.get('category'):
+        hashes = [t.hash for t in qbit_request('torrents_info', category=category)]
+        if not hashes:
+            return {"message": "Торрент не найден в клиенте.", "deleted": 0}
+    try:
+        qbit_request('torrents_delete', delete_files=True, torrent_hashes=hashes)
+    except qbittorrent_exceptions.NotFound404Error:
+        return {"message": "Торрент уже удалён из клиента.", "deleted": 0}
+    except qbittorrent_exceptions.HTTP4XXError as e:
+        raise PermanentJobError(f"qBittorrent отклонил удаление: {e}")
+    return {"message": "Торрент и файлы удалены с клиента.", "deleted": len(hashes)}
+
+
+def _job_backoff(attempts):
+    return min(JOB_RETRY_BASE * 2 ** (attempts - 1), JOB_RETRY_MAX) * random.uniform(0.8, 1.2)
+
+def _job_to_dict(job):
+    return {
+        "id": job.id, "kind": job.kind, "status": job.status, "attempts": job.attempts,
+        "result": json.loads(job.result) if job.result else None, "error": job.last_error,
+        "run_at": job.run_at.isoformat() + "Z", "updated_at": job.updated_at.isoformat() + "Z",
+    }
+
+def enqueue_job(kind, payload, idempotency_key=None):
+    """
+    Добавляет задачу в текущую транзакцию (commit делает вызывающий код).
+    Задача с тем же ключом идемпотентности или такая же ещё не выполненная
+    задача не дублируется - возвращается уже существующая.
+    """
+    payload_json = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    if idempotency_key:
+        existing = Job.query.filter_by(idempotency_key=idempotency_key).first()
+    else:
+        existing = Job.query.filter(
+            Job.kind == kind, Job.payload == payload_json, Job.status.in_(('pending', 'running')),
+        ).first()
+    if existing:
+        return existing
+    job = Job(kind=kind, payload=payload_json, idempotency_key=idempotency_key, max_attempts=JOB_MAX_ATTEMPTS)
+    db.session.add(job)
+    db.session.flush()
+    return job
+
+
+class JobWorker:
+    """
+    Пул потоков, выполняющих задачи из таблицы job. Задача захватывается
+    условным UPDATE (status='pending' -> 'running'), так что несколько
+    воркеров gunicorn не выполнят её дважды. Зависшие в 'running' дольше
+    lease_timeout задачи (процесс упал) забираются повторно.
+    """
+
+    def __init__(self, workers, poll_interval, lease_timeout):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def is_running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._loop, name=f'job-worker-{index}', daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=5):
+        """Останавливает пул и дожидается потоков: после возврата ни одна задача не пишет в БД."""
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    ran = self.run_pending(limit=1)
+            except SQLAlchemyError as e:
+                print(f"Ошибка очереди задач: {e}")
+                ran = 0
+            if not ran:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _claim(self, job_id=None):
+        now = datetime.utcnow()
+        if job_id is None:
+            stale = now - timedelta(seconds=self.lease_timeout)
+            candidate = db.session.scalar(
+                db.select(Job.id).where(or_(
+                    and_(Job.status == 'pending', Job.run_at <= now),
+                    and_(Job.status == 'running', Job.updated_at < stale),
+                )).order_by(Job.run_at, Job.id).limit(1)
+            )
+            if candidate is None:
+                return None
+            job_id = candidate
+        claimed = db.session.execute(
+            db.update(Job)
+            .where(Job.id == job_id, or_(Job.status == 'pending', and_(
+                Job.status == 'running', Job.updated_at < now - timedelta(seconds=self.lease_timeout),
+            )))
+            .values(status='running', attempts=Job.attempts + 1, updated_at=now)
+        )
+        db.session.commit()
+        return job_id if claimed.rowcount == 1 else False
+
+    def run_pending(self, limit=None):
+        """Выполняет готовые к запуску задачи. Возвращает число выполненных."""
+        ran = 0
+        while limit is None or ran < limit:
+            job_id = self._claim()
+            if job_id is None:
+                break
+            if job_id is False:
+                continue
+            self.execute(job_id)
+            ran += 1
+        return ran
+
+    def run_now(self, job):
+        """Выполняет конкретную задачу сразу, если её ещё никто не взял."""
+        if job.status == 'pending' and self._claim(job.id):
+            self.execute(job.id)
+        db.session.refresh(job)
+        return job
+
+    def execute(self, job_id):
+        job = db.session.get(Job, job_id)
+        handler = JOB_HANDLERS.get(job.kind)
+        try:
+            if handler is None:
+                raise PermanentJobError(f"Неизвестный тип задачи: {job.kind}")
+            result = handler(json.loads(job.payload))
+        except PermanentJobError as e:
+            job.status, job.last_error = 'failed', str(e)
+        except CircuitOpenError as e:
+            # Вызов даже не выполнялся: ждём пробной попытки, не тратя попытку задачи
+            job.status, job.last_error = 'pending', str(e)
+            job.attempts -= 1
+            job.run_at = datetime.utcnow() + timedelta(seconds=max(qbit_breaker.retry_in(), JOB_POLL_INTERVAL))
+        except Exception as e:
+            job.last_error = str(e)
+            if job.attempts >= job.max_attempts:
+                job.status = 'failed'
+            else:
+                job.status = 'pending'
+                job.run_at = datetime.utcnow() + timedelta(seconds=_job_backoff(job.attempts))
+            print(f"Задача {job.id} ({job.kind}), попытка {job.attempts}: {e}")
+        else:
+            job.status, job.result, job.last_error = 'done', json.dumps(result, ensure_ascii=False), None
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+        if job.status in ('done', 'failed'):
+            event_broker.publish('job', _job_to_dict(job))
+        if job.status == 'failed' and job.kind == 'torrent_add':
+            download_scheduler.notify()  # место в очереди загрузок освободилось
+        if job.status == 'done' and job.kind == 'lottery_download':
+            download_scheduler.notify()  # найденная раздача ждёт в очереди загрузок
+
+
+job_worker = JobWorker(JOB_WORKERS, JOB_POLL_INTERVAL, JOB_LEASE_TIMEOUT)
+
+def submit_job(job):
+    """
+    Вызывается после commit: будит воркеры, а в синхронном режиме (тесты,
+    JOBS_EAGER=1) сразу выполняет задачу.
+    """
+    if JOBS_EAGER or app.config.get('TESTING'):
+        return job_worker.run_now(job)
+    job_worker.notify()
+    return job
+
+def _idempotency_key(kind):
+    """Ключ из заголовка Idempotency-Key: повтор того же запроса не создаст вторую задачу."""
+    if key := request.headers.get('Idempotency-Key', '').strip():
+        return f"{kind}:{key[:150]}"
+    return None
+
+def job_response(job, queued_message):
+    """Ответ маршрута: 200 - задача уже выполнена, 202 - в очереди, 502 - не удалась."""
+    body = {"job_id": job.id, "status": job.status}
+    if job.status == 'done':
+        result = json.loads(job.result) if job.result else {}
+        return jsonify({**body, "success": True, "message": result.get('message', queued_message)}), 200
+    if job.status == 'failed':
+        return jsonify({**body, "success": False, "message": f"Ошибка qBittorrent: {job.last_error}"}), 502
+    return jsonify({**body, "success": True, "message": queued_message}), 202
+
+# --- Планировщик загрузок ---
+# Кнопки "Скачать" не добавляют торрент сразу, а ставят загрузку в очередь
+# download_request. В qBittorrent одновременно качается не больше
+# DOWNLOAD_MAX_ACTIVE торрентов, остальные ждут: сначала победители только что
+# проведённых лотерей, затем фильмы из истории, последней - библиотека.
+
+DOWNLOAD_PRIORITY_WINNER = 30
+DOWNLOAD_PRIORITY_LOTTERY = 20
+DOWNLOAD_PRIORITY_LIBRARY = 10
+
+# Ключ pg_advisory_xact_lock, сериализующий захват мест в PostgreSQL
+DOWNLOAD_DISPATCH_LOCK_KEY = 0x6d6c6477  # 'mldw'
+
+
+def _download_add_options(download):
+    options = {
+        "urls": download.magnet_link, "category": download.category,
+        "is_sequential_download": True, "is_first_last_piece_priority": True,
+    }
+    if download.kinopoisk_id:
+        options["tags"] = f"kp-{download.kinopoisk_id}"
+    if DOWNLOAD_RATE_LIMIT_KIB > 0:
+        options["download_limit"] = DOWNLOAD_RATE_LIMIT_KIB * 1024
+    if UPLOAD_RATE_LIMIT_KIB > 0:
+        options["upload_limit"] = UPLOAD_RATE_LIMIT_KIB * 1024
+    return options
+
+
+def _download_to_dict(download, queue_position=None):
+    return {
+        "download_id": download.id, "status": download.status, "category": download.category,
+        "kinopoisk_id": download.kinopoisk_id, "priority": download.priority, "queue_position": queue_position,
+        "created_at": download.created_at.isoformat() + "Z",
+    }
+
+
+class DownloadScheduler:
+    """
+    Очередь загрузок поверх очереди задач. Запуск загрузки - условный
+    UPDATE queued -> active (с проверкой лимита, см. _claim) и задача
+    torrent_add, поэтому несколько воркеров gunicorn не запустят её дважды
+    и не превысят max_active. Место освобождается, когда торрент
+    докачан, удалён из клиента или задача добавления не удалась; тогда
+    запускается следующая по приоритету (и времени постановки) загрузка.
+    Фоновый поток проверяет это раз в interval секунд или сразу, когда
+    синхронизатор сообщает о завершении отслеживаемого торрента.
+    """
+
+    def __init__(self, max_active, interval, missing_grace):
+        self.max_active = max_active
+        self.interval = interval
+        self.missing_grace = missing_grace
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._watched = frozenset()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def torrents_changed(self, changes):
+        """Вызывается синхронизатором снимка: будит планировщик, если активный торрент докачан или удалён."""
+        for torrent, removed in changes:
+            if torrent.get('category') in self._watched and (removed or torrent.get('progress', 0) >= 1):
+                self.notify()
+                return
+
+    def schedule(self, category, magnet_link, kinopoisk_id=None, priority=DOWNLOAD_PRIORITY_LIBRARY, idempotency_key=None):
+        """
+        Ставит загрузку в очередь (commit делает вызывающий код). Если для
+        категории загрузка уже ждёт или идёт, возвращается она же, а её
+        приоритет поднимается до запрошенного. Повтор запроса с тем же
+        ключом идемпотентности возвращает ту же загрузку в любом статусе.
+        """
+        if idempotency_key and (download := DownloadRequest.query.filter_by(idempotency_key=idempotency_key).first()):
+            return download
+        download = DownloadRequest.query.filter(
+            DownloadRequest.category == category, DownloadRequest.status.in_(('queued', 'active')),
+        ).first()
+        if download:
+            download.priority = max(download.priority, priority)
+            return download
+        download = DownloadRequest(
+            category=category, magnet_link=magnet_link, kinopoisk_id=kinopoisk_id, priority=priority,
+            idempotency_key=idempotency_key,
+        )
+        try:
+            with db.session.begin_nested():
+                db.session.add(download)
+        except IntegrityError:
+            # Тот же ключ только что записал параллельный запрос
+            return DownloadRequest.query.filter_by(idempotency_key=idempotency_key).one()
+        return download
+
+    def _queued_query(self):
+        return db.select(DownloadRequest).where(DownloadRequest.status == 'queued').order_by(
+            DownloadRequest.priority.desc(), DownloadRequest.created_at, DownloadRequest.id,
+        )
+
+    def _active_count(self):
+        return db.select(db.func.count()).select_from(DownloadRequest).where(DownloadRequest.status == 'active')
+
+    def _free_slots(self):
+        if self.max_active <= 0:
+            return None
+        return max(0, self.max_active - db.session.scalar(self._active_count()))
+
+    def _claim(self, download):
+        """
+        queued -> active одним UPDATE, который сам проверяет лимит активных
+        загрузок: одновременные dispatch в разных потоках и воркерах не
+        превысят max_active, даже забирая разные строки. SQLite выполняет
+        записи по одной; в PostgreSQL подзапрос видит только уже
+        закоммиченные строки, поэтому захваты сериализуются advisory-блокировкой
+        до конца транзакции.
+        """
+        claim = db.update(DownloadRequest).where(DownloadRequest.id == download.id, DownloadRequest.status == 'queued')
+        if self.max_active > 0:
+            if db.session.get_bind().dialect.name == 'postgresql':
+                db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': DOWNLOAD_DISPATCH_LOCK_KEY})
+            active = self._active_count().scalar_subquery()
+            claim = claim.where(active < self.max_active)
+        result = db.session.execute(claim.values(status='active', started_at=datetime.utcnow()))
+        return result.rowcount == 1
+
+    def _finish(self, download, status, error=None):
+        download.status, download.last_error, download.finished_at = status, error, datetime.utcnow()
+
+    def cancel(self, download, reason="Отменена пользователем."):
+        """
+        Отменяет ожидающую загрузку и коммитит. queued -> cancelled одним
+        условным UPDATE: загрузку, которую в это же время запустил dispatch,
+        отменить уже нельзя (возвращается False). Место в очереди сразу
+        освобождается, подписчики /api/events получают событие download.
+        """
+        result = db.session.execute(
+            db.update(DownloadRequest)
+            .where(DownloadRequest.id == download.id, DownloadRequest.status == 'queued')
+            .values(status='cancelled', last_error=reason, finished_at=datetime.utcnow())
+        )
+        db.session.commit()
+        db.session.refresh(download)
+        if result.rowcount != 1:
+            return False
+        event_broker.publish('download', _download_to_dict(download))
+        self.notify()
+        return True
+
+    def dispatch(self):
+        """Запускает ожидающие загрузки, пока есть свободные места. Возвращает запущенные."""
+        started = []
+        while self._free_slots() != 0:
+            download = db.session.scalar(self._queued_query().limit(1))
+            if download is None:
+                break
+            if not self._claim(download):
+                db.session.rollback()
+                continue
+            job = enqueue_job(
+                'torrent_add', {"options": _download_add_options(download)}, idempotency_key=download.idempotency_key,
+            )
+            download.job_id = job.id
+            db.session.commit()
+            job = submit_job(job)
+            if job.status == 'failed':
+                self._finish(download, 'failed', job.last_error)
+                db.session.commit()
+            started.append(download)
+        self._watched = frozenset(db.session.scalars(
+            db.select(DownloadRequest.category).where(DownloadRequest.status == 'active')
+        ))
+        return started
+
+    def reconcile(self):
+        """Закрывает активные загрузки: докачанные, удалённые из клиента и те, что не удалось добавить."""
+        active = DownloadRequest.query.filter_by(status='active').all()
+        if not active:
+            return 0
+        torrent_sync.ensure_fresh()
+        snapshot_fresh = not _snapshot_is_stale()
+        now = datetime.utcnow()
+        finished = 0
+        for download in active:
+            job = db.session.get(Job, download.job_id) if download.job_id else None
+            torrents = torrent_snapshot.by_category(download.category)
+            if torrents:
+                download.torrent_hash = torrents[0]['hash']
+            if job is not None and job.status == 'failed':
+                self._finish(download, 'failed', job.last_error)
+            elif torrents and all(torrent.get('progress', 0) >= 1 for torrent in torrents):
+                self._finish(download, 'completed')
+            elif (
+                not torrents and snapshot_fresh and job is not None and job.status == 'done'
+                and (now - download.started_at).total_seconds() > self.missing_grace
+            ):
+                self._finish(download, 'cancelled', "Торрент не найден в клиенте.")
+            else:
+                continue
+            finished += 1
+        db.session.commit()
+        return finished
+
+    def tick(self):
+        self.reconcile()
+        return self.dispatch()
+
+    def queued(self):
+        """Ожидающие загрузки по порядку запуска, с местом в очереди (с 1)."""
+        return [
+            _download_to_dict(download, position)
+            for position, download in enumerate(db.session.scalars(self._queued_query()), start=1)
+        ]
+
+    def queue_position(self, download):
+        for item in self.queued():
+            if item["download_id"] == download.id:
+                return item["queue_position"]
+        return None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                with app.app_context():
+                    self.tick()
+            except SQLAlchemyError as e:
+                print(f"Ошибка планировщика загрузок: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='download-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wakeup.set()
+
+
+download_scheduler = DownloadScheduler(DOWNLOAD_MAX_ACTIVE, DOWNLOAD_SCHEDULER_INTERVAL, DOWNLOAD_MISSING_GRACE)
+
+
+def download_response(download):
+    """
+    Ответ маршрута скачивания: если место нашлось - как job_response, иначе
+    202 с местом в очереди.
+    """
+    retention_manager.touch(download.category)
+    download_scheduler.dispatch()
+    if download.status == 'queued':
+        position = download_scheduler.queue_position(download)
+        return jsonify({
+            "success": True, "status": "queued", "download_id": download.id, "queue_position": position,
+            "message": f"Загрузка в очереди, место: {position}.",
+        }), 202
+    if download.job_id is None:
+        # Повтор по ключу идемпотентности загрузки, отменённой в очереди
+        return jsonify({
+            "success": False, "status": download.status, "download_id": download.id, "message": "Загрузка отменена.",
+        }), 409
+    return job_response(db.session.get(Job, download.job_id), "Загрузка поставлена в очередь.")
+
+
+def _queued_downloads():
+    """Очередь для маршрутов статуса: без БД они просто не видят ожидающих загрузок."""
+    try:
+        return download_scheduler.queued()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Не удалось прочитать очередь загрузок: {e}")
+        return []
+
+
+def _queued_status(queued, category=None, kinopoisk_id=None):
+    """Статус ожидающей загрузки для маршрутов статуса или None."""
+    for item in queued:
+        if (category and item["category"] == category) or (kinopoisk_id and item["kinopoisk_id"] == kinopoisk_id):
+            return {"status": "queued", "queue_position": item["queue_position"], "download_id": item["download_id"]}
+    return None
+
+# --- Хранение загрузок ---
+# Чтобы диск сидбокса не переполнялся, фоновый проход раз в RETENTION_INTERVAL
+# считает по снимку торрентов занятое место (по категориям и тегам kp-<id>) и
+# удаляет докачанные торренты lottery-*/library-* вместе с файлами: сначала
+# по возрасту, затем самые давно использованные, пока не уложится в лимиты
+# места. Удаление идёт задачами torrent_delete пачками по RETENTION_BATCH_SIZE.
+
+RETENTION_CATEGORY_PREFIXES = ('lottery-', 'library-')
+RETENTION_TOUCH_INTERVAL = 300
+
+
+def _torrent_disk_bytes(torrent):
+    if 'completed' in torrent:
+        return int(torrent['completed'] or 0)
+    return int((torrent.get('size') or 0) * (torrent.get('progress') or 0))
+
+
+def _utc_from_timestamp(value):
+    """Метка времени qBittorrent (секунды; 0 и -1 - нет значения) как naive UTC."""
+    if not value or value <= 0:
+        return None
+    return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+
+
+def _lease_holder():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(name, duration):
+    """
+    Захватывает аренду службы name на duration секунд. Условный UPDATE
+    срабатывает только в одном воркере, поэтому периодическая служба
+    выполняется раз в duration на все воркеры. Возвращает True, если
+    аренда досталась этому процессу.
+    """
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=duration)
+    if db.session.get(ServiceLease, name) is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(ServiceLease(name=name, holder=_lease_holder(), expires_at=expires_at))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            pass  # строку только что создал другой воркер - пробуем забрать её как обычно
+    claimed = db.session.execute(
+        db.update(ServiceLease)
+        .where(ServiceLease.name == name, ServiceLease.expires_at <= now)
+        .values(holder=_lease_holder(), expires_at=expires_at)
+    )
+    db.session.commit()
+    return claimed.rowcount == 1
+
+
+class RetentionManager:
+    """
+    Политики хранения докачанных торрентов:
+    - max_age: удалить, если с завершения (или последнего просмотра) прошло больше;
+    - max_total_bytes / min_free_bytes: удалять по LRU (последний просмотр,
+      запрос на скачивание или завершение), пока загрузки приложения не
+      уложатся в лимит, а на диске не станет достаточно свободного места;
+    - keep_library: торренты библиотеки не трогать.
+    Недокачанные торренты не удаляются никогда. Фоновый поток есть в каждом
+    воркере, но проход выполняет только получивший аренду 'retention' на
+    interval секунд; отчёт последнего прохода хранится в её строке.
+    """
+
+    lease_name = 'retention'
+
+    def __init__(self, max_total_bytes, min_free_bytes, max_age, keep_library, interval, batch_size):
+        self.max_total_bytes = max_total_bytes
+        self.min_free_bytes = min_free_bytes
+        self.max_age = max_age
+        self.keep_library = keep_library
+        self.interval = interval
+        self.batch_size = batch_size
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.max_total_bytes or self.min_free_bytes or self.max_age)
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def policies(self):
+        return {
+            "max_total_bytes": self.max_total_bytes or None,
+            "min_free_bytes": self.min_free_bytes or None,
+            "max_age_days": self.max_age.total_seconds() / 86400 if self.max_age else None,
+            "keep_library": self.keep_library,
+        }
+
+    def touch(self, category):
+        """Отмечает просмотр загрузки категории; в БД пишет не чаще раза в RETENTION_TOUCH_INTERVAL."""
+        if not category:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._touched.get(category, -RETENTION_TOUCH_INTERVAL) < RETENTION_TOUCH_INTERVAL:
+                return
+            self._touched[category] = now
+        try:
+            access = db.session.get(TorrentAccess, category)
+            if access is None:
+                db.session.add(TorrentAccess(category=category))
+            else:
+                access.last_access = datetime.utcnow()
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"Не удалось отметить доступ к загрузке {category}: {e}")
+
+    def usage(self, torrents):
+        """Занятое место по категориям и по kinopoisk_id."""
+        categories, kinopoisk = collections.Counter(), collections.Counter()
+        managed = 0
+        for torrent in torrents:
+            size = _torrent_disk_bytes(torrent)
+            category = torrent.get('category') or ''
+            categories[category] += size
+            if category.startswith(RETENTION_CATEGORY_PREFIXES):
+                managed += size
+            if kp_id := _extract_kinopoisk_id(torrent.get('tags')):
+                kinopoisk[str(kp_id)] += size
+        return {
+            "total_bytes": sum(categories.values()), "managed_bytes": managed,
+            "free_space_on_disk": torrent_snapshot.server_state.get('free_space_on_disk'),
+            "categories": dict(categories), "kinopoisk": dict(kinopoisk),
+        }
+
+    def plan(self, torrents, now=None):
+        """Пары (торрент, причина) к удалению по текущим политикам; сам ничего не удаляет."""
+        now = now or datetime.utcnow()
+        managed = [t for t in torrents if (t.get('category') or '').startswith(RETENTION_CATEGORY_PREFIXES)]
+        candidates = [
+            t for t in managed
+            if t.get('progress', 0) >= 1 and not (self.keep_library and t['category'].startswith('library-'))
+        ]
+        if not candidates:
+            return []
+        access = dict(db.session.execute(
+            db.select(TorrentAccess.category, TorrentAccess.last_access)
+            .where(TorrentAccess.category.in_({t['category'] for t in candidates}))
+        ).all())
+
+        def last_used(torrent):
+            times = [
+                value for value in (_utc_from_timestamp(torrent.get('completion_on')), access.get(torrent['category']))
+                if value
+            ]
+            return max(times) if times else (_utc_from_timestamp(torrent.get('added_on')) or datetime.min)
+
+        candidates.sort(key=last_used)
+        selected = []
+        if self.max_age:
+            selected = [(t, 'age') for t in candidates if now - last_used(t) > self.max_age]
+
+        need = 0
+        if self.max_total_bytes:
+            need = sum(_torrent_disk_bytes(t) for t in managed) - self.max_total_bytes
+        free = torrent_snapshot.server_state.get('free_space_on_disk')
+        if self.min_free_bytes and free is not None:
+            need = max(need, self.min_free_bytes - free)
+        need -= sum(_torrent_disk_bytes(t) for t, _ in selected)
+        chosen = {t['hash'] for t, _ in selected}
+        for torrent in candidates:
+            if need <= 0:
+                break
+            if torrent['hash'] not in chosen:
+                selected.append((torrent, 'disk_space'))
+                need -= _torrent_disk_bytes(torrent)
+        return selected
+
+    def run(self, dry_run=False):
+        """Один проход очистки. Возвращает отчёт; без dry_run он же сохраняется в last_report."""
+        torrent_sync.ensure_fresh()
+        report = {
+            "generated_at": datetime.utcnow().isoformat() + "Z", "dry_run": dry_run,
+            "policies": self.policies(), "deleted": [], "freed_bytes": 0, "jobs": [],
+        }
+        if _snapshot_is_stale():
+            report["skipped"] = "Снимок торрентов устарел: qBittorrent недоступен."
+        else:
+            torrents = torrent_snapshot.all()
+            report["usage"] = self.usage(torrents)
+            for torrent, reason in (self.plan(torrents) if self.enabled else []):
+                report["deleted"].append({
+                    "hash": torrent['hash'], "name": torrent.get('name'), "category": torrent.get('category'),
+                    "kinopoisk_id": _extract_kinopoisk_id(torrent.get('tags')),
+                    "bytes": _torrent_disk_bytes(torrent), "reason": reason,
+                })
+            report["freed_bytes"] = sum(item["bytes"] for item in report["deleted"])
+
+        if dry_run:
+            return report
+        hashes = [item["hash"] for item in report["deleted"]]
+        for start in range(0, len(hashes), self.batch_size):
+            job = enqueue_job('torrent_delete', {"hashes": hashes[start:start + self.batch_size]})
+            db.session.commit()
+            report["jobs"].append(submit_job(job).id)
+        for item in report["deleted"]:
+            RETENTION_DELETED.inc(reason=item["reason"])
+            RETENTION_FREED.inc(item["bytes"], reason=item["reason"])
+        if hashes:
+            print(f"Очистка диска: удаляется торрентов - {len(hashes)}, освобождается {report['freed_bytes'] / GIB:.1f} ГБ.")
+        self._save_report(report)
+        return report
+
+    def _save_report(self, report):
+        lease = db.session.get(ServiceLease, self.lease_name)
+        if lease is None:
+            lease = ServiceLease(name=self.lease_name, expires_at=datetime.utcnow())
+            db.session.add(lease)
+        lease.state = json.dumps(report, ensure_ascii=False)
+        try:
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"Не удалось сохранить отчёт очистки диска: {e}")
+
+    def last_report(self):
+        """Отчёт последнего прохода (в любом воркере) или None."""
+        lease = db.session.get(ServiceLease, self.lease_name)
+        return json.loads(lease.state) if lease is not None and lease.state else None
+
+    def run_scheduled(self):
+        """Проход по расписанию: None, если в этом интервале его уже выполняет другой воркер."""
+        if not acquire_lease(self.lease_name, self.interval):
+            return None
+        return self.run()
+
+    def _run(self):
+        # Будимся чаще interval: аренду заберёт первый проснувшийся воркер, и
+        # проходы не расходятся почти на два интервала из-за разных фаз потоков
+        poll_interval = min(self.interval, 60)
+        while not self._stop_event.is_set():
+            try:
+                with app.app_context():
+                    self.run_scheduled()
+            except SQLAlchemyError as e:
+                print(f"Ошибка очистки диска: {e}")
+            self._stop_event.wait(poll_interval)
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+retention_manager = RetentionManager(
+    max_total_bytes=int(RETENTION_MAX_TOTAL_GB * GIB), min_free_bytes=int(RETENTION_MIN_FREE_GB * GIB),
+    max_age=timedelta(days=RETENTION_MAX_AGE_DAYS) if RETENTION_MAX_AGE_DAYS else None,
+    keep_library=RETENTION_KEEP_LIBRARY, interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH_SIZE,
+)
+
+# --- Вспомогательные функции ---
+
+def get_active_torrents_map():
+    """
+    Возвращает словарь из снимка торрентов, где ключ - kinopoisk_id
+    (из тега), а значение - хеш торрента. Если qBittorrent недоступен,
+    отдаются последние известные данные.
+    """
+    torrent_sync.ensure_fresh()
+    return torrent_snapshot.kinopoisk_map()
+
+
+def _request_kinopoisk(url, params):
+    """Один запрос к API Кинопоиска. Возвращает JSON или None, если API ответил 404."""
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        data = _kinopoisk_get(url, params)
+        if data is None:
+            outcome = 'not_found'
+        return data
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        KINOPOISK_LATENCY.observe(time.perf_counter() - started)
+        KINOPOISK_REQUESTS.inc(outcome=outcome)
+
+def _kinopoisk_get(url, params):
+    headers = {"X-API-KEY": os.environ.get('KINOPOISK_API_TOKEN')}
+    response = kinopoisk_session.get(
+        url, headers=headers, params=params,
+        timeout=(KINOPOISK_CONNECT_TIMEOUT, KINOPOISK_READ_TIMEOUT),
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+def _fetch_kinopoisk_movie(cache_key, query):
+    """
+    Запрашивает у API один фильм. Не трогает БД, поэтому её можно вызывать
+    из потоков пула. Возвращает (ok, movie): ok=False - ошибка API,
+    movie=None - фильм не найден.
+    """
+    if cache_key.startswith('id:'):
+        url, params = f"{KINOPOISK_API_URL}/movie/{cache_key[3:]}", {}
+    else:
+        url, params = f"{KINOPOISK_API_URL}/movie/search", {'query': query, 'limit': 1}
+    try:
+        data = _request_kinopoisk(url, params)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        kinopoisk_cache.stats['api_errors'] += 1
+        print(f"Ошибка при запросе к API Кинопоиска: {e}")
+        return False, None
+
+    if not data: return True, None
+    if 'docs' in data and data['docs']: movie_data = data['docs'][0]
+    elif 'id' in data: movie_data = data
+    else: return True, None
+    return True, _parse_kinopoisk_movie(movie_data)
+
+def _fetch_kinopoisk_movies_by_ids(movie_ids):
+    """
+    Получает несколько фильмов одним запросом /movie?id=..&id=..
+    Возвращает словарь {id: movie} или None, если запрос не удался.
+    """
+    params = [('id', movie_id) for movie_id in movie_ids] + [('limit', len(movie_ids))]
+    try:
+        data = _request_kinopoisk(f"{KINOPOISK_API_URL}/movie", params) or {}
+    except (requests.exceptions.RequestException, ValueError) as e:
+        kinopoisk_cache.stats['api_errors'] += 1
+        print(f"Ошибка при пакетном запросе к API Кинопоиска: {e}")
+        return None
+    movies = {}
+    for movie_data in data.get('docs') or []:
+        movie = _parse_kinopoisk_movie(movie_data)
+        if movie.get('kinopoisk_id'):
+            movies[movie['kinopoisk_id']] = movie
+    return movies
+
+def _lookup_cached_movie(cache_key):
+    """Ищет фильм в кэше, а для ссылок - ещё и среди сохранённых фильмов."""
+    found, cached = kinopoisk_cache.get(cache_key)
+    if found:
+        if cached is None:
+            kinopoisk_cache.stats['negative_hits'] += 1
+        return True, cached
+    if cache_key.startswith('id:'):
+        stored = _find_stored_movie_data(int(cache_key[3:]))
+        if stored:
+            kinopoisk_cache.stats['warm_hits'] += 1
+            kinopoisk_cache.set(cache_key, stored)
+            return True, stored
+    return False, None
+
+def _store_kinopoisk_result(cache_key, movie):
+    kinopoisk_cache.set(cache_key, movie)
+    if movie and movie.get('kinopoisk_id') and cache_key != f"id:{movie['kinopoisk_id']}":
+        kinopoisk_cache.set(f"id:{movie['kinopoisk_id']}", movie)
+
+def get_movie_data_from_kinopoisk(query):
+    """
+    Ищет фильм по названию или ссылке на Кинопоиск. Сначала смотрит в кэш
+    (память, затем БД), для ссылок - в уже сохранённые фильмы, и только
+    потом обращается к API через общую сессию с пулом соединений.
+    """
+    cache_key = _kinopoisk_cache_key(query)
+    found, movie = _lookup_cached_movie(cache_key)
+    if found:
+        return movie
+    ok, movie = _fetch_kinopoisk_movie(cache_key, query)
+    if ok:
+        _store_kinopoisk_result(cache_key, movie)
+    return movie
+
+def get_movies_data_from_kinopoisk(queries):
+    """
+    Пакетный вариант get_movie_data_from_kinopoisk. Одинаковые запросы
+    выполняются один раз, ссылки на Кинопоиск забираются одним запросом
+    по списку id, названия ищутся параллельно в ограниченном пуле потоков.
+    Возвращает список пар (ok, movie) в порядке исходных запросов.
+    """
+    keys = [_kinopoisk_cache_key(query) for query in queries]
+    resolved, pending = {}, {}
+    for query, cache_key in zip(queries, keys):
+        if cache_key in resolved or cache_key in pending: continue
+        found, movie = _lookup_cached_movie(cache_key)
+        if found: resolved[cache_key] = (True, movie)
+        else: pending[cache_key] = query
+
+    fetched = {}
+    id_keys = [cache_key for cache_key in pending if cache_key.startswith('id:')]
+    if len(id_keys) > 1:
+        movies = _fetch_kinopoisk_movies_by_ids([int(cache_key[3:]) for cache_key in id_keys])
+        if movies is not None:
+            for cache_key in id_keys:
+                fetched[cache_key] = (True, movies.get(int(cache_key[3:])))
+                del pending[cache_key]
+
+    futures = {
+        cache_key: kinopoisk_executor.submit(_fetch_kinopoisk_movie, cache_key, query)
+        for cache_key, query in pending.items()
+    }
+    for cache_key, future in futures.items():
+        fetched[cache_key] = future.result()
+
+    # Запись в кэш идёт в потоке запроса: сессия БД к потокам пула не привязана.
+    for cache_key, (ok, movie) in fetched.items():
+        if ok:
+            _store_kinopoisk_result(cache_key, movie)
+    resolved.update(fetched)
+    return [resolved[cache_key] for cache_key in keys]
+
+def get_movie_identifiers(kinopoisk_ids):
+    """Загружает magnet-ссылки для набора фильмов одним запросом IN (...)."""
+    ids = {kp_id for kp_id in kinopoisk_ids if kp_id}
+    if not ids:
+        return {}
+    rows = MovieIdentifier.query.filter(MovieIdentifier.kinopoisk_id.in_(ids)).all()
+    return {row.kinopoisk_id: row for row in rows}
+
+def allocate_lottery_ids(count, length=6):
+    """
+    Подбирает count свободных id лотерей. Кандидаты генерируются пачкой с
+    запасом и проверяются одним запросом IN (...), а не по одному.
+    """
+    alphabet = string.ascii_lowercase + string.digits
+    allocated = []
+    while len(allocated) < count:
+        need = count - len(allocated)
+        # Порядок генерации сохраняется: сортировка смещала бы id к начинающимся с цифры
+        candidates = list(dict.fromkeys(''.join(random.choices(alphabet, k=length)) for _ in range(need * 2)))
+        # Чисто цифровой id перехватил бы маршрут /api/start-download/<int:kinopoisk_id>
+        candidates = [candidate for candidate in candidates if not candidate.isdigit() and candidate not in allocated]
+        taken = set(db.session.scalars(db.select(Lottery.id).where(Lottery.id.in_(candidates))))
+        allocated.extend([candidate for candidate in candidates if candidate not in taken][:need])
+    return allocated
+
+def generate_unique_id(length=6):
+    return allocate_lottery_ids(1, length)[0]
+
+def create_lotteries(movie_lists, attempts=3):
+    """
+    Создаёт лотереи (по одной на каждый список фильмов) одной транзакцией:
+    пакетная выдача id и по одной пакетной вставке лотерей и фильмов.
+    Если параллельный запрос успел занять тот же id (или добавить тот же
+    постер в коллаж), транзакция повторяется с новыми id; прочие нарушения
+    ограничений пробрасываются сразу. Возвращает список id в порядке movie_lists.
+    """
+    for attempt in range(attempts):
+        lottery_ids = allocate_lottery_ids(len(movie_lists))
+        now = datetime.utcnow()
+        movie_rows = [
+            {
+                "lottery_id": lottery_id, "kinopoisk_id": movie_data.get('kinopoisk_id'), "name": movie_data['name'],
+                "poster": movie_data.get('poster'), "year": movie_data.get('year'),
+                "description": movie_data.get('description'), "rating_kp": movie_data.get('rating_kp'),
+                "genres": movie_data.get('genres'), "countries": movie_data.get('countries'),
+            }
+            for lottery_id, movies in zip(lottery_ids, movie_lists) for movie_data in movies
+        ]
+        try:
+            db.session.execute(db.insert(Lottery), [{"id": lottery_id, "created_at": now} for lottery_id in lottery_ids])
+            db.session.execute(db.insert(Movie), movie_rows)
+            added_photos = add_background_photos(row['poster'] for row in movie_rows)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if attempt == attempts - 1 or not _is_concurrent_create_conflict(e, lottery_ids):
+                raise
+            continue
+        if added_photos:
+            background_collage.invalidate()
+        return lottery_ids
+
+def _is_concurrent_create_conflict(error, lottery_ids):
+    """Гонка с параллельным созданием: один из id уже занят или тот же постер только что попал в коллаж."""
+    if BackgroundPhoto.__tablename__ in (error.statement or ''):
+        return True
+    return db.session.scalar(
+        db.select(db.func.count()).select_from(Lottery).where(Lottery.id.in_(lottery_ids))
+    ) > 0
+
+def _validate_movie_list(movies):
+    if not isinstance(movies, list) or len(movies) < 2:
+        return "Нужно добавить хотя бы два фильма"
+    if not all(isinstance(movie, dict) and movie.get('name') for movie in movies):
+        return "У каждого фильма должно быть название"
+    if not all(movie.get('year') not in (None, '') for movie in movies):
+        return "У каждого фильма должен быть указан год"
+    return None
+
+def add_background_photos(poster_urls):
+    """
+    Добавляет в коллаж новые постеры: одна проверка существующих через
+    IN (...), один запрос max(z_index) и одна пакетная вставка.
+    Вызывающий код сам делает commit и background_collage.invalidate().
+    Возвращает число добавленных постеров.
+    """
+    urls = list(dict.fromkeys(url for url in poster_urls if url))
+    if not urls:
+        return 0
+    existing = set(db.session.scalars(
+        db.select(BackgroundPhoto.poster_url).where(BackgroundPhoto.poster_url.in_(urls))
+    ))
+    new_urls = [url for url in urls if url not in existing]
+    if not new_urls:
+        return 0
+
+    max_z_index = db.session.query(db.func.max(BackgroundPhoto.z_index)).scalar() or 0
+    now = datetime.utcnow()
+    db.session.execute(db.insert(BackgroundPhoto), [
+        {
+            "poster_url": url, "pos_top": random.uniform(5, 65),
+            "pos_left": random.uniform(5, 75), "rotation": random.randint(-30, 30),
+            "z_index": max_z_index + offset, "added_at": now,
+        } for offset, url in enumerate(new_urls, start=1)
+    ])
+    return len(new_urls)
+
+# --- Постраничная выдача ---
+
+def _encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor, cast=str):
+    """Разбирает курсор в пару (timestamp, id). При ошибке бросает ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, row_id = raw.split('|', 1)
+        return datetime.fromisoformat(timestamp), cast(row_id)
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(f"Некорректный курсор: {e}")
+
+def _keyset_page(query, timestamp_column, id_column, cursor, limit, cast=str):
+    """
+    Возвращает (rows, next_cursor) - одну страницу по убыванию (timestamp, id).
+    Вместо OFFSET страница отсчитывается от последней показанной строки,
+    поэтому её стоимость не зависит от того, насколько далеко пролистали.
+    """
+    if cursor:
+        timestamp, row_id = _decode_cursor(cursor, cast)
+        query = query.filter(or_(
+            timestamp_column < timestamp,
+            and_(timestamp_column == timestamp, id_column < row_id),
+        ))
+    rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, _encode_cursor(getattr(last, timestamp_column.key), getattr(last, id_column.key))
+
+def _page_limit(default):
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def _movie_payload(movie, identifiers, active_torrents):
+    """Данные фильма (из лотереи или библиотеки) в том виде, в каком их ждёт фронтенд."""
+    identifier = identifiers.get(movie.kinopoisk_id)
+    is_on_client = movie.kinopoisk_id in active_torrents if movie.kinopoisk_id else False
+    return {
+        "kinopoisk_id": movie.kinopoisk_id, "name": movie.name, "poster": movie.poster, "year": movie.year,
+        "description": movie.description, "rating_kp": movie.rating_kp, "genres": movie.genres, "countries": movie.countries,
+        "has_magnet": bool(identifier), "magnet_link": identifier.magnet_link if identifier else None,
+        "is_on_client": is_on_client, "torrent_hash": active_torrents.get(movie.kinopoisk_id) if is_on_client else None
+    }
+
+def load_history_page(cursor=None, limit=None):
+    """
+    Загружает страницу истории за постоянное число запросов: лотереи
+    вместе с победителем (JOIN) и magnet-ссылки победителей одним IN (...).
+    Проигравшие фильмы не загружаются.
+    Возвращает (lotteries, winners, identifiers, active_torrents, next_cursor).
+    """
+    lotteries, next_cursor = _keyset_page(
+        Lottery.query.options(joinedload(Lottery.winner)),
+        Lottery.created_at, Lottery.id, cursor, limit or HISTORY_PAGE_SIZE,
+    )
+    active_torrents = get_active_torrents_map()
+    winners = {}
+
+    for lottery in lotteries:
+        if winner_movie := lottery.winner:
+            winners[lottery.id] = winner_movie
+            if kp_id := winner_movie.kinopoisk_id:
+                # Добавляем новые атрибуты прямо в объект фильма
+                winner_movie.is_on_client = kp_id in active_torrents
+                winner_movie.torrent_hash = active_torrents.get(kp_id)
+
+    identifiers = get_movie_identifiers(m.kinopoisk_id for m in winners.values())
+    return lotteries, winners, identifiers, active_torrents, next_cursor
+
+def load_library_page(cursor=None, limit=None):
+    """Страница библиотеки с magnet-ссылками и статусом на клиенте. Возвращает (movies, next_cursor)."""
+    library_movies, next_cursor = _keyset_page(
+        LibraryMovie.query, LibraryMovie.added_at, LibraryMovie.id, cursor, limit or LIBRARY_PAGE_SIZE, cast=int,
+    )
+    active_torrents = get_active_torrents_map()
+    identifiers = get_movie_identifiers(movie.kinopoisk_id for movie in library_movies)
+
+    for movie in library_movies:
+        identifier = identifiers.get(movie.kinopoisk_id)
+        movie.has_magnet = bool(identifier)
+        movie.magnet_link = identifier.magnet_link if identifier else ''
+        # Добавляем новые атрибуты
+        movie.is_on_client = movie.kinopoisk_id in active_torrents if movie.kinopoisk_id else False
+        movie.torrent_hash = active_torrents.get(movie.kinopoisk_id) if movie.kinopoisk_id else None
+
+    return library_movies, next_cursor
+
+# --- Условные запросы (ETag) ---
+# ETag строится из версий данных, от которых зависит ответ, и проверяется
+# до сборки ответа: повторный опрос без изменений стоит пары лёгких
+# запросов к БД, а не загрузки и сериализации всей лотереи или страницы.
+
+def _build_fingerprint():
+    """Отпечаток кода и шаблонов: после обновления приложения старые ETag страниц недействительны."""
+    paths = [os.path.abspath(__file__)]
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    for root, _, names in os.walk(template_dir):
+        paths.extend(os.path.join(root, name) for name in names)
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f"{os.path.relpath(path, app.root_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:12]
+
+
+APP_FINGERPRINT = _build_fingerprint()
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr((APP_FINGERPRINT,) + parts).encode()).hexdigest()[:24]
+
+
+def _collection_version(updated_column):
+    """(число строк, время последнего изменения) таблицы одним агрегатным запросом."""
+    count, last_modified = db.session.execute(
+        db.select(db.func.count(), db.func.max(updated_column)).select_from(updated_column.table)
+    ).one()
+    return count, last_modified
+
+
+def lotteries_version():
+    return _collection_version(Lottery.updated_at)
+
+def library_version():
+    return _collection_version(LibraryMovie.added_at)
+
+def identifiers_version():
+    return _collection_version(MovieIdentifier.updated_at)
+
+
+page_cache = shared_cache.namespace('pages', ttl=CACHE_PAGE_TTL)
+
+
+def _cached_build(etag, build):
+    """
+    Собранный ответ из общего кэша по ETag: ETag уже описывает все данные
+    ответа, так что первый воркер собирает страницу, а остальные отдают
+    готовую. Хост входит в ключ из-за абсолютных ссылок (_external=True).
+    """
+    key = f"{request.host_url}|{etag}"
+    cached = page_cache.get(key)
+    if cached is not None:
+        return Response(cached['body'], mimetype=cached['mimetype'])
+    response = make_response(build())
+    if response.status_code == 200 and not response.is_streamed:
+        page_cache.set(key, {"body": response.get_data(as_text=True), "mimetype": response.mimetype})
+    return response
+
+
+def conditional_response(etag, last_modified, build):
+    """
+    Отвечает 304, если у клиента актуальная версия (If-None-Match, а без
+    него If-Modified-Since). Иначе отдаёт ответ build() (через общий кэш)
+    с ETag и Last-Modified. Cache-Control: no-cache - браузер всегда
+    перепроверяет.
+    """
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = bool(
+            last_modified and request.if_modified_since
+            and last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+        )
+    response = Response(status=304) if fresh else _cached_build(etag, build)
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.cache_control.no_cache = True
+    return response
 
-def ensure_background_photo(poster_url):
-    if not poster_url or BackgroundPhoto.query.filter_by(poster_url=poster_url).first():
+
+def _latest(*timestamps):
+    return max((ts for ts in timestamps if ts is not None), default=None)
+
+
+# --- Фоновые службы ---
+
+_background_services_started = False
+
+
+@app.before_request
+def start_background_services():
+    """Запускает фоновые потоки при первом запросе в каждом воркере."""
+    global _background_services_started
+    if _background_services_started or app.config.get('TESTING'):
         return
-    max_z_index = db.session.query(db.func.max(BackgroundPhoto.z_index)).scalar() or 0
-    new_photo = BackgroundPhoto(
-        poster_url=poster_url, pos_top=random.uniform(5, 65),
-        pos_left=random.uniform(5, 75), rotation=random.randint(-30, 30),
-        z_index=max_z_index + 1,
-    )
-    db.session.add(new_photo)
+    _background_services_started = True
+    if AUTO_MIGRATE:
+        try:
+            run_migrations()
+        except SQLAlchemyError as e:
+            print(f"Не удалось применить миграции схемы: {e}")
+    if TORRENT_SYNC_ENABLED:
+        torrent_sync.start()
+    if not JOBS_EAGER:
+        job_worker.start()
+    download_scheduler.start()
+    if retention_manager.enabled:
+        retention_manager.start()
+
 
 # --- Маршруты ---
 @app.route('/')
 def index():
-    return render_template('index.html', background_photos=get_background_photos())
+    return render_template('index.html')
 
 @app.route('/fetch-movie', methods=['POST'])
 def get_movie_info():
@@ -190,81 +3369,155 @@ def get_movie_info():
     if movie_data: return jsonify(movie_data)
     else: return jsonify({"error": "Фильм не найден"}), 404
 
+@app.route('/fetch-movie/batch', methods=['POST'])
+def get_movies_info():
+    payload = request.get_json(silent=True) or {}
+    queries = [str(q).strip() for q in payload.get('queries') or [] if str(q).strip()]
+    if not queries: return jsonify({"error": "Пустой запрос"}), 400
+    if len(queries) > KINOPOISK_BATCH_MAX_QUERIES:
+        return jsonify({"error": f"Слишком много фильмов за раз (максимум {KINOPOISK_BATCH_MAX_QUERIES})"}), 400
+    results = []
+    for query, (ok, movie) in zip(queries, get_movies_data_from_kinopoisk(queries)):
+        if movie: results.append({"query": query, "movie": movie})
+        elif ok: results.append({"query": query, "error": "Фильм не найден"})
+        else: results.append({"query": query, "error": "Кинопоиск не ответил, попробуйте позже"})
+    return jsonify({"results": results})
+
+@app.route('/poster/<variant>')
+def poster_proxy(variant):
+    url = request.args.get('url', '')
+    if variant != 'original' and variant not in POSTER_VARIANTS:
+        return jsonify({"error": "Неизвестный размер постера"}), 404
+    if not url.startswith(('http://', 'https://')):
+        return jsonify({"error": "Некорректный адрес постера"}), 400
+    if not POSTER_PROXY_ENABLED:
+        # Перенаправляем только на известные постеры, иначе это открытый редирект
+        if not _is_known_poster(url):
+            return jsonify({"error": "Постер не найден"}), 404
+        return redirect(url)
+
+    cached = poster_cache.lookup(url, variant)
+    if cached is None:
+        if not _is_known_poster(url):
+            return jsonify({"error": "Постер не найден"}), 404
+        try:
+            cached = poster_cache.fetch(url, variant)
+        except (requests.exceptions.RequestException, ValueError, OSError) as e:
+            print(f"Не удалось закэшировать постер {url}: {e}")
+            cached = None
+        if cached is None:
+            # Картинка всё равно должна показаться - пусть браузер сходит за ней сам
+            return redirect(url)
+
+    digest, mimetype, path = cached
+    response = send_file(path, mimetype=mimetype, etag=digest, max_age=POSTER_BROWSER_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/background-photos')
+def get_background_photos_api():
+    photos, etag = background_collage.get()
+    response = jsonify({"photos": photos})
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = int(BACKGROUND_CACHE_TTL)
+    return response.make_conditional(request)
+
+@app.route('/api/kinopoisk/cache-stats')
+def get_kinopoisk_cache_stats():
+    return jsonify(kinopoisk_cache.snapshot_stats())
+
 @app.route('/create', methods=['POST'])
 def create_lottery():
     movies_json = request.json.get('movies')
-    if not movies_json or len(movies_json) < 2:
-        return jsonify({"error": "Нужно добавить хотя бы два фильма"}), 400
-    
-    new_lottery = Lottery(id=generate_unique_id())
-    db.session.add(new_lottery)
-
-    for movie_data in movies_json:
-        new_movie = Movie(
-            kinopoisk_id=movie_data.get('kinopoisk_id'), name=movie_data['name'],
-            poster=movie_data.get('poster'), year=movie_data.get('year'),
-            description=movie_data.get('description'), rating_kp=movie_data.get('rating_kp'),
-            genres=movie_data.get('genres'), countries=movie_data.get('countries'), lottery=new_lottery
-        )
-        db.session.add(new_movie)
-        if poster := movie_data.get('poster'):
-            ensure_background_photo(poster)
+    if error := _validate_movie_list(movies_json):
+        return jsonify({"error": error}), 400
 
-    db.session.commit()
-    return jsonify({"wait_url": url_for('wait_for_result', lottery_id=new_lottery.id)})
+    lottery_id, = create_lotteries([movies_json])
+    return jsonify({"wait_url": url_for('wait_for_result', lottery_id=lottery_id)})
+
+@app.route('/create/batch', methods=['POST'])
+def create_lotteries_batch():
+    lotteries_json = (request.get_json(silent=True) or {}).get('lotteries')
+    if not isinstance(lotteries_json, list) or not lotteries_json:
+        return jsonify({"error": "Список лотерей пуст"}), 400
+    if len(lotteries_json) > BULK_LOTTERY_MAX:
+        return jsonify({"error": f"За один раз можно создать не больше {BULK_LOTTERY_MAX} лотерей"}), 400
+
+    movie_lists = []
+    for index, lottery_json in enumerate(lotteries_json):
+        movies = lottery_json.get('movies') if isinstance(lottery_json, dict) else None
+        if error := _validate_movie_list(movies):
+            return jsonify({"error": f"Лотерея №{index + 1}: {error}"}), 400
+        movie_lists.append(movies)
+
+    lottery_ids = create_lotteries(movie_lists)
+    return jsonify({"lotteries": [
+        {
+            "id": lottery_id,
+            "wait_url": url_for('wait_for_result', lottery_id=lottery_id),
+            "play_url": url_for('play_lottery', lottery_id=lottery_id, _external=True),
+        } for lottery_id in lottery_ids
+    ]})
 
 @app.route('/wait/<lottery_id>')
 def wait_for_result(lottery_id):
     Lottery.query.get_or_404(lottery_id)
-    return render_template('wait.html', lottery_id=lottery_id, play_url=url_for('play_lottery', lottery_id=lottery_id, _external=True), background_photos=get_background_photos())
+    return render_template('wait.html', lottery_id=lottery_id, play_url=url_for('play_lottery', lottery_id=lottery_id, _external=True))
 
 @app.route('/history')
 def history():
-    lotteries = Lottery.query.order_by(Lottery.created_at.desc()).all()
-    active_torrents = get_active_torrents_map()
-    identifiers = {}
-    
-    for lottery in lotteries:
-        if winner_movie := next((m for m in lottery.movies if m.name == lottery.result_name), None):
-            if kp_id := winner_movie.kinopoisk_id:
-                if kp_id not in identifiers:
-                    identifiers[kp_id] = MovieIdentifier.query.get(kp_id)
-                # Добавляем новые атрибуты прямо в объект фильма
-                winner_movie.is_on_client = kp_id in active_torrents
-                winner_movie.torrent_hash = active_torrents.get(kp_id)
-
-    return render_template(
-        'history.html',
-        lotteries=lotteries,
-        identifiers=identifiers,
-        background_photos=get_background_photos()
+    lotteries_count, lotteries_updated = lotteries_version()
+    identifiers_count, identifiers_updated = identifiers_version()
+    get_active_torrents_map()  # освежает снимок перед расчётом ETag
+    etag = make_etag(
+        'history', lotteries_count, lotteries_updated, identifiers_count, identifiers_updated,
+        torrent_snapshot.kinopoisk_digest(),
     )
 
+    def build():
+        lotteries, _, identifiers, _, next_cursor = load_history_page()
+        return render_template(
+            'history.html',
+            lotteries=lotteries,
+            identifiers=identifiers,
+            next_cursor=next_cursor,
+        )
+    # Без Last-Modified: удаление строки не меняет max(updated_at), и клиент
+    # с одним If-Modified-Since получил бы 304 с удалённой записью
+    return conditional_response(etag, None, build)
+
 @app.route('/library')
 def library():
-    library_movies = LibraryMovie.query.order_by(LibraryMovie.added_at.desc()).all()
-    active_torrents = get_active_torrents_map()
-    
-    for movie in library_movies:
-        identifier = MovieIdentifier.query.get(movie.kinopoisk_id) if movie.kinopoisk_id else None
-        movie.has_magnet = bool(identifier)
-        movie.magnet_link = identifier.magnet_link if identifier else ''
-        # Добавляем новые атрибуты
-        movie.is_on_client = movie.kinopoisk_id in active_torrents if movie.kinopoisk_id else False
-        movie.torrent_hash = active_torrents.get(movie.kinopoisk_id) if movie.kinopoisk_id else None
-        
-    return render_template(
-        'library.html',
-        library_movies=library_movies,
-        background_photos=get_background_photos()
+    library_count, library_updated = library_version()
+    identifiers_count, identifiers_updated = identifiers_version()
+    get_active_torrents_map()  # освежает снимок перед расчётом ETag
+    etag = make_etag(
+        'library', library_count, library_updated, identifiers_count, identifiers_updated,
+        torrent_snapshot.kinopoisk_digest(),
     )
 
+    def build():
+        library_movies, next_cursor = load_library_page()
+        return render_template(
+            'library.html',
+            library_movies=library_movies,
+            next_cursor=next_cursor,
+        )
+    # Без Last-Modified: удаление строки не меняет max(updated_at), и клиент
+    # с одним If-Modified-Since получил бы 304 с удалённой записью
+    return conditional_response(etag, None, build)
+
 
 @app.route('/l/<lottery_id>')
 def play_lottery(lottery_id):
     lottery = Lottery.query.get_or_404(lottery_id)
-    result_obj = {"name": lottery.result_name, "poster": lottery.result_poster, "year": lottery.result_year} if lottery.result_name else None
-    return render_template('play.html', lottery=lottery, result=result_obj, background_photos=get_background_photos())
+
+    def build():
+        result_obj = {"name": lottery.result_name, "poster": lottery.result_poster, "year": lottery.result_year} if lottery.result_name else None
+        return render_template('play.html', lottery=lottery, result=result_obj)
+    return conditional_response(make_etag('play', lottery.id, lottery.version), lottery.updated_at, build)
 
 @app.route('/draw/<lottery_id>', methods=['POST'])
 def draw_winner(lottery_id):
@@ -273,10 +3526,16 @@ def draw_winner(lottery_id):
         return jsonify({"name": lottery.result_name, "poster": lottery.result_poster, "year": lottery.result_year})
     
     winner = random.choice(lottery.movies)
+    lottery.winner = winner
     lottery.result_name = winner.name
     lottery.result_poster = winner.poster
     lottery.result_year = winner.year
+    lottery.version += 1
     db.session.commit()
+    event_broker.publish('lottery_drawn', {
+        "lottery_id": lottery.id,
+        "result": {"name": winner.name, "poster": winner.poster, "year": winner.year},
+    })
     return jsonify({"name": winner.name, "poster": winner.poster, "year": winner.year})
 
 # --- API Маршруты ---
@@ -285,25 +3544,126 @@ def draw_winner(lottery_id):
 def get_result_data(lottery_id):
     lottery = Lottery.query.get_or_404(lottery_id)
     active_torrents = get_active_torrents_map()
-    movies_data = []
-
-    for m in lottery.movies:
-        identifier = MovieIdentifier.query.get(m.kinopoisk_id)
-        is_on_client = m.kinopoisk_id in active_torrents if m.kinopoisk_id else False
-        movies_data.append({
-            "kinopoisk_id": m.kinopoisk_id, "name": m.name, "poster": m.poster, "year": m.year,
-            "description": m.description, "rating_kp": m.rating_kp, "genres": m.genres, "countries": m.countries,
-            "has_magnet": bool(identifier), "magnet_link": identifier.magnet_link if identifier else None,
-            "is_on_client": is_on_client, "torrent_hash": active_torrents.get(m.kinopoisk_id) if is_on_client else None
+    identifiers_count, identifiers_updated = identifiers_version()
+    etag = make_etag(
+        'result', lottery.id, lottery.version, identifiers_count, identifiers_updated, torrent_snapshot.kinopoisk_digest(),
+    )
+
+    def build():
+        identifiers = get_movie_identifiers(m.kinopoisk_id for m in lottery.movies)
+        movies_data = [_movie_payload(m, identifiers, active_torrents) for m in lottery.movies]
+        result_data = next((data for m, data in zip(lottery.movies, movies_data) if m.id == lottery.winner_movie_id), None)
+        return jsonify({
+            "movies": movies_data, "result": result_data,
+            "createdAt": lottery.created_at.isoformat() + "Z",
+            "play_url": url_for('play_lottery', lottery_id=lottery.id, _external=True)
         })
+    return conditional_response(etag, _latest(lottery.updated_at, identifiers_updated), build)
+
+def load_draw_results(lottery_ids):
+    """Состояние розыгрыша для набора лотерей одним запросом, без данных о торрентах."""
+    rows = db.session.execute(
+        db.select(Lottery.id, Lottery.result_name, Lottery.result_poster, Lottery.result_year)
+        .where(Lottery.id.in_(lottery_ids))
+    ).all()
+    return {
+        row.id: {"name": row.result_name, "poster": row.result_poster, "year": row.result_year} if row.result_name else None
+        for row in rows
+    }
+
+def _wait_for_draw(lottery_ids, last_event_id, timeout):
+    """
+    Блокирует до события lottery_drawn по одной из лотерей или до таймаута.
+    Уведомление внутрипроцессное, поэтому раз в EVENT_DRAW_POLL_INTERVAL
+    состояние лотерей перечитывается из базы: так виден и розыгрыш,
+    проведённый другим воркером.
+    """
+    deadline = time.monotonic() + timeout
+    while (remaining := deadline - time.monotonic()) > 0:
+        if event_broker.wait(last_event_id, min(remaining, EVENT_DRAW_POLL_INTERVAL)):
+            events = event_broker.events_since(last_event_id)
+            if events is None:
+                return True
+            for event in events:
+                last_event_id = event["id"]
+                if event["type"] == 'lottery_drawn' and event["data"].get("lottery_id") in lottery_ids:
+                    return True
+            continue
+        drawn = any(result is not None for result in load_draw_results(lottery_ids).values())
+        db.session.close()
+        if drawn:
+            return True
+    return False
+
+@app.route('/api/results')
+def get_draw_results():
+    """
+    Результаты розыгрышей для списка лотерей: ?ids=a,b,c. С параметром
+    wait=<секунды> ответ задерживается, пока одна из ещё не разыгранных
+    лотерей не будет разыграна (long-polling), но не дольше RESULTS_LONG_POLL_MAX.
+    """
+    lottery_ids = _parse_filter('ids')
+    if not lottery_ids:
+        return jsonify({"error": "Не указаны id лотерей."}), 400
+    if len(lottery_ids) > RESULTS_BATCH_MAX:
+        return jsonify({"error": f"Не больше {RESULTS_BATCH_MAX} лотерей за запрос."}), 400
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), RESULTS_LONG_POLL_MAX)
+    except ValueError:
+        return jsonify({"error": "Некорректный параметр wait."}), 400
+
+    # id события запоминается до чтения базы, чтобы не пропустить розыгрыш между ними
+    last_event_id = event_broker.last_id
+    results = load_draw_results(lottery_ids)
+    pending = {lottery_id for lottery_id, result in results.items() if result is None}
+    if wait and pending and len(pending) == len(results):
+        db.session.close()  # не держим соединение пула на время ожидания
+        if _wait_for_draw(pending, last_event_id, wait):
+            results = load_draw_results(lottery_ids)
 
-    result_data = next((m for m in movies_data if m["name"] == lottery.result_name), None) if lottery.result_name else None
     return jsonify({
-        "movies": movies_data, "result": result_data, 
-        "createdAt": lottery.created_at.isoformat() + "Z", 
-        "play_url": url_for('play_lottery', lottery_id=lottery.id, _external=True)
+        "drawn": {lottery_id: result for lottery_id, result in results.items() if result},
+        "pending": sorted(lottery_id for lottery_id, result in results.items() if result is None),
+        "missing": sorted(lottery_ids - results.keys()),
     })
 
+@app.route('/api/history')
+def get_history_page():
+    try:
+        lotteries, winners, identifiers, active_torrents, next_cursor = load_history_page(
+            request.args.get('cursor'), _page_limit(HISTORY_PAGE_SIZE),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    items = []
+    for lottery in lotteries:
+        result = None
+        if winner_movie := winners.get(lottery.id):
+            result = _movie_payload(winner_movie, identifiers, active_torrents)
+        elif lottery.result_name:
+            result = {"name": lottery.result_name, "poster": lottery.result_poster, "year": lottery.result_year, "has_magnet": False}
+        items.append({"id": lottery.id, "created_at": lottery.created_at.isoformat() + "Z", "result": result})
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+@app.route('/api/library', methods=['GET'])
+def get_library_page():
+    try:
+        library_movies, next_cursor = load_library_page(request.args.get('cursor'), _page_limit(LIBRARY_PAGE_SIZE))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    items = []
+    for movie in library_movies:
+        items.append({
+            "id": movie.id, "kinopoisk_id": movie.kinopoisk_id, "name": movie.name, "poster": movie.poster,
+            "year": movie.year, "description": movie.description, "rating_kp": movie.rating_kp,
+            "genres": movie.genres, "countries": movie.countries, "added_at": movie.added_at.isoformat(),
+            "has_magnet": movie.has_magnet, "magnet_link": movie.magnet_link,
+            "is_on_client": movie.is_on_client, "torrent_hash": movie.torrent_hash,
+        })
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
 @app.route('/api/library', methods=['POST'])
 def add_library_movie():
     # ... (код без изменений)
@@ -400,38 +3760,26 @@ def remove_library_movie(movie_id):
 
 @app.route('/delete-lottery/<lottery_id>', methods=['POST'])
 def delete_lottery(lottery_id):
-    # ... (код без изменений)
     lottery_to_delete = Lottery.query.get(lottery_id)
     if not lottery_to_delete:
         return jsonify({"success": False, "message": "Лотерея не найдена."}), 404
-    
-    message = ""
-    try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        
-        category = f"lottery-{lottery_id}"
-        torrents_to_delete = qbt_client.torrents_info(category=category)
-        
-        if torrents_to_delete:
-            hashes_to_delete = [t.hash for t in torrents_to_delete]
-            qbt_client.torrents_delete(delete_files=True, torrent_hashes=hashes_to_delete)
-            message = "Лотерея и связанный торрент успешно удалены."
-        else:
-            message = "Торрент не найден в клиенте. Лотерея удалена из истории."
-            
-        qbt_client.auth_log_out()
 
-    except (qbittorrent_exceptions.APIConnectionError, requests.exceptions.RequestException) as e:
-        message = "Не удалось подключиться к qBittorrent. Лотерея будет удалена только из истории."
-        print(f"Ошибка подключения к qBittorrent при удалении: {e}")
-    except Exception as e:
-        message = "Произошла ошибка при работе с qBittorrent. Лотерея будет удалена только из истории."
-        print(f"Неизвестная ошибка qBittorrent при удалении: {e}")
-    
+    # Задача на удаление торрента коммитится вместе с удалением лотереи
+    job = enqueue_job('torrent_delete', {"category": f"lottery-{lottery_id}"})
     db.session.delete(lottery_to_delete)
     db.session.commit()
-    return jsonify({"success": True, "message": message})
+    job = submit_job(job)
+
+    body = {"success": True, "job_id": job.id, "status": job.status}
+    if job.status == 'done':
+        deleted = (json.loads(job.result) if job.result else {}).get('deleted')
+        body["message"] = ("Лотерея и связанный торрент успешно удалены." if deleted
+                           else "Торрент не найден в клиенте. Лотерея удалена из истории.")
+    elif job.status == 'failed':
+        body["message"] = "Лотерея удалена из истории, но торрент удалить не удалось."
+    else:
+        body["message"] = "Лотерея удалена. Торрент будет удалён из клиента в фоне."
+    return jsonify(body)
 
 @app.route('/api/movie-magnet', methods=['POST'])
 def save_movie_magnet():
@@ -469,27 +3817,100 @@ def save_movie_magnet():
 
 @app.route('/api/start-download/<int:kinopoisk_id>', methods=['POST'])
 def start_download(kinopoisk_id):
-    # ... (код без изменений)
     identifier = MovieIdentifier.query.get_or_404(kinopoisk_id)
     movie_in_lottery = Movie.query.filter_by(kinopoisk_id=kinopoisk_id).order_by(Movie.id.desc()).first()
     category = f"lottery-{movie_in_lottery.lottery_id}" if movie_in_lottery else "lottery-default"
 
+    download = download_scheduler.schedule(
+        category, identifier.magnet_link, kinopoisk_id, DOWNLOAD_PRIORITY_LOTTERY,
+        idempotency_key=_idempotency_key('torrent_add'),
+    )
+    db.session.commit()
+    return download_response(download)
+
+def _remember_magnet(kinopoisk_id, magnet):
+    """Запоминает найденную раздачу фильма; запись параллельного запроса не перетирается."""
+    if db.session.get(MovieIdentifier, kinopoisk_id):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(MovieIdentifier(kinopoisk_id=kinopoisk_id, magnet_link=magnet))
+    except IntegrityError:
+        pass  # тот же kinopoisk_id только что записал параллельный запрос
+
+@job_handler('lottery_download')
+def _run_lottery_download(payload):
+    """
+    Поиск раздачи для победителя лотереи и постановка её в очередь загрузок.
+    Выполняется воркером очереди задач: проверка клиента и поиск по всем
+    провайдерам не держат HTTP-запрос.
+    """
+    lottery = db.session.get(Lottery, payload['lottery_id'])
+    if lottery is None:
+        raise PermanentJobError("Лотерея не найдена.")
+    winner = lottery.winner
+    name = winner.name if winner else lottery.result_name
+    year = winner.year if winner else lottery.result_year
+    category = f"lottery-{lottery.id}"
     try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        qbt_client.torrents_add(
-            urls=identifier.magnet_link, category=category,
-            is_sequential_download=True, is_first_last_piece_priority=True,
-            tags=f"kp-{kinopoisk_id}",
+        if qbit_request('torrents_info', category=category):
+            return {"message": "Загрузка уже идёт."}
+    except (qbittorrent_exceptions.APIError, requests.exceptions.RequestException) as e:
+        print(f"Не удалось проверить загрузки лотереи {lottery.id}: {e}")
+
+    results = _search_torrents(f"{name} {year}" if year else name)
+    if not results:
+        raise PermanentJobError("Раздача для фильма не найдена.")
+    magnet = next((result['magnet'] for result in results if result.get('magnet')), None)
+    if not magnet:
+        raise PermanentJobError("Раздача без magnet-ссылки.")
+    kinopoisk_id = winner.kinopoisk_id if winner else None
+    if kinopoisk_id:
+        _remember_magnet(kinopoisk_id, magnet)
+    download = download_scheduler.schedule(category, magnet, kinopoisk_id, DOWNLOAD_PRIORITY_WINNER)
+    db.session.flush()
+    return {"message": "Раздача найдена.", "download_id": download.id}
+
+@app.route('/api/start-download/<lottery_id>', methods=['POST'])
+def start_lottery_download(lottery_id):
+    """
+    Скачивание победителя лотереи без ручного magnet: берётся сохранённая
+    ссылка фильма, а если её нет - поиск по "название год" ставится в
+    очередь задач (см. _run_lottery_download).
+    """
+    lottery = Lottery.query.get_or_404(lottery_id)
+    winner = lottery.winner
+    if not (winner.name if winner else lottery.result_name):
+        return jsonify({"success": False, "message": "Победитель ещё не определён."}), 400
+
+    category = f"lottery-{lottery.id}"
+    if torrent_snapshot.by_category(category):
+        return jsonify({"success": True, "message": "Загрузка уже идёт."})
+
+    kinopoisk_id = winner.kinopoisk_id if winner else None
+    identifier = db.session.get(MovieIdentifier, kinopoisk_id) if kinopoisk_id else None
+    if identifier:
+        download = download_scheduler.schedule(
+            category, identifier.magnet_link, kinopoisk_id, DOWNLOAD_PRIORITY_WINNER,
+            idempotency_key=_idempotency_key('torrent_add'),
         )
-        qbt_client.auth_log_out()
-        return jsonify({"success": True, "message": "Загрузка началась!"})
-    except Exception as e:
-        return jsonify({"success": False, "message": f"Ошибка qBittorrent: {e}"}), 500
+        db.session.commit()
+        return download_response(download)
+
+    job = enqueue_job('lottery_download', {"lottery_id": lottery.id}, _idempotency_key('lottery_download'))
+    db.session.commit()
+    job = submit_job(job)
+    if job.status == 'failed':
+        return jsonify({"job_id": job.id, "status": job.status, "success": False, "message": job.last_error}), 404
+    if job.status == 'done':
+        result = json.loads(job.result)
+        if download_id := result.get('download_id'):
+            return download_response(db.session.get(DownloadRequest, download_id))
+        return jsonify({"job_id": job.id, "status": job.status, "success": True, "message": result['message']})
+    return job_response(job, "Ищем раздачу для фильма.")
 
 @app.route('/api/library/start-download/<int:movie_id>', methods=['POST'])
 def start_library_download(movie_id):
-    # ... (код без изменений)
     library_movie = LibraryMovie.query.get_or_404(movie_id)
     if not library_movie.kinopoisk_id:
         return jsonify({"success": False, "message": "Для фильма не указан kinopoisk_id."}), 400
@@ -498,78 +3919,95 @@ def start_library_download(movie_id):
     if not identifier or not identifier.magnet_link:
         return jsonify({"success": False, "message": "Magnet-ссылка не найдена."}), 400
 
-    category = f"library-{movie_id}"
-
-    try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        qbt_client.torrents_add(
-            urls=identifier.magnet_link, category=category,
-            is_sequential_download=True, is_first_last_piece_priority=True,
-            tags=f"kp-{library_movie.kinopoisk_id}",
-        )
-        qbt_client.auth_log_out()
-        return jsonify({"success": True, "message": "Загрузка началась!"})
-    except Exception as e:
-        return jsonify({"success": False, "message": f"Ошибка qBittorrent: {e}"}), 500
+    download = download_scheduler.schedule(
+        f"library-{movie_id}", identifier.magnet_link, library_movie.kinopoisk_id, DOWNLOAD_PRIORITY_LIBRARY,
+        idempotency_key=_idempotency_key('torrent_add'),
+    )
+    db.session.commit()
+    return download_response(download)
 
 # НОВЫЙ МАРШРУТ ДЛЯ УДАЛЕНИЯ ТОРРЕНТА
 @app.route('/api/delete-torrent/<string:torrent_hash>', methods=['POST'])
 def delete_torrent_from_client(torrent_hash):
     if not torrent_hash:
         return jsonify({"success": False, "message": "Не указан хеш торрента"}), 400
-    
-    qbt_client = None
+
+    job = enqueue_job('torrent_delete', {"hashes": [torrent_hash]}, idempotency_key=_idempotency_key('torrent_delete'))
+    db.session.commit()
+    return job_response(submit_job(job), "Торрент будет удалён из клиента в фоне.")
+
+@app.route('/api/jobs/<int:job_id>')
+def get_job_status(job_id):
+    return jsonify(_job_to_dict(Job.query.get_or_404(job_id)))
+
+@app.route('/api/downloads')
+def list_download_queue():
+    active = DownloadRequest.query.filter_by(status='active').order_by(DownloadRequest.started_at).all()
+    return jsonify({
+        "max_active": download_scheduler.max_active,
+        "active": [_download_to_dict(download) for download in active],
+        "queued": download_scheduler.queued(),
+    })
+
+@app.route('/api/retention')
+def get_retention_report():
+    """Занятое место, политики, план очистки (без удаления) и отчёт последнего прохода."""
+    return jsonify({
+        "enabled": retention_manager.enabled,
+        "plan": retention_manager.run(dry_run=True),
+        "last_report": retention_manager.last_report(),
+    })
+
+@app.route('/api/retention/run', methods=['POST'])
+def run_retention():
+    """Проход очистки вне расписания; ?dry_run=1 - только показать, что будет удалено."""
+    if not retention_manager.enabled:
+        return jsonify({"success": False, "message": "Политики хранения не заданы (RETENTION_*)."}), 400
+    return jsonify(retention_manager.run(dry_run=request.args.get('dry_run') == '1'))
+
+@app.route('/api/downloads/<int:download_id>', methods=['PATCH'])
+def update_download_priority(download_id):
+    download = DownloadRequest.query.get_or_404(download_id)
     try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        
-        # Удаляем торрент и файлы
-        qbt_client.torrents_delete(delete_files=True, torrent_hashes=torrent_hash)
-        
-        return jsonify({"success": True, "message": "Торрент и файлы удалены с клиента."})
-    
-    except qbittorrent_exceptions.NotFound404Error:
-        return jsonify({"success": False, "message": "Торрент с таким хешем не найден в клиенте."}), 404
-    except (qbittorrent_exceptions.APIConnectionError, requests.exceptions.RequestException) as e:
-        print(f"Ошибка подключения к qBittorrent при удалении: {e}")
-        return jsonify({"success": False, "message": "Не удалось подключиться к qBittorrent."}), 500
-    except Exception as e:
-        print(f"Неизвестная ошибка qBittorrent при удалении торрента: {e}")
-        return jsonify({"success": False, "message": "Произошла неизвестная ошибка."}), 500
-    finally:
-        if qbt_client and qbt_client.is_logged_in:
-            try:
-                qbt_client.auth_log_out()
-            except Exception:
-                pass
+        download.priority = int((request.get_json(silent=True) or {})['priority'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"success": False, "message": "Укажите целый priority."}), 400
+    db.session.commit()
+    return jsonify({
+        "success": True,
+        **_download_to_dict(download, download_scheduler.queue_position(download) if download.status == 'queued' else None),
+    })
+
+@app.route('/api/downloads/<int:download_id>', methods=['DELETE'])
+def cancel_queued_download(download_id):
+    download = DownloadRequest.query.get_or_404(download_id)
+    if not download_scheduler.cancel(download):
+        return jsonify({"success": False, "message": "Отменить можно только загрузку, ожидающую в очереди."}), 409
+    return jsonify({"success": True, "message": "Загрузка убрана из очереди."})
 
 
 # --- Маршруты статусов (без изменений) ---
+def _format_lottery_torrent_status(torrent):
+    return {
+        "status": torrent.state,
+        "progress": round(torrent.progress * 100, 1),
+        "speed_mbps": round(torrent.dlspeed / 1024 / 1024, 2),
+        "eta": _format_eta(torrent.eta),
+        "name": torrent.name,
+    }
+
 @app.route('/api/torrent-status/<lottery_id>')
 def get_torrent_status(lottery_id):
-    # ... (код без изменений)
-    qbt_client = None
+    category = f"lottery-{lottery_id}"
     try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        torrents = qbt_client.torrents_info(category=f"lottery-{lottery_id}")
+        torrents = qbit_request('torrents_info', category=category)
         if not torrents:
-            return jsonify({"status": "not_found"})
-        
-        torrent = torrents[0]
-        return jsonify({
-            "status": torrent.state, "progress": f"{torrent.progress * 100:.1f}",
-            "speed": f"{torrent.dlspeed / 1024 / 1024:.2f}", "name": torrent.name,
-            "eta": f"{torrent.eta // 3600}ч {(torrent.eta % 3600) // 60}м",
-            "seeds": torrent.num_seeds, "peers": torrent.num_leechs
-        })
+            return jsonify(_queued_status(_queued_downloads(), category=category) or {"status": "not_found"})
+        return jsonify(_format_lottery_torrent_status(torrents[0]))
+    except QBIT_UNAVAILABLE_ERRORS as e:
+        return jsonify(_stale_status(torrent_snapshot.by_category(category), e, _format_lottery_torrent_status))
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
-    finally:
-        if qbt_client:
-            try: qbt_client.auth_log_out()
-            except: pass
 
 # ... (остальные маршруты статусов и служебные маршруты без изменений)
 
@@ -591,6 +4029,8 @@ def _format_eta(seconds):
         return '--:--'
     hours = int(seconds) // 3600
     minutes = (int(seconds) % 3600) // 60
+    if not hours:
+        return f"{minutes}м"
     return f"{hours}ч {minutes}м"
 
 
@@ -607,92 +4047,522 @@ def _format_torrent_status(torrent):
     }
 
 
+def qbittorrent_state():
+    """Состояние связи с qBittorrent (предохранитель и возраст снимка) для ответов API."""
+    age = torrent_snapshot.age()
+    return {**qbit_breaker.snapshot(), "snapshot_age": round(age, 2) if age is not None else None}
+
+
+def _snapshot_is_stale():
+    age = torrent_snapshot.age()
+    return (
+        qbit_breaker.state != 'closed' or torrent_snapshot.last_error is not None
+        or age is None or age > TORRENT_SNAPSHOT_MAX_AGE
+    )
+
+
+def _stale_status(torrents, error, formatter=_format_torrent_status):
+    """
+    Ответ по последнему известному снимку, когда qBittorrent не ответил:
+    вместо пустого статуса - старые данные с пометкой stale.
+    """
+    body = None
+    if torrents:
+        try:
+            body = formatter(max(torrents, key=lambda t: t.get('progress', 0)))
+        except (AttributeError, TypeError):
+            body = None  # в снимке ещё нет всех полей торрента
+    if body is None:
+        body = {"status": "error", "message": f"Нет связи с qBittorrent: {error}"}
+    body.update(stale=True, qbittorrent=qbittorrent_state())
+    return body
+
+
 @app.route('/api/download-status/<int:kinopoisk_id>')
 def get_download_status_by_kinopoisk(kinopoisk_id):
-    qbt_client = None
     try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        torrents = qbt_client.torrents_info(tag=f"kp-{kinopoisk_id}")
+        torrents = qbit_request('torrents_info', tag=f"kp-{kinopoisk_id}")
         if not torrents:
-            return jsonify({"status": "not_found"})
+            queued = _queued_status(_queued_downloads(), kinopoisk_id=kinopoisk_id)
+            return jsonify({**queued, "kinopoisk_id": kinopoisk_id} if queued else {"status": "not_found"})
 
         torrent = max(torrents, key=lambda t: getattr(t, 'progress', 0))
         payload = _format_torrent_status(torrent)
-        payload["kinopoisk_id"] = kinopoisk_id
-        return jsonify(payload)
+    except QBIT_UNAVAILABLE_ERRORS as e:
+        payload = _stale_status(torrent_snapshot.by_kinopoisk(kinopoisk_id), e)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
-    finally:
-        if qbt_client:
-            try:
-                qbt_client.auth_log_out()
-            except Exception:
-                pass
+    payload["kinopoisk_id"] = kinopoisk_id
+    return jsonify(payload)
 
 
-@app.route('/api/active-downloads')
-def list_active_downloads():
-    qbt_client = None
+def _parse_id_list(values, cast=str):
+    if not isinstance(values, list):
+        return []
+    parsed = []
+    for value in values:
+        try:
+            item = cast(value)
+        except (TypeError, ValueError):
+            continue
+        if item not in parsed:
+            parsed.append(item)
+    return parsed
+
+
+@app.route('/api/download-status/batch', methods=['POST'])
+def get_download_statuses_batch():
+    """
+    Статусы сразу для набора загрузок одним вызовом torrents_info.
+    Принимает {"kinopoisk_ids": [...], "lottery_ids": [...], "library_ids": [...]}
+    и возвращает словари статусов под ключами kinopoisk, lotteries и library.
+    """
+    payload = request.json or {}
+    kinopoisk_ids = _parse_id_list(payload.get('kinopoisk_ids'), int)
+    lottery_ids = _parse_id_list(payload.get('lottery_ids'))
+    library_ids = _parse_id_list(payload.get('library_ids'), int)
+    result = {"kinopoisk": {}, "lotteries": {}, "library": {}}
+    if not (kinopoisk_ids or lottery_ids or library_ids):
+        return jsonify(result)
+
     try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        torrents = qbt_client.torrents_info()
-        downloads = []
-        for torrent in torrents:
-            kinopoisk_id = _extract_kinopoisk_id(getattr(torrent, 'tags', ''))
-            if not kinopoisk_id:
-                continue
-            payload = _format_torrent_status(torrent)
-            payload["kinopoisk_id"] = kinopoisk_id
-            downloads.append(payload)
-        return jsonify({"downloads": downloads})
+        torrents = qbit_request('torrents_info')
     except Exception as e:
-        return jsonify({"downloads": [], "status": "error", "message": str(e)})
-    finally:
-        if qbt_client:
-            try:
-                qbt_client.auth_log_out()
-            except Exception:
-                pass
+        if not isinstance(e, QBIT_UNAVAILABLE_ERRORS) or torrent_snapshot.age() is None:
+            error = {"status": "error", "message": str(e)}
+            result["kinopoisk"] = {str(kp_id): error for kp_id in kinopoisk_ids}
+            result["lotteries"] = {lottery_id: error for lottery_id in lottery_ids}
+            result["library"] = {str(movie_id): error for movie_id in library_ids}
+            return jsonify(result)
+        # qBittorrent недоступен: отвечаем по последнему известному снимку
+        torrents = torrent_snapshot.all()
+        result.update(stale=True, qbittorrent=qbittorrent_state())
+
+    by_kinopoisk, by_category = {}, {}
+    for torrent in torrents:
+        kp_id = _extract_kinopoisk_id(getattr(torrent, 'tags', ''))
+        if kp_id and getattr(torrent, 'progress', 0) >= getattr(by_kinopoisk.get(kp_id), 'progress', -1):
+            by_kinopoisk[kp_id] = torrent
+        by_category.setdefault(getattr(torrent, 'category', ''), torrent)
+
+    queued = None
+
+    def missing(**filters):
+        # Очередь загрузок читается, только если какого-то торрента нет в клиенте
+        nonlocal queued
+        if queued is None:
+            queued = _queued_downloads()
+        return _queued_status(queued, **filters) or {"status": "not_found"}
+
+    for kp_id in kinopoisk_ids:
+        torrent = by_kinopoisk.get(kp_id)
+        status = _format_torrent_status(torrent) if torrent else missing(kinopoisk_id=kp_id)
+        status["kinopoisk_id"] = kp_id
+        result["kinopoisk"][str(kp_id)] = status
+    for lottery_id in lottery_ids:
+        torrent = by_category.get(f"lottery-{lottery_id}")
+        result["lotteries"][lottery_id] = _format_torrent_status(torrent) if torrent else missing(category=f"lottery-{lottery_id}")
+    for movie_id in library_ids:
+        torrent = by_category.get(f"library-{movie_id}")
+        result["library"][str(movie_id)] = _format_torrent_status(torrent) if torrent else missing(category=f"library-{movie_id}")
+    return jsonify(result)
+
+
+@app.route('/api/active-downloads')
+def list_active_downloads():
+    torrent_sync.ensure_fresh()
+    downloads = []
+    for torrent in torrent_snapshot.all():
+        kinopoisk_id = _extract_kinopoisk_id(torrent.get('tags'))
+        if not kinopoisk_id:
+            continue
+        payload = _format_torrent_status(torrent)
+        payload["kinopoisk_id"] = kinopoisk_id
+        downloads.append(payload)
+
+    queued = [
+        {**item, "status": "queued"} for item in _queued_downloads() if item["kinopoisk_id"]
+    ]
+
+    age = torrent_snapshot.age()
+    response = {
+        "downloads": downloads, "queued": queued, "snapshot_age": round(age, 2) if age is not None else None,
+        "stale": _snapshot_is_stale(), "qbittorrent": qbittorrent_state(),
+    }
+    if torrent_snapshot.last_error:
+        response.update({"status": "error", "message": torrent_snapshot.last_error})
+    return jsonify(response)
 
 
 @app.route('/api/library/torrent-status/<int:movie_id>')
 def get_library_torrent_status(movie_id):
-    qbt_client = None
+    category = f"library-{movie_id}"
     try:
-        qbt_client = Client(host=QBIT_HOST, port=QBIT_PORT, username=QBIT_USERNAME, password=QBIT_PASSWORD)
-        qbt_client.auth_log_in()
-        torrents = qbt_client.torrents_info(category=f"library-{movie_id}")
+        torrents = qbit_request('torrents_info', category=category)
         if not torrents:
-            return jsonify({"status": "not_found"})
+            return jsonify(_queued_status(_queued_downloads(), category=category) or {"status": "not_found"})
 
-        torrent = torrents[0]
-        return jsonify({
-            "status": torrent.state,
-            "progress": f"{torrent.progress * 100:.1f}",
-            "speed": f"{torrent.dlspeed / 1024 / 1024:.2f}",
-            "name": torrent.name,
-            "eta": f"{torrent.eta // 3600}ч {(torrent.eta % 3600) // 60}м",
-            "seeds": torrent.num_seeds,
-            "peers": torrent.num_leechs,
-        })
+        return jsonify(_format_torrent_status(torrents[0]))
+    except QBIT_UNAVAILABLE_ERRORS as e:
+        return jsonify(_stale_status(torrent_snapshot.by_category(category), e))
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
+
+
+# --- Потоковое воспроизведение ---
+VIDEO_EXTENSIONS = frozenset({'.mkv', '.mp4', '.m4v', '.avi', '.mov', '.webm', '.ts', '.m2ts', '.wmv', '.mpg', '.mpeg'})
+VIDEO_MIMETYPES = {
+    '.mkv': 'video/x-matroska', '.mp4': 'video/mp4', '.m4v': 'video/mp4', '.webm': 'video/webm',
+    '.avi': 'video/x-msvideo', '.mov': 'video/quicktime', '.ts': 'video/mp2t', '.m2ts': 'video/mp2t',
+    '.wmv': 'video/x-ms-wmv', '.mpg': 'video/mpeg', '.mpeg': 'video/mpeg',
+}
+PIECE_DOWNLOADED = 2  # состояние куска в torrents/pieceStates
+MAX_FILE_PRIORITY = 7
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _map_qbit_path(path):
+    for remote, local in STREAM_PATH_MAP:
+        if path == remote or path.startswith(remote.rstrip('/') + '/'):
+            return local + path[len(remote):]
+    return path
+
+
+def _pick_stream_file(files):
+    """Самый большой видеофайл торрента (если видео нет - самый большой файл) и его смещение в торренте."""
+    indexed = [(file.get('index', position), file) for position, file in enumerate(files)]
+    videos = [item for item in indexed if os.path.splitext(item[1]['name'])[1].lower() in VIDEO_EXTENSIONS]
+    index, file = max(videos or indexed, key=lambda item: item[1]['size'])
+    offset = sum(other['size'] for other_index, other in indexed if other_index < index)
+    return index, file, offset
+
+
+def _locate_on_disk(torrent, file):
+    """
+    Путь к файлу торрента на диске: в save_path или в папке незавершённых
+    загрузок, с расширением .!qB или без. Пути вне папки торрента не отдаются.
+    """
+    for root in (getattr(torrent, 'save_path', None), getattr(torrent, 'download_path', None)):
+        if not root:
+            continue
+        root = os.path.realpath(_map_qbit_path(root))
+        for suffix in ('', '.!qB'):
+            path = os.path.realpath(os.path.join(root, file['name'] + suffix))
+            if path.startswith(root + os.sep) and os.path.isfile(path):
+                return path
+    return None
+
+
+def _parse_range(header, size):
+    """
+    (start, end) из заголовка Range. None - заголовка нет, ValueError -
+    диапазон некорректен или за пределами файла. Поддерживается один диапазон.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        raise ValueError(header)
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(0, size - int(last)), size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def _available_end(states, piece_size, offset, start, end):
+    """Последний байт диапазона, до которого все куски уже скачаны, или None."""
+    first_piece = piece = (offset + start) // piece_size
+    last_piece = (offset + end) // piece_size
+    while piece <= last_piece and piece < len(states) and states[piece] == PIECE_DOWNLOADED:
+        piece += 1
+    if piece == first_piece:
+        return None
+    return min(end, piece * piece_size - offset - 1)
+
+
+def _wait_for_pieces(torrent_hash, offset, start, end):
+    piece_size = qbit_request('torrents_properties', torrent_hash=torrent_hash)['piece_size']
+    deadline = time.monotonic() + STREAM_WAIT_TIMEOUT
+    while True:
+        states = qbit_request('torrents_piece_states', torrent_hash=torrent_hash)
+        available = _available_end(states, piece_size, offset, start, end)
+        if available is not None or time.monotonic() >= deadline:
+            return available
+        time.sleep(STREAM_POLL_INTERVAL)
+
+
+def _boost_stream_priority(torrent, index, file):
+    """
+    WebAPI qBittorrent не умеет задавать приоритет отдельных кусков, поэтому
+    просматриваемому файлу ставится максимальный приоритет и включаются
+    последовательная загрузка и приоритет первых/последних кусков.
+    """
+    try:
+        if file.get('priority', MAX_FILE_PRIORITY) < MAX_FILE_PRIORITY:
+            qbit_request('torrents_file_priority', torrent_hash=torrent.hash, file_ids=index, priority=MAX_FILE_PRIORITY)
+        if getattr(torrent, 'seq_dl', True) is False:
+            qbit_request('torrents_toggle_sequential_download', torrent_hashes=torrent.hash)
+        if getattr(torrent, 'f_l_piece_prio', True) is False:
+            qbit_request('torrents_toggle_first_last_piece_priority', torrent_hashes=torrent.hash)
+    except qbittorrent_exceptions.APIError as e:
+        print(f"Не удалось поднять приоритет файла {file['name']}: {e}")
+
+
+def _range_not_satisfiable(size, retry=False):
+    if retry:
+        response = jsonify({"status": "not_ready", "message": "Эта часть файла ещё не скачана."})
+        response.headers['Retry-After'] = str(STREAM_RETRY_AFTER)
+    else:
+        response = jsonify({"status": "error", "message": "Некорректный диапазон."})
+    response.status_code = 416
+    response.headers['Content-Range'] = f"bytes */{size}"
+    return response
+
+
+def _iter_file_range(handle, length):
+    try:
+        while length > 0:
+            chunk = handle.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
     finally:
-        if qbt_client:
-            try:
-                qbt_client.auth_log_out()
-            except:
-                pass
+        handle.close()
+
+
+def _file_range_response(path, start, end, size, partial):
+    length = end - start + 1
+    handle = open(path, 'rb')
+    handle.seek(start)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    # gunicorn отдаёт file_wrapper через sendfile() без копирования и не больше Content-Length;
+    # без него (встроенный сервер, тесты) читаем файл сами, ровно length байт
+    body = file_wrapper(handle, STREAM_CHUNK_SIZE) if file_wrapper else _iter_file_range(handle, length)
+    mimetype = VIDEO_MIMETYPES.get(os.path.splitext(path.removesuffix('.!qB'))[1].lower(), 'application/octet-stream')
+    response = Response(body, status=206 if partial else 200, mimetype=mimetype, direct_passthrough=True)
+    response.headers['Content-Length'] = str(length)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'no-cache'
+    if partial:
+        response.headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+    return response
+
+
+def stream_torrent_file(**filters):
+    """
+    Отдаёт самый большой видеофайл торрента (фильтры torrents_info) с
+    поддержкой Range. Отдаются только уже скачанные куски: для открытого
+    диапазона ответ обрезается по первому нескачанному куску, а если не скачан
+    и первый - запрос ждёт STREAM_WAIT_TIMEOUT и отвечает 416 с Retry-After.
+    """
+    try:
+        torrents = qbit_request('torrents_info', **filters)
+        if not torrents:
+            return jsonify({"status": "not_found", "message": "Торрент не найден."}), 404
+        torrent = max(torrents, key=lambda t: getattr(t, 'progress', 0))
+        retention_manager.touch(getattr(torrent, 'category', None))
+        files = qbit_request('torrents_files', torrent_hash=torrent.hash)
+        if not files:
+            response = jsonify({"status": "not_ready", "message": "qBittorrent ещё получает список файлов."})
+            response.headers['Retry-After'] = str(STREAM_RETRY_AFTER)
+            return response, 503
+
+        index, file, offset = _pick_stream_file(files)
+        size = file['size']
+        try:
+            byte_range = _parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            return _range_not_satisfiable(size)
+        start, end = byte_range or (0, size - 1)
+
+        if file.get('progress', 0) >= 1:
+            available = end
+        else:
+            _boost_stream_priority(torrent, index, file)
+            available = _wait_for_pieces(torrent.hash, offset, start, end)
+            if available is None:
+                return _range_not_satisfiable(size, retry=True)
+    except QBIT_UNAVAILABLE_ERRORS as e:
+        response = jsonify({"status": "error", "message": f"Нет связи с qBittorrent: {e}"})
+        response.headers['Retry-After'] = str(STREAM_RETRY_AFTER)
+        return response, 503
+
+    path = _locate_on_disk(torrent, file)
+    if path is None:
+        return jsonify({"status": "error", "message": "Файл торрента не найден на диске."}), 404
+    available = min(available, os.path.getsize(path) - 1)
+    if available < start:
+        return _range_not_satisfiable(size, retry=True)
+    return _file_range_response(path, start, available, size, partial=byte_range is not None or available < size - 1)
+
+
+@app.route('/api/stream/<lottery_id>')
+def stream_lottery_torrent(lottery_id):
+    return stream_torrent_file(category=f"lottery-{lottery_id}")
+
+
+@app.route('/api/stream/kp/<int:kinopoisk_id>')
+def stream_kinopoisk_torrent(kinopoisk_id):
+    return stream_torrent_file(tag=f"kp-{kinopoisk_id}")
+
+
+@app.route('/api/library/stream/<int:movie_id>')
+def stream_library_torrent(movie_id):
+    return stream_torrent_file(category=f"library-{movie_id}")
+
+
+def _parse_filter(name, cast=str):
+    values = set()
+    for value in request.args.get(name, '').split(','):
+        value = value.strip()
+        if not value:
+            continue
+        try:
+            values.add(cast(value))
+        except ValueError:
+            continue
+    return values
+
+
+def _event_matches(event, types, kinopoisk_ids, lottery_ids, library_ids):
+    if types and event["type"] not in types:
+        return False
+    if not (kinopoisk_ids or lottery_ids or library_ids):
+        return True
+    data = event["data"]
+    if event["type"] == 'lottery_drawn':
+        return data.get("lottery_id") in lottery_ids
+    category = data.get("category") or ''
+    return (
+        data.get("kinopoisk_id") in kinopoisk_ids
+        or any(category == f"lottery-{lottery_id}" for lottery_id in lottery_ids)
+        or any(category == f"library-{movie_id}" for movie_id in library_ids)
+    )
+
+
+def _format_sse(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+
+
+@app.route('/api/events')
+def stream_events():
+    """
+    Поток Server-Sent Events: изменения торрентов (`torrent`) и результаты
+    розыгрышей (`lottery_drawn`). Фильтры: types, kp, lottery, library
+    (списки через запятую). Поддерживает Last-Event-ID и heartbeat.
+    """
+    types = _parse_filter('types')
+    kinopoisk_ids = _parse_filter('kp', int)
+    lottery_ids = _parse_filter('lottery')
+    library_ids = _parse_filter('library', int)
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_event_id) if last_event_id else event_broker.last_id
+    except ValueError:
+        last_id = event_broker.last_id
+
+    # Розыгрыш в другом воркере не попадёт в шину этого процесса: ещё не
+    # разыгранные лотерии из фильтра периодически перечитываются из базы.
+    # Список читается после last_id, так что розыгрыш между ними не потеряется.
+    pending_draws = set()
+    if lottery_ids and (not types or 'lottery_drawn' in types):
+        pending_draws = {lottery_id for lottery_id, result in load_draw_results(lottery_ids).items() if result is None}
+        db.session.close()
+
+    def generate():
+        nonlocal last_id
+        started_at = last_sent_at = time.monotonic()
+        next_draw_check = started_at + EVENT_DRAW_POLL_INTERVAL
+        yield "retry: 3000\n\n"
+        while time.monotonic() - started_at < EVENT_STREAM_MAX_DURATION:
+            if not torrent_sync.is_running:
+                torrent_sync.ensure_fresh()
+            events = event_broker.events_since(last_id)
+            if events is None:
+                # Клиент отстал сильнее, чем хранит буфер: пусть перечитает состояние
+                last_id = event_broker.last_id
+                yield _format_sse({"id": last_id, "type": "resync", "data": {}})
+                continue
+            for event in events:
+                last_id = event["id"]
+                if _event_matches(event, types, kinopoisk_ids, lottery_ids, library_ids):
+                    if event["type"] == 'lottery_drawn':
+                        pending_draws.discard(event["data"].get("lottery_id"))
+                    last_sent_at = time.monotonic()
+                    yield _format_sse(event)
+            if pending_draws and time.monotonic() >= next_draw_check:
+                next_draw_check = time.monotonic() + EVENT_DRAW_POLL_INTERVAL
+                drawn = {lottery_id: result for lottery_id, result in load_draw_results(pending_draws).items() if result}
+                db.session.close()
+                for lottery_id, result in drawn.items():
+                    pending_draws.discard(lottery_id)
+                    last_sent_at = time.monotonic()
+                    yield _format_sse({"id": last_id, "type": 'lottery_drawn', "data": {"lottery_id": lottery_id, "result": result}})
+            if time.monotonic() - last_sent_at >= EVENT_HEARTBEAT_INTERVAL:
+                last_sent_at = time.monotonic()
+                yield ": heartbeat\n\n"
+            # Без фонового потока снимок обновляет сам поток событий
+            wait_timeout = EVENT_HEARTBEAT_INTERVAL if torrent_sync.is_running else torrent_sync.interval
+            if pending_draws:
+                wait_timeout = min(wait_timeout, max(next_draw_check - time.monotonic(), 0))
+            event_broker.wait(last_id, min(wait_timeout, EVENT_HEARTBEAT_INTERVAL))
+
+    return Response(
+        stream_with_context(generate()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
 
 # --- Служебные маршруты ---
+def _job_counts():
+    rows = db.session.execute(db.select(Job.status, db.func.count()).group_by(Job.status)).all()
+    return {(status,): count for status, count in rows}
+
+def _torrent_sync_lag():
+    return torrent_snapshot.age()
+
+metrics.gauge('movie_lottery_torrents_tracked', 'Торрентов в снимке qBittorrent.', collect=lambda: len(torrent_snapshot.all()))
+metrics.gauge('movie_lottery_torrents_with_kinopoisk_tag', 'Торрентов с тегом kp-<id>.', collect=lambda: len(torrent_snapshot.kinopoisk_map()))
+metrics.gauge('movie_lottery_torrent_sync_lag_seconds', 'Возраст снимка торрентов (отставание фоновой синхронизации).', collect=_torrent_sync_lag)
+metrics.gauge('movie_lottery_torrent_sync_running', 'Запущен ли поток синхронизации с qBittorrent.', collect=lambda: int(torrent_sync.is_running))
+metrics.gauge('movie_lottery_torrent_sync_error', 'Последняя синхронизация завершилась ошибкой.', collect=lambda: int(torrent_snapshot.last_error is not None))
+metrics.register(CallbackCounterMetric(
+    'movie_lottery_kinopoisk_cache_lookups_total', 'Обращения к кэшу Кинопоиска по результату.', ('result',),
+    collect=lambda: {(kind,): count for kind, count in kinopoisk_cache.stats.items()},
+))
+metrics.register(CallbackCounterMetric(
+    'movie_lottery_torrent_search_events_total', 'Поиск торрентов: попадания в кэш, ошибки и таймауты провайдеров.', ('event',),
+    collect=lambda: {(kind,): count for kind, count in torrent_search.stats.items()},
+))
+metrics.gauge(
+    'movie_lottery_qbittorrent_breaker_open', 'Предохранитель qBittorrent: 0 - closed, 1 - half_open, 2 - open.',
+    collect=lambda: {'closed': 0, 'half_open': 1, 'open': 2}[qbit_breaker.state],
+)
+metrics.gauge('movie_lottery_jobs', 'Задачи очереди qBittorrent по статусу.', ('status',), collect=_job_counts)
+metrics.gauge(
+    'movie_lottery_downloads', 'Загрузки планировщика по статусу.', ('status',),
+    collect=lambda: {(status,): count for status, count in db.session.execute(
+        db.select(DownloadRequest.status, db.func.count()).group_by(DownloadRequest.status)
+    ).all()},
+)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики процесса в текстовом формате Prometheus."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/init-db/super-secret-key-for-db-init-12345')
 def init_db():
     with app.app_context():
         db.drop_all()
         db.create_all()
+        run_migrations()
+    background_collage.invalidate()
     return "База данных полностью очищена и создана заново!"
 
 if __name__ == '__main__':
@@ -0,0 +1,353 @@
+"""
+Нагрузочный замер HTTP-маршрутов с фейковыми qBittorrent и Кинопоиском.
+
+Наполняет временную SQLite-базу лотереями, фильмами, библиотекой и
+фейковыми торрентами, затем параллельными клиентами (потоки с
+app.test_client(), без сети) гоняет каждый сценарий и считает пропускную
+способность, задержки p50/p95/p99 и среднее число SQL-запросов на запрос
+(по метрикам из /metrics). Результат пишется в JSON, который можно
+сравнить с предыдущим прогоном:
+
+    python benchmarks/bench_http.py --output before.json
+    python benchmarks/bench_http.py --output after.json --compare before.json
+
+С --compare скрипт завершается с кодом 1, если p95 какого-либо сценария
+вырос больше чем на --max-regression процентов.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+# --- Фейковые внешние сервисы ---
+
+class FakeQbitClient:
+    """qBittorrent, который держит торренты в памяти и отвечает мгновенно."""
+
+    torrents = {}
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        time.sleep(self.latency)
+        return {"rid": rid + 1, "full_update": True, "torrents": FakeQbitClient.torrents}
+
+    def torrents_info(self, category=None, **kwargs):
+        time.sleep(self.latency)
+        return []
+
+    def torrents_add(self, **kwargs):
+        time.sleep(self.latency)
+
+    def torrents_delete(self, **kwargs):
+        time.sleep(self.latency)
+
+
+class _FakeKinopoiskResponse:
+    def __init__(self, payload):
+        self.status_code = 200
+        self._payload = payload
+
+    def raise_for_status(self):
+        return None
+
+    def json(self):
+        return self._payload
+
+
+class FakeKinopoiskSession:
+    """API Кинопоиска с фиксированной задержкой; фильм строится из запроса."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        time.sleep(self.latency)
+        query = (params or {}).get('query', '') if isinstance(params, dict) else ''
+        kinopoisk_id = 10 ** 6 + sum(map(ord, query))
+        return _FakeKinopoiskResponse({"docs": [{
+            "id": kinopoisk_id, "name": query or f"Фильм {kinopoisk_id}", "year": 2000,
+            "poster": {"url": f"https://example.com/{kinopoisk_id}.jpg"}, "description": "Описание",
+            "rating": {"kp": 7.5}, "genres": [{"name": "драма"}], "countries": [{"name": "СССР"}],
+        }]})
+
+
+# --- Подготовка данных ---
+
+def _load_app(db_path, args):
+    os.environ['DATABASE_URL'] = f"sqlite:///{db_path}"
+    os.environ['TORRENT_SYNC_ENABLED'] = '0'
+    os.environ['POSTER_CACHE_DIR'] = str(Path(db_path).parent / 'posters')
+    if str(PROJECT_ROOT) not in sys.path:
+        sys.path.insert(0, str(PROJECT_ROOT))
+    import app
+    # TESTING: без фоновых потоков, задачи qBittorrent выполняются прямо в запросе
+    app.app.config['TESTING'] = True
+    app.Client = FakeQbitClient
+    app.kinopoisk_session = FakeKinopoiskSession(args.kinopoisk_latency)
+    FakeQbitClient.latency = args.qbit_latency
+    return app
+
+
+def _seed(app_module, args):
+    """Детерминированно (random.Random(seed)) наполняет базу. Возвращает id неразыгранных лотерей."""
+    rng = random.Random(args.seed)
+    start = datetime(2020, 1, 1)
+    lottery_rows, movie_rows, library_rows, identifier_rows = [], [], [], []
+    undrawn = []
+    movie_id = itertools.count(1)
+    winners = {}
+    for index in range(args.lotteries):
+        lottery_id = f"b{index:05x}"
+        created_at = start + timedelta(minutes=rng.randint(0, 10 ** 6))
+        row = {"id": lottery_id, "created_at": created_at, "updated_at": created_at, "version": 1}
+        movies = []
+        for _ in range(args.movies_per_lottery):
+            kp_id = rng.randint(1, args.lotteries * 2)
+            movies.append({
+                "id": next(movie_id), "kinopoisk_id": kp_id, "name": f"Фильм {kp_id}", "year": "2000",
+                "poster": f"https://example.com/{kp_id}.jpg", "lottery_id": lottery_id,
+            })
+        movie_rows.extend(movies)
+        # Неразыгранные лотереи нужны сценарию /draw
+        if index < args.requests:
+            undrawn.append(lottery_id)
+        else:
+            winner = rng.choice(movies)
+            winners[lottery_id] = winner["id"]
+            row.update(result_name=winner["name"], result_poster=winner["poster"], result_year=winner["year"])
+        lottery_rows.append(row)
+    for index in range(args.library):
+        library_rows.append({
+            "kinopoisk_id": 10 ** 7 + index, "name": f"Фильм {index}", "year": str(1950 + index % 70),
+            "added_at": start + timedelta(minutes=rng.randint(0, 10 ** 6)),
+        })
+    kinopoisk_ids = sorted({row["kinopoisk_id"] for row in movie_rows})
+    for kp_id in rng.sample(kinopoisk_ids, len(kinopoisk_ids) // 2):
+        identifier_rows.append({"kinopoisk_id": kp_id, "magnet_link": f"magnet:?xt=urn:btih:{kp_id:040x}"})
+
+    FakeQbitClient.torrents = {
+        f"{index:040x}": {
+            "name": f"Торрент {index}", "state": "downloading", "progress": rng.random(),
+            "dlspeed": rng.randint(0, 10 ** 7), "eta": rng.randint(60, 7200), "num_seeds": 5, "num_leechs": 1,
+            "category": f"lottery-{rng.choice(lottery_rows)['id']}", "tags": f"kp-{rng.choice(kinopoisk_ids)}",
+        }
+        for index in range(args.torrents)
+    }
+
+    db = app_module.db
+    with db.engine.begin() as connection:
+        if lottery_rows:
+            connection.execute(app_module.Lottery.__table__.insert(), lottery_rows)
+        if movie_rows:
+            connection.execute(app_module.Movie.__table__.insert(), movie_rows)
+        for lottery_id, winner_id in winners.items():
+            connection.execute(
+                app_module.Lottery.__table__.update()
+                .where(app_module.Lottery.id == lottery_id).values(winner_movie_id=winner_id)
+            )
+        if library_rows:
+            connection.execute(app_module.LibraryMovie.__table__.insert(), library_rows)
+        if identifier_rows:
+            connection.execute(app_module.MovieIdentifier.__table__.insert(), identifier_rows)
+    return undrawn, [row["id"] for row in lottery_rows]
+
+
+# --- Сценарии ---
+
+def _scenarios(undrawn, lottery_ids, args):
+    """Имя сценария -> (endpoint Flask для метрик, функция запроса)."""
+    undrawn_iter = iter(undrawn)
+    undrawn_lock = threading.Lock()
+    query_pool = [f"Фильм для поиска {index}" for index in range(args.kinopoisk_queries)]
+
+    def next_undrawn():
+        with undrawn_lock:
+            return next(undrawn_iter, undrawn[-1] if undrawn else 'nope00')
+
+    def create(client, rng):
+        movies = [{"name": f"Фильм {rng.randint(1, 10 ** 6)}", "year": "2000", "poster": None} for _ in range(4)]
+        return client.post('/create', json={"movies": movies})
+
+    return {
+        "history": ('history', lambda client, rng: client.get('/history')),
+        "library": ('library', lambda client, rng: client.get('/library')),
+        "api_result": ('get_result_data', lambda client, rng: client.get(f"/api/result/{rng.choice(lottery_ids)}")),
+        "active_downloads": ('list_active_downloads', lambda client, rng: client.get('/api/active-downloads')),
+        "create": ('create_lottery', create),
+        "draw": ('draw_winner', lambda client, rng: client.post(f"/draw/{next_undrawn()}")),
+        "fetch_movie": ('get_movie_info', lambda client, rng: client.post('/fetch-movie', json={"query": rng.choice(query_pool)})),
+    }
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+def _run_scenario(app_module, endpoint, request_fn, args, seed):
+    """Выполняет args.requests запросов в args.clients потоках."""
+    histogram = app_module.HTTP_SQL_QUERIES
+    sql_before = histogram.snapshot(endpoint=endpoint)
+    counter = itertools.count()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def worker(worker_index):
+        rng = random.Random(seed * 1000 + worker_index)
+        client = app_module.app.test_client()
+        local_latencies, local_errors = [], 0
+        while next(counter) < args.requests:
+            started = time.perf_counter()
+            try:
+                response = request_fn(client, rng)
+                failed = response.status_code >= 400
+            except Exception as e:
+                print(f"  ошибка: {e}")
+                failed = True
+            local_latencies.append(time.perf_counter() - started)
+            local_errors += failed
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(worker, range(args.clients)))
+    elapsed = time.perf_counter() - started
+
+    sql_after = histogram.snapshot(endpoint=endpoint)
+    requests_seen = sql_after["count"] - sql_before["count"]
+    latencies_ms = sorted(value * 1000 for value in latencies)
+    return {
+        "requests": len(latencies_ms),
+        "errors": sum(errors),
+        "throughput_rps": round(len(latencies_ms) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": round(_percentile(latencies_ms, 50), 3),
+            "p95": round(_percentile(latencies_ms, 95), 3),
+            "p99": round(_percentile(latencies_ms, 99), 3),
+            "mean": round(sum(latencies_ms) / len(latencies_ms), 3),
+            "max": round(latencies_ms[-1], 3),
+        },
+        "sql_queries_per_request": round((sql_after["sum"] - sql_before["sum"]) / requests_seen, 2) if requests_seen else None,
+    }
+
+
+# --- Отчёт ---
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=PROJECT_ROOT,
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _print_report(report, baseline=None):
+    print(f"{'Сценарий':<18}{'rps':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'SQL/запрос':>12}{'ошибки':>8}{'p95 к базе':>12}")
+    for name, result in report["scenarios"].items():
+        latency = result["latency_ms"]
+        delta = ''
+        base = (baseline or {}).get("scenarios", {}).get(name)
+        if base and base["latency_ms"]["p95"]:
+            delta = f"{(latency['p95'] / base['latency_ms']['p95'] - 1) * 100:+.0f}%"
+        sql = result["sql_queries_per_request"]
+        print(
+            f"{name:<18}{result['throughput_rps']:>9}{latency['p50']:>10.2f}{latency['p95']:>10.2f}"
+            f"{latency['p99']:>10.2f}{sql if sql is not None else '-':>12}{result['errors']:>8}{delta:>12}"
+        )
+
+
+def _regressions(report, baseline, max_regression):
+    found = []
+    for name, result in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base or not base["latency_ms"]["p95"]:
+            continue
+        growth = (result["latency_ms"]["p95"] / base["latency_ms"]["p95"] - 1) * 100
+        if growth > max_regression:
+            found.append(f"{name}: p95 {base['latency_ms']['p95']} -> {result['latency_ms']['p95']} мс ({growth:+.0f}%)")
+        base_sql, sql = base.get("sql_queries_per_request"), result.get("sql_queries_per_request")
+        if base_sql is not None and sql is not None and sql > base_sql:
+            found.append(f"{name}: SQL-запросов на запрос {base_sql} -> {sql}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lotteries', type=int, default=2000)
+    parser.add_argument('--movies-per-lottery', type=int, default=4)
+    parser.add_argument('--library', type=int, default=1000)
+    parser.add_argument('--torrents', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=8, help='параллельных клиентов')
+    parser.add_argument('--requests', type=int, default=200, help='запросов на сценарий')
+    parser.add_argument('--kinopoisk-queries', type=int, default=50, help='разных запросов в сценарии fetch_movie')
+    parser.add_argument('--kinopoisk-latency', type=float, default=0.05, help='задержка фейкового Кинопоиска, с')
+    parser.add_argument('--qbit-latency', type=float, default=0.002, help='задержка фейкового qBittorrent, с')
+    parser.add_argument('--scenarios', help='через запятую; по умолчанию все')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='куда записать JSON-отчёт')
+    parser.add_argument('--compare', help='JSON-отчёт предыдущего прогона')
+    parser.add_argument('--max-regression', type=float, default=20, help='допустимый рост p95, %%')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app_module = _load_app(Path(tmp) / 'bench.db', args)
+        with app_module.app.app_context():
+            app_module.db.create_all()
+            app_module.run_migrations()
+            undrawn, lottery_ids = _seed(app_module, args)
+
+        scenarios = _scenarios(undrawn, lottery_ids, args)
+        selected = args.scenarios.split(',') if args.scenarios else list(scenarios)
+        report = {
+            "meta": {
+                "revision": _git_revision(), "python": platform.python_version(),
+                "started_at": datetime.utcnow().isoformat() + "Z",
+                "params": {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            },
+            "scenarios": {},
+        }
+        for index, name in enumerate(selected):
+            endpoint, request_fn = scenarios[name]
+            print(f"Сценарий {name}...")
+            report["scenarios"][name] = _run_scenario(app_module, endpoint, request_fn, args, args.seed + index)
+
+    baseline = json.loads(Path(args.compare).read_text(encoding='utf-8')) if args.compare else None
+    _print_report(report, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+        print(f"Отчёт: {args.output}")
+    if baseline:
+        regressions = _regressions(report, baseline, args.max_regression)
+        for line in regressions:
+            print(f"Регрессия: {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
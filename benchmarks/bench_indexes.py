@@ -0,0 +1,122 @@
+"""
+Замер частых выборок до и после миграции с индексами.
+
+Создаёт временную SQLite-базу в «старой» схеме (без индексов), наполняет её
+данными, замеряет запросы, применяет run_migrations() и замеряет снова.
+
+    python benchmarks/bench_indexes.py --lotteries 20000 --library 5000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+def _load_app(db_path):
+    os.environ['DATABASE_URL'] = f"sqlite:///{db_path}"
+    os.environ['TORRENT_SYNC_ENABLED'] = '0'
+    if str(PROJECT_ROOT) not in sys.path:
+        sys.path.insert(0, str(PROJECT_ROOT))
+    import app
+    return app
+
+
+def _drop_hot_indexes(app_module):
+    db = app_module.db
+    migrated = {version for version, _, _ in app_module.MIGRATIONS}
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in app_module.HOT_LOOKUP_INDEXES:
+                    index.drop(connection)
+        connection.execute(app_module.SchemaMigration.__table__.delete().where(
+            app_module.SchemaMigration.version.in_(migrated)
+        ))
+
+
+def _seed(app_module, lotteries, library, movies_per_lottery=4):
+    db = app_module.db
+    rng = random.Random(42)
+    start = datetime(2020, 1, 1)
+    lottery_rows, movie_rows, library_rows, photo_rows = [], [], [], []
+    for index in range(lotteries):
+        lottery_id = f"{index:06x}"
+        lottery_rows.append({"id": lottery_id, "created_at": start + timedelta(minutes=rng.randint(0, 10 ** 6))})
+        for _ in range(movies_per_lottery):
+            kp_id = rng.randint(1, lotteries * 2)
+            movie_rows.append({"kinopoisk_id": kp_id, "name": f"Фильм {kp_id}", "year": "2000", "lottery_id": lottery_id})
+    for index in range(library):
+        library_rows.append({
+            "kinopoisk_id": 10 ** 7 + index, "name": f"Фильм {index}", "year": str(1950 + index % 70),
+            "added_at": start + timedelta(minutes=rng.randint(0, 10 ** 6)),
+        })
+    for index in range(min(library, 2000)):
+        photo_rows.append({
+            "poster_url": f"https://example.com/{index}.jpg", "pos_top": 10.0, "pos_left": 10.0,
+            "rotation": 0, "z_index": index, "added_at": start + timedelta(minutes=index),
+        })
+    with db.engine.begin() as connection:
+        connection.execute(app_module.Lottery.__table__.insert(), lottery_rows)
+        connection.execute(app_module.Movie.__table__.insert(), movie_rows)
+        connection.execute(app_module.LibraryMovie.__table__.insert(), library_rows)
+        connection.execute(app_module.BackgroundPhoto.__table__.insert(), photo_rows)
+
+
+def _lookups(app_module, lotteries):
+    Lottery, Movie = app_module.Lottery, app_module.Movie
+    LibraryMovie, BackgroundPhoto = app_module.LibraryMovie, app_module.BackgroundPhoto
+    rng = random.Random(7)
+    return {
+        "Movie по kinopoisk_id": lambda: Movie.query.filter_by(kinopoisk_id=rng.randint(1, lotteries * 2)).order_by(Movie.id.desc()).first(),
+        "Movie по lottery_id": lambda: Movie.query.filter_by(lottery_id=f"{rng.randrange(lotteries):06x}").all(),
+        "Страница истории": lambda: app_module._keyset_page(Lottery.query, Lottery.created_at, Lottery.id, None, 24),
+        "LibraryMovie по (name, year)": lambda: LibraryMovie.query.filter_by(name=f"Фильм {rng.randrange(1000)}", year="1960").first(),
+        "Последние фоновые фото": lambda: BackgroundPhoto.query.order_by(BackgroundPhoto.added_at.desc()).limit(20).all(),
+    }
+
+
+def _measure(app_module, lotteries, repeat):
+    results = {}
+    for name, lookup in _lookups(app_module, lotteries).items():
+        lookup()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            lookup()
+        results[name] = (time.perf_counter() - started) / repeat * 1000
+        app_module.db.session.rollback()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lotteries', type=int, default=20000)
+    parser.add_argument('--library', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app_module = _load_app(Path(tmp) / 'bench.db')
+        with app_module.app.app_context():
+            app_module.db.create_all()
+            _drop_hot_indexes(app_module)
+            _seed(app_module, args.lotteries, args.library)
+
+            before = _measure(app_module, args.lotteries, args.repeat)
+            applied = app_module.run_migrations()
+            after = _measure(app_module, args.lotteries, args.repeat)
+
+    print(f"Лотерей: {args.lotteries}, фильмов в библиотеке: {args.library}, миграции: {applied}")
+    print(f"{'Запрос':<32}{'до, мс':>10}{'после, мс':>12}{'ускорение':>12}")
+    for name in before:
+        speedup = before[name] / after[name] if after[name] else float('inf')
+        print(f"{name:<32}{before[name]:>10.3f}{after[name]:>12.3f}{speedup:>11.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# Настройки gunicorn; файл подхватывается автоматически при запуске из этой
+# папки: gunicorn app:app
+#
+# /api/events и /api/results?wait= держат запрос открытым до
+# EVENT_STREAM_MAX_DURATION и RESULTS_LONG_POLL_MAX секунд. Синхронный
+# воркер обслуживает один запрос за раз, и каждая открытая вкладка истории,
+# библиотеки или ожидания занимала бы целый процесс. Воркер gthread отдаёт
+# такие запросы отдельным потокам, а обычные маршруты обслуживают остальные.
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', str(min(multiprocessing.cpu_count(), 4))))
+worker_class = 'gthread'
+# Потоков на воркер: открытые вкладки плюс запас на обычные запросы
+threads = int(os.environ.get('GUNICORN_THREADS', '32'))
+# Для gthread timeout - срок ответа воркера мастеру, а не длительность запроса
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+# Потоки событий при остановке не дожидаются конца EVENT_STREAM_MAX_DURATION
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '10'))
@@ -15,7 +15,7 @@ document.addEventListener('DOMContentLoaded', () => {
             div.className = 'bg-image';
             
             // Устанавливаем все стили напрямую из данных, полученных от сервера
-            div.style.backgroundImage = `url(${photo.poster_url})`;
+            div.style.backgroundImage = `url("/poster/collage?url=${encodeURIComponent(photo.poster_url)}")`;
             div.style.top = `${photo.pos_top}%`;
             div.style.left = `${photo.pos_left}%`;
             div.style.zIndex = photo.z_index;
@@ -26,8 +26,11 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     };
 
-    // Проверяем, передал ли сервер данные для фона в глобальной переменной
-    if (typeof backgroundPhotos !== 'undefined' && Array.isArray(backgroundPhotos)) {
-        renderStaticBackground(backgroundPhotos);
-    }
+    // Набор фото отдаёт сервер; ответ кэшируется браузером и проверяется по ETag
+    fetch('/api/background-photos')
+        .then(response => (response.ok ? response.json() : null))
+        .then(data => {
+            if (data && Array.isArray(data.photos)) renderStaticBackground(data.photos);
+        })
+        .catch(error => console.error('Не удалось загрузить фон:', error));
 });
\ No newline at end of file
@@ -13,11 +13,18 @@ document.addEventListener('DOMContentLoaded', () => {
     const widgetToggleBtn = widget ? widget.querySelector('#widget-toggle-btn') : null;
     const widgetDownloadsContainer = widget ? widget.querySelector('#widget-downloads') : null;
     const widgetEmptyText = widget ? widget.querySelector('.widget-empty') : null;
+    const widgetStaleNotice = widget ? widget.querySelector('.widget-stale') : null;
 
     const ACTIVE_DOWNLOADS_KEY = 'lotteryActiveDownloads';
     const placeholderPoster = 'https://via.placeholder.com/200x300.png?text=No+Image';
-
-    const pollIntervals = new Map();
+    // Постеры идут через локальный прокси с уменьшенными копиями (см. /poster/<variant>)
+    const posterUrl = (url, variant = 'card') => (url ? `/poster/${variant}?url=${encodeURIComponent(url)}` : '');
+
+    const STATUS_POLL_INTERVAL = 3000;
+    const trackedStatuses = new Map();
+    let statusPollTimer = null;
+    let statusPollScheduled = false;
+    let eventsConnected = false;
     const activeDownloads = new Map();
     const waitingCards = new Map();
     let currentModalLotteryId = null;
@@ -122,7 +129,14 @@ document.addEventListener('DOMContentLoaded', () => {
                     <span class="speed-text">0.00 МБ/с</span>
                     <span class="eta-text">--:--</span>
                 </div>
-                <div class="widget-stats-bottom"><span class="peers-text">Сиды: 0 / Пиры: 0</span></div>`;
+                <div class="widget-stats-bottom">
+                    <span class="peers-text">Сиды: 0 / Пиры: 0</span>
+                    <a class="widget-watch-link" target="_blank" rel="noopener">Смотреть</a>
+                </div>`;
+            // Файл можно смотреть, не дожидаясь конца загрузки: сервер отдаёт уже скачанные куски
+            item.querySelector('.widget-watch-link').href = normalizeId(kinopoiskId)
+                ? `/api/stream/kp/${encodeURIComponent(normalizeId(kinopoiskId))}`
+                : `/api/stream/${encodeURIComponent(normalizeId(lotteryId))}`;
             widgetDownloadsContainer.appendChild(item);
         }
         return item;
@@ -165,10 +179,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const removeDownload = (lotteryId, kinopoiskId) => {
         const key = resolveDownloadKey(lotteryId, kinopoiskId);
         if (!key) return;
-        if (pollIntervals.has(key)) {
-            clearInterval(pollIntervals.get(key));
-            pollIntervals.delete(key);
-        }
+        stopStatusPolling(key);
         if (activeDownloads.has(key)) {
             activeDownloads.delete(key);
             saveActiveDownloads();
@@ -192,6 +203,15 @@ document.addEventListener('DOMContentLoaded', () => {
         const peersText = element.querySelector('.peers-text');
 
         if (data.name && title) title.textContent = `Загрузка: ${data.name}`;
+        if (data.status === 'queued') {
+            // Загрузка ждёт свободного места в планировщике
+            if (progressText) progressText.textContent = 'В очереди';
+            if (speedText) speedText.textContent = '-';
+            if (etaText) etaText.textContent = '-';
+            if (peersText) peersText.textContent = data.queue_position ? `Место в очереди: ${data.queue_position}` : 'Ожидает запуска';
+            if (bar) bar.style.width = '0%';
+            return;
+        }
         if (data.status === 'error' || data.status === 'not_found') {
             if (progressText) progressText.textContent = data.status === 'error' ? 'Ошибка' : 'Ожидание...';
             if (speedText) speedText.textContent = '-';
@@ -204,7 +224,8 @@ document.addEventListener('DOMContentLoaded', () => {
         const progressValue = Number.parseFloat(data.progress) || 0;
         if (bar) bar.style.width = `${Math.min(100, Math.max(0, progressValue))}%`;
         if (progressText) progressText.textContent = `${progressValue.toFixed(0)}%`;
-        const speedValue = typeof data.speed === 'number' ? data.speed.toFixed(2) : data.speed;
+        const rawSpeed = data.speed_mbps ?? data.speed;
+        const speedValue = typeof rawSpeed === 'number' ? rawSpeed.toFixed(2) : rawSpeed;
         if (speedText) speedText.textContent = speedValue ? `${speedValue} МБ/с` : '0.00 МБ/с';
         if (etaText) etaText.textContent = data.eta || '--:--';
         if (peersText) peersText.textContent = `Сиды: ${data.seeds ?? 0} / Пиры: ${data.peers ?? 0}`;
@@ -220,52 +241,104 @@ document.addEventListener('DOMContentLoaded', () => {
         setTimeout(() => removeDownload(lotteryId, kinopoiskId), 5000);
     };
 
+    // Все отслеживаемые загрузки опрашиваются одним таймером и одним
+    // запросом к /api/download-status/batch.
+    const stopStatusPolling = (key) => {
+        trackedStatuses.delete(key);
+        if (!trackedStatuses.size && statusPollTimer) {
+            clearInterval(statusPollTimer);
+            statusPollTimer = null;
+        }
+    };
+
+    // Пометка в виджете, что qBittorrent не отвечает и показан последний известный снимок.
+    const updateStaleNotice = (payload) => {
+        if (!widgetStaleNotice || !payload) return;
+        const qbit = payload.qbittorrent || {};
+        if (!payload.stale) {
+            widgetStaleNotice.style.display = 'none';
+            return;
+        }
+        let text = 'qBittorrent не отвечает — показаны последние известные данные.';
+        if (qbit.state === 'open' && qbit.retry_in) text += ` Повтор через ${Math.ceil(qbit.retry_in)} с.`;
+        widgetStaleNotice.textContent = text;
+        widgetStaleNotice.style.display = 'block';
+    };
+
+    const applyStatusUpdate = (key, entry, data) => {
+        const { lotteryId, kinopoiskId, useKinopoiskStatus } = entry;
+        if (data.stale && data.status === 'error') {
+            // Данных в снимке нет, но связь может вернуться: продолжаем опрос.
+            updateDownloadView(lotteryId, kinopoiskId, data);
+            return;
+        }
+        if (data.status === 'error' || (data.status === 'not_found' && useKinopoiskStatus)) {
+            updateDownloadView(lotteryId, kinopoiskId, data);
+            stopStatusPolling(key);
+            if (data.status === 'not_found') removeDownload(lotteryId, kinopoiskId);
+            return;
+        }
+
+        updateDownloadView(lotteryId, kinopoiskId, data);
+        const progressValue = Number.parseFloat(data.progress) || 0;
+        const statusText = (data.status || '').toLowerCase();
+        if (progressValue >= 100 || statusText.includes('seeding') || statusText.includes('completed')) {
+            stopStatusPolling(key);
+            markDownloadCompleted(lotteryId, kinopoiskId);
+        }
+    };
+
+    const pollTrackedStatuses = async () => {
+        statusPollScheduled = false;
+        if (!trackedStatuses.size) return;
+        const entries = Array.from(trackedStatuses.entries());
+        const request = { kinopoisk_ids: [], lottery_ids: [] };
+        entries.forEach(([, entry]) => {
+            if (entry.useKinopoiskStatus && entry.kinopoiskId) request.kinopoisk_ids.push(entry.kinopoiskId);
+            else if (entry.lotteryId) request.lottery_ids.push(entry.lotteryId);
+        });
+
+        try {
+            const response = await fetch('/api/download-status/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(request),
+            });
+            if (!response.ok) throw new Error('Сервер вернул ошибку статуса');
+            const payload = await response.json();
+            updateStaleNotice(payload);
+            entries.forEach(([key, entry]) => {
+                if (trackedStatuses.get(key) !== entry) return;
+                const data = entry.useKinopoiskStatus && entry.kinopoiskId
+                    ? (payload.kinopoisk || {})[entry.kinopoiskId]
+                    : (payload.lotteries || {})[entry.lotteryId];
+                applyStatusUpdate(key, entry, data || { status: 'not_found' });
+            });
+        } catch (error) {
+            console.error('Ошибка при опросе статуса торрентов:', error);
+            entries.forEach(([key, entry]) => {
+                updateDownloadView(entry.lotteryId, entry.kinopoiskId, { status: 'error', message: 'Нет связи с qBittorrent' });
+                stopStatusPolling(key);
+            });
+        }
+    };
+
+    const scheduleStatusPoll = () => {
+        if (statusPollScheduled) return;
+        statusPollScheduled = true;
+        setTimeout(pollTrackedStatuses, 0);
+    };
+
     const startTorrentStatusPolling = (lotteryId, movieName, kinopoiskId, { skipRegister = false, useKinopoiskStatus = false } = {}) => {
         const key = getDownloadKey(lotteryId, kinopoiskId);
         if (!key) return;
         if (!skipRegister) registerDownload(lotteryId, movieName, kinopoiskId);
-        if (pollIntervals.has(key)) clearInterval(pollIntervals.get(key));
+        const current = trackedStatuses.get(key);
+        if (current && current.useKinopoiskStatus === useKinopoiskStatus) return;
 
-        const poll = async () => {
-            try {
-                let response, data;
-                if (useKinopoiskStatus && kinopoiskId) {
-                    response = await fetch(`/api/download-status/${kinopoiskId}`);
-                } else if (lotteryId) {
-                    response = await fetch(`/api/torrent-status/${lotteryId}`);
-                } else {
-                    return;
-                }
-                if (!response.ok) throw new Error('Сервер вернул ошибку статуса');
-                data = await response.json();
-
-                if (data.status === 'error' || (data.status === 'not_found' && useKinopoiskStatus)) {
-                    updateDownloadView(lotteryId, kinopoiskId, data);
-                    clearInterval(pollIntervals.get(key));
-                    pollIntervals.delete(key);
-                    if (data.status === 'not_found') removeDownload(lotteryId, kinopoiskId);
-                    return;
-                }
-
-                updateDownloadView(lotteryId, kinopoiskId, data);
-                const progressValue = Number.parseFloat(data.progress) || 0;
-                const statusText = (data.status || '').toLowerCase();
-                if (progressValue >= 100 || statusText.includes('seeding') || statusText.includes('completed')) {
-                    clearInterval(pollIntervals.get(key));
-                    pollIntervals.delete(key);
-                    markDownloadCompleted(lotteryId, kinopoiskId);
-                }
-            } catch (error) {
-                console.error('Ошибка при опросе статуса торрента:', error);
-                updateDownloadView(lotteryId, kinopoiskId, { status: 'error', message: 'Нет связи с qBittorrent' });
-                if (pollIntervals.has(key)) {
-                    clearInterval(pollIntervals.get(key));
-                    pollIntervals.delete(key);
-                }
-            }
-        };
-        poll();
-        pollIntervals.set(key, setInterval(poll, 3000));
+        trackedStatuses.set(key, { lotteryId, kinopoiskId, useKinopoiskStatus });
+        if (!statusPollTimer && !eventsConnected) statusPollTimer = setInterval(pollTrackedStatuses, STATUS_POLL_INTERVAL);
+        scheduleStatusPoll();
     };
 
     const initializeStoredDownloads = () => {
@@ -283,8 +356,10 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/api/active-downloads');
             if (!response.ok) return;
             const payload = await response.json();
+            updateStaleNotice(payload);
             const downloads = Array.isArray(payload.downloads) ? payload.downloads : [];
-            downloads.forEach((item) => {
+            const queued = Array.isArray(payload.queued) ? payload.queued : [];
+            downloads.concat(queued).forEach((item) => {
                 const kinopoiskId = item.kinopoisk_id ? String(item.kinopoisk_id) : '';
                 if (!kinopoiskId) return;
                 const card = gallery.querySelector(`.gallery-item[data-kinopoisk-id="${kinopoiskId}"]`);
@@ -324,15 +399,19 @@ document.addEventListener('DOMContentLoaded', () => {
         item.dataset.movieCountries = winner.countries || '';
         item.dataset.hasMagnet = winner.has_magnet ? 'true' : 'false';
         item.dataset.magnetLink = winner.magnet_link || '';
+        item.dataset.isOnClient = winner.is_on_client ? 'true' : 'false';
+        item.dataset.torrentHash = winner.torrent_hash || '';
+        if (winner.is_on_client) item.classList.add('has-torrent-on-client');
 
         item.innerHTML = `
+            <div class="torrent-status-indicator"></div>
             <div class="action-buttons">
                 <button type="button" class="icon-button download-button"><svg class="icon-svg icon-download" viewBox="0 0 24 24"><use href="#icon-download"></use></svg></button>
                 <button type="button" class="icon-button search-button"><svg class="icon-svg icon-search" viewBox="0 0 24 24"><use href="#icon-search"></use></svg></button>
                 <button type="button" class="icon-button delete-button"><svg class="icon-svg icon-delete" viewBox="0 0 24 24"><use href="#icon-delete"></use></svg></button>
             </div>
             <div class="date-badge" data-date="${escapeAttr(createdAtIso)}"></div>
-            <img src="${escapeAttr(winner.poster || placeholderPoster)}" alt="${escapeHtml(winner.name)}">`;
+            <img src="${escapeAttr(posterUrl(winner.poster) || placeholderPoster)}" alt="${escapeHtml(winner.name)}" loading="lazy">`;
         
         const downloadBtn = item.querySelector('.download-button');
         const searchBtn = item.querySelector('.search-button');
@@ -341,32 +420,216 @@ document.addEventListener('DOMContentLoaded', () => {
         return item;
     };
 
-    const pollWaitingCards = async () => {
-        if (!waitingCards.size) return;
-        for (const [lotteryId, cardElement] of waitingCards.entries()) {
-            try {
-                const data = await fetchLotteryDetails(lotteryId);
-                if (data.result) {
-                    const newCard = createCompletedCard(lotteryId, data.result, data.createdAt);
-                    cardElement.replaceWith(newCard);
-                    waitingCards.delete(lotteryId);
-                    formatDateBadges();
-                }
-            } catch (error) {
-                console.error(`Не удалось обновить лотерею ${lotteryId}:`, error);
+    const createWaitingCard = (lotteryId, createdAtIso) => {
+        const item = document.createElement('div');
+        item.className = 'gallery-item waiting-card';
+        item.dataset.lotteryId = lotteryId;
+        item.innerHTML = `
+            <div class="action-buttons">
+                <button type="button" class="icon-button delete-button" title="Удалить лотерею" aria-label="Удалить лотерею"><svg class="icon-svg icon-delete" viewBox="0 0 24 24"><use href="#icon-delete"></use></svg></button>
+            </div>
+            <div class="waiting-content">
+                <div class="loader-small"></div>
+                <span>Ожидает<br>розыгрыша</span>
+            </div>
+            <div class="date-badge" data-date="${escapeAttr(createdAtIso)}"></div>`;
+        return item;
+    };
+
+    const refreshWaitingCard = async (lotteryId, cardElement) => {
+        try {
+            const data = await fetchLotteryDetails(lotteryId);
+            if (data.result && waitingCards.get(lotteryId) === cardElement) {
+                const newCard = createCompletedCard(lotteryId, data.result, data.createdAt);
+                cardElement.replaceWith(newCard);
                 waitingCards.delete(lotteryId);
+                formatDateBadges();
+            }
+        } catch (error) {
+            console.error(`Не удалось обновить лотерею ${lotteryId}:`, error);
+            waitingCards.delete(lotteryId);
+        }
+    };
+
+    // Состояние всех ожидающих лотерей одним запросом; полные данные
+    // (/api/result) запрашиваются только для уже разыгранных.
+    const pollWaitingCards = async (waitSeconds = 0) => {
+        if (!waitingCards.size) return true;
+        const params = new URLSearchParams({ ids: [...waitingCards.keys()].join(',') });
+        if (waitSeconds) params.set('wait', waitSeconds);
+        try {
+            const response = await fetch(`/api/results?${params}`);
+            if (!response.ok) throw new Error('Ошибка сети');
+            const data = await response.json();
+            data.missing.forEach((lotteryId) => waitingCards.delete(lotteryId));
+            for (const lotteryId of Object.keys(data.drawn)) {
+                const cardElement = waitingCards.get(lotteryId);
+                if (cardElement) await refreshWaitingCard(lotteryId, cardElement);
+            }
+            return true;
+        } catch (error) {
+            console.error('Не удалось проверить ожидающие лотереи:', error);
+            return false;
+        }
+    };
+
+    // Пока открыт поток событий, розыгрыши приходят через него; иначе
+    // держим long-poll запрос, который сервер отпускает при розыгрыше.
+    const WAITING_LONG_POLL = 25;
+    const WAITING_RETRY_DELAY = 5000;
+    let waitingPollerActive = false;
+    const startWaitingPoller = async () => {
+        if (waitingPollerActive || !waitingCards.size) return;
+        waitingPollerActive = true;
+        let ok = await pollWaitingCards();
+        while (waitingCards.size) {
+            if (eventsConnected || !ok) {
+                await new Promise((resolve) => setTimeout(resolve, WAITING_RETRY_DELAY));
+                ok = true;
+                continue;
             }
+            ok = await pollWaitingCards(WAITING_LONG_POLL);
         }
+        waitingPollerActive = false;
+    };
+
+
+    // --- ПОДГРУЗКА СЛЕДУЮЩИХ СТРАНИЦ ---
+    // Сервер отдаёт историю страницами по курсору, следующие карточки
+    // дорисовываются на клиенте, когда пользователь докручивает до конца.
+
+    const sentinel = document.querySelector('.gallery-sentinel');
+    let nextCursor = gallery ? gallery.dataset.nextCursor || '' : '';
+    let pageLoading = false;
+    let pageObserver = null;
+
+    const appendHistoryItem = (item) => {
+        if (gallery.querySelector(`.gallery-item[data-lottery-id="${item.id}"]`)) return;
+        if (item.result) {
+            gallery.appendChild(createCompletedCard(item.id, item.result, item.created_at));
+        } else {
+            const card = createWaitingCard(item.id, item.created_at);
+            gallery.appendChild(card);
+            waitingCards.set(item.id, card);
+        }
+    };
+
+    const sentinelIsNearViewport = () => sentinel && sentinel.getBoundingClientRect().top < window.innerHeight + 600;
+
+    const loadNextPage = async () => {
+        if (!nextCursor || pageLoading) return;
+        pageLoading = true;
+        try {
+            const response = await fetch(`/api/history?cursor=${encodeURIComponent(nextCursor)}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const data = await response.json();
+            (data.items || []).forEach(appendHistoryItem);
+            nextCursor = data.next_cursor || '';
+            formatDateBadges();
+            startWaitingPoller();
+        } catch (error) {
+            console.error('Не удалось загрузить следующую страницу истории:', error);
+            return;
+        } finally {
+            pageLoading = false;
+        }
+        if (!nextCursor) {
+            if (pageObserver) pageObserver.disconnect();
+        } else if (sentinelIsNearViewport()) {
+            // Страница не заполнила экран - наблюдатель сам не сработает ещё раз
+            loadNextPage();
+        }
+    };
+
+    const initInfiniteScroll = () => {
+        if (!gallery || !sentinel || !nextCursor) return;
+        if ('IntersectionObserver' in window) {
+            pageObserver = new IntersectionObserver((entries) => {
+                if (entries.some(entry => entry.isIntersecting)) loadNextPage();
+            }, { rootMargin: '600px 0px' });
+            pageObserver.observe(sentinel);
+        } else {
+            window.addEventListener('scroll', () => { if (sentinelIsNearViewport()) loadNextPage(); }, { passive: true });
+            if (sentinelIsNearViewport()) loadNextPage();
+        }
+    };
+
+
+    // --- ПОТОК СОБЫТИЙ (SSE) ---
+    // Пока поток открыт, прогресс загрузок и результаты розыгрышей приходят
+    // с сервера сами, а опрос по таймерам приостанавливается.
+
+    const handleTorrentEvent = (data) => {
+        const kinopoiskId = data.kinopoisk_id ? String(data.kinopoisk_id) : '';
+        let handled = false;
+        trackedStatuses.forEach((entry, key) => {
+            const matches = entry.useKinopoiskStatus && entry.kinopoiskId
+                ? kinopoiskId === String(entry.kinopoiskId)
+                : data.category === `lottery-${entry.lotteryId}`;
+            if (matches) {
+                handled = true;
+                applyStatusUpdate(key, entry, data);
+            }
+        });
+        if (handled || !kinopoiskId || data.status === 'not_found' || !gallery || !widget) return;
+        const card = gallery.querySelector(`.gallery-item[data-kinopoisk-id="${kinopoiskId}"]`);
+        if (!card) return;
+        const { lotteryId } = card.dataset;
+        const movieName = card.dataset.movieName || data.name;
+        registerDownload(lotteryId, movieName, kinopoiskId);
+        startTorrentStatusPolling(lotteryId, movieName, kinopoiskId, { skipRegister: true, useKinopoiskStatus: true });
+    };
+
+    const setEventsConnected = (connected) => {
+        eventsConnected = connected;
+        if (connected && statusPollTimer) {
+            clearInterval(statusPollTimer);
+            statusPollTimer = null;
+        } else if (!connected && !statusPollTimer && trackedStatuses.size) {
+            statusPollTimer = setInterval(pollTrackedStatuses, STATUS_POLL_INTERVAL);
+        }
+    };
+
+    const connectEvents = () => {
+        if (!window.EventSource) return;
+        const source = new EventSource('/api/events?types=torrent,lottery_drawn,resync');
+        source.addEventListener('open', () => {
+            setEventsConnected(true);
+            scheduleStatusPoll();
+        });
+        source.addEventListener('error', () => setEventsConnected(false));
+        source.addEventListener('torrent', (event) => {
+            const data = safeJsonParse(event.data);
+            if (data) handleTorrentEvent(data);
+        });
+        source.addEventListener('lottery_drawn', (event) => {
+            const data = safeJsonParse(event.data);
+            const cardElement = data ? waitingCards.get(data.lottery_id) : null;
+            if (cardElement) refreshWaitingCard(data.lottery_id, cardElement);
+        });
+        source.addEventListener('resync', () => {
+            scheduleStatusPoll();
+            pollWaitingCards();
+            syncExternalDownloads();
+        });
     };
 
 
     // --- ЛОГИКА МОДАЛЬНОГО ОКНА И ДЕЙСТВИЙ ---
 
+    // Последний ответ по каждой лотерее вместе с ETag: повторный запрос
+    // условный, и на 304 используется уже полученный ответ.
+    const lotteryDetailsCache = new Map();
     const fetchLotteryDetails = async (lotteryId) => {
-        const response = await fetch(`/api/result/${lotteryId}`);
+        const cached = lotteryDetailsCache.get(lotteryId);
+        const headers = cached ? { 'If-None-Match': cached.etag } : {};
+        const response = await fetch(`/api/result/${lotteryId}`, { headers, cache: 'no-store' });
+        if (response.status === 304 && cached) return cached.data;
         if (!response.ok) throw new Error('Ошибка сети');
         const data = await response.json();
         if(data.error) throw new Error(data.error);
+        const etag = response.headers.get('ETag');
+        if (etag) lotteryDetailsCache.set(lotteryId, { etag, data });
         return data;
     };
 
@@ -376,6 +639,28 @@ document.addEventListener('DOMContentLoaded', () => {
         window.open(`https://rutracker.org/forum/tracker.php?nm=${query}`, '_blank');
     };
     
+    // Операции с qBittorrent сервер выполняет в фоне и возвращает id задачи;
+    // если задача в итоге не удалась, сообщаем об этом отдельно
+    const watchJob = (jobId, onFailed) => {
+        if (!jobId) return;
+        const check = async () => {
+            try {
+                const response = await fetch(`/api/jobs/${jobId}`);
+                if (!response.ok) return;
+                const job = await response.json();
+                if (job.status === 'failed') {
+                    showToast(`Ошибка qBittorrent: ${job.error}`, 'error');
+                    if (onFailed) onFailed(job);
+                } else if (job.status !== 'done') {
+                    setTimeout(check, 2000);
+                }
+            } catch (error) {
+                setTimeout(check, 5000);
+            }
+        };
+        setTimeout(check, 1000);
+    };
+
     const handleDownloadClick = async (kinopoiskId, movieName, lotteryId) => {
         if (!kinopoiskId) {
             showToast('Сначала добавьте magnet-ссылку для этого фильма.', 'warning');
@@ -388,7 +673,8 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await response.json();
             if (data.success) {
                 startTorrentStatusPolling(lotteryId, movieName, kinopoiskId, { skipRegister: true });
-                showToast('Загрузка началась.', 'success');
+                showToast(data.message || 'Загрузка началась.', 'success');
+                if (data.status !== 'done') watchJob(data.job_id, () => removeDownload(lotteryId, kinopoiskId));
             } else {
                 showToast(`Ошибка: ${data.message}`, 'error');
                 removeDownload(lotteryId, kinopoiskId);
@@ -445,7 +731,7 @@ document.addEventListener('DOMContentLoaded', () => {
         modalParticipantsList.innerHTML = movies.map(movie => {
             const isWinner = movie.name === winnerName;
             return `<li class="participant-item ${isWinner ? 'winner' : ''}">
-                <img class="participant-poster" src="${escapeAttr(movie.poster || placeholderPoster)}" alt="${escapeAttr(movie.name)}">
+                <img class="participant-poster" src="${escapeAttr(posterUrl(movie.poster) || placeholderPoster)}" alt="${escapeAttr(movie.name)}">
                 <span class="participant-name">${escapeHtml(movie.name)}</span>
                 <span class="participant-meta">${escapeHtml(movie.year || '')}</span>
                 ${isWinner ? '<span class="participant-winner-badge">Победитель</span>' : ''}
@@ -461,7 +747,7 @@ document.addEventListener('DOMContentLoaded', () => {
         modalWinnerInfo.innerHTML = `
             <div class="winner-card">
                 <div class="winner-poster">
-                    <img src="${escapeAttr(winner.poster || placeholderPoster)}" alt="Постер ${escapeAttr(winner.name)}">
+                    <img src="${escapeAttr(posterUrl(winner.poster, 'modal') || placeholderPoster)}" alt="Постер ${escapeAttr(winner.name)}">
                     ${ratingBadgeHtml}
                 </div>
                 <div class="winner-details">
@@ -516,6 +802,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await response.json();
             showToast(data.message, data.success ? 'success' : 'error');
             if (data.success) {
+                if (data.status !== 'done') watchJob(data.job_id);
                 cardElement.classList.add('is-deleting');
                 removeDownload(lotteryId, cardElement.dataset.kinopoiskId);
                 cardElement.addEventListener('transitionend', () => cardElement.remove());
@@ -554,6 +841,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await response.json();
             showToast(data.message, data.success ? 'success' : 'error');
             if (data.success) {
+                if (data.status !== 'done') watchJob(data.job_id);
                 sliderContainer.classList.add('disabled');
                 const card = gallery.querySelector(`.gallery-item[data-torrent-hash="${torrentHash}"]`);
                 if (card) {
@@ -678,19 +966,14 @@ document.addEventListener('DOMContentLoaded', () => {
     initializeCardStates();
     formatDateBadges();
     collectWaitingCards();
-    if (waitingCards.size) {
-        const poller = () => pollWaitingCards();
-        poller();
-        const intervalId = setInterval(() => {
-            if (waitingCards.size === 0) clearInterval(intervalId);
-            else poller();
-        }, 5000);
-    }
+    startWaitingPoller();
+    initInfiniteScroll();
     initializeStoredDownloads();
     ensureWidgetState();
     syncExternalDownloads();
+    connectEvents();
     if (widget) {
-        setInterval(syncExternalDownloads, 5000);
+        setInterval(() => { if (!eventsConnected) syncExternalDownloads(); }, 5000);
         window.addEventListener('focus', syncExternalDownloads);
     }
 });
\ No newline at end of file
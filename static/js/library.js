@@ -7,16 +7,23 @@ document.addEventListener('DOMContentLoaded', () => {
     const closeButton = modalOverlay ? modalOverlay.querySelector('.close-button') : null;
     const emptyMessage = document.querySelector('.library-empty-message');
     const placeholderPoster = 'https://via.placeholder.com/200x300.png?text=No+Image';
+    // Постеры идут через локальный прокси с уменьшенными копиями (см. /poster/<variant>)
+    const posterUrl = (url, variant = 'card') => (url ? `/poster/${variant}?url=${encodeURIComponent(url)}` : '');
 
     const widget = document.getElementById('torrent-status-widget');
     const widgetHeader = widget ? widget.querySelector('.widget-header') : null;
     const widgetToggleBtn = widget ? widget.querySelector('#widget-toggle-btn') : null;
     const widgetDownloadsContainer = widget ? widget.querySelector('#widget-downloads') : null;
     const widgetEmptyText = widget ? widget.querySelector('.widget-empty') : null;
+    const widgetStaleNotice = widget ? widget.querySelector('.widget-stale') : null;
 
     const ACTIVE_DOWNLOADS_KEY = 'libraryActiveDownloads';
 
-    const pollIntervals = new Map();
+    const STATUS_POLL_INTERVAL = 3000;
+    const trackedStatuses = new Map();
+    let statusPollTimer = null;
+    let statusPollScheduled = false;
+    let eventsConnected = false;
     const activeDownloads = new Map();
 
     const getDownloadKey = (movieId, kinopoiskId) => {
@@ -115,7 +122,14 @@ document.addEventListener('DOMContentLoaded', () => {
                     <span class="speed-text">0.00 МБ/с</span>
                     <span class="eta-text">--:--</span>
                 </div>
-                <div class="widget-stats-bottom"><span class="peers-text">Сиды: 0 / Пиры: 0</span></div>`;
+                <div class="widget-stats-bottom">
+                    <span class="peers-text">Сиды: 0 / Пиры: 0</span>
+                    <a class="widget-watch-link" target="_blank" rel="noopener">Смотреть</a>
+                </div>`;
+            // Файл можно смотреть, не дожидаясь конца загрузки: сервер отдаёт уже скачанные куски
+            item.querySelector('.widget-watch-link').href = normalizeId(kinopoiskId)
+                ? `/api/stream/kp/${encodeURIComponent(normalizeId(kinopoiskId))}`
+                : `/api/library/stream/${encodeURIComponent(normalizeId(movieId))}`;
             widgetDownloadsContainer.appendChild(item);
         }
         return item;
@@ -158,10 +172,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const removeDownload = (movieId, kinopoiskId) => {
         const key = resolveDownloadKey(movieId, kinopoiskId);
         if (!key) return;
-        if (pollIntervals.has(key)) {
-            clearInterval(pollIntervals.get(key));
-            pollIntervals.delete(key);
-        }
+        stopStatusPolling(key);
         if (activeDownloads.has(key)) {
             activeDownloads.delete(key);
             saveActiveDownloads();
@@ -187,6 +198,15 @@ document.addEventListener('DOMContentLoaded', () => {
         const peersText = element.querySelector('.peers-text');
 
         if (data.name && title) title.textContent = `Загрузка: ${data.name}`;
+        if (data.status === 'queued') {
+            // Загрузка ждёт свободного места в планировщике
+            if (progressText) progressText.textContent = 'В очереди';
+            if (speedText) speedText.textContent = '-';
+            if (etaText) etaText.textContent = '-';
+            if (peersText) peersText.textContent = data.queue_position ? `Место в очереди: ${data.queue_position}` : 'Ожидает запуска';
+            if (bar) bar.style.width = '0%';
+            return;
+        }
         if (data.status === 'error' || data.status === 'not_found') {
             if (progressText) progressText.textContent = data.status === 'error' ? 'Ошибка' : 'Ожидание...';
             if (speedText) speedText.textContent = '-';
@@ -216,53 +236,104 @@ document.addEventListener('DOMContentLoaded', () => {
         setTimeout(() => removeDownload(movieId, kinopoiskId), 5000);
     };
 
+    // Все отслеживаемые загрузки опрашиваются одним таймером и одним
+    // запросом к /api/download-status/batch.
+    const stopStatusPolling = (key) => {
+        trackedStatuses.delete(key);
+        if (!trackedStatuses.size && statusPollTimer) {
+            clearInterval(statusPollTimer);
+            statusPollTimer = null;
+        }
+    };
+
+    // Пометка в виджете, что qBittorrent не отвечает и показан последний известный снимок.
+    const updateStaleNotice = (payload) => {
+        if (!widgetStaleNotice || !payload) return;
+        const qbit = payload.qbittorrent || {};
+        if (!payload.stale) {
+            widgetStaleNotice.style.display = 'none';
+            return;
+        }
+        let text = 'qBittorrent не отвечает — показаны последние известные данные.';
+        if (qbit.state === 'open' && qbit.retry_in) text += ` Повтор через ${Math.ceil(qbit.retry_in)} с.`;
+        widgetStaleNotice.textContent = text;
+        widgetStaleNotice.style.display = 'block';
+    };
+
+    const applyStatusUpdate = (key, entry, data) => {
+        const { movieId, kinopoiskId, useKinopoiskStatus } = entry;
+        if (data.stale && data.status === 'error') {
+            // Данных в снимке нет, но связь может вернуться: продолжаем опрос.
+            updateDownloadView(movieId, kinopoiskId, data);
+            return;
+        }
+        if (data.status === 'error' || (data.status === 'not_found' && useKinopoiskStatus)) {
+            updateDownloadView(movieId, kinopoiskId, data);
+            stopStatusPolling(key);
+            if (data.status === 'not_found') removeDownload(movieId, kinopoiskId);
+            return;
+        }
+
+        updateDownloadView(movieId, kinopoiskId, data);
+        const progressValue = Number.parseFloat(data.progress) || 0;
+        const statusText = (data.status || '').toLowerCase();
+        if (progressValue >= 100 || statusText.includes('seeding') || statusText.includes('completed')) {
+            stopStatusPolling(key);
+            markDownloadCompleted(movieId, kinopoiskId);
+        }
+    };
+
+    const pollTrackedStatuses = async () => {
+        statusPollScheduled = false;
+        if (!trackedStatuses.size) return;
+        const entries = Array.from(trackedStatuses.entries());
+        const request = { kinopoisk_ids: [], library_ids: [] };
+        entries.forEach(([, entry]) => {
+            if (entry.useKinopoiskStatus && entry.kinopoiskId) request.kinopoisk_ids.push(entry.kinopoiskId);
+            else if (entry.movieId) request.library_ids.push(entry.movieId);
+        });
+
+        try {
+            const response = await fetch('/api/download-status/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(request),
+            });
+            if (!response.ok) throw new Error('Сервер вернул ошибку статуса');
+            const payload = await response.json();
+            updateStaleNotice(payload);
+            entries.forEach(([key, entry]) => {
+                if (trackedStatuses.get(key) !== entry) return;
+                const data = entry.useKinopoiskStatus && entry.kinopoiskId
+                    ? (payload.kinopoisk || {})[entry.kinopoiskId]
+                    : (payload.library || {})[entry.movieId];
+                applyStatusUpdate(key, entry, data || { status: 'not_found' });
+            });
+        } catch (error) {
+            console.error('Ошибка при опросе статуса торрентов:', error);
+            entries.forEach(([key, entry]) => {
+                updateDownloadView(entry.movieId, entry.kinopoiskId, { status: 'error', message: 'Нет связи с qBittorrent' });
+                stopStatusPolling(key);
+            });
+        }
+    };
+
+    const scheduleStatusPoll = () => {
+        if (statusPollScheduled) return;
+        statusPollScheduled = true;
+        setTimeout(pollTrackedStatuses, 0);
+    };
+
     const startTorrentStatusPolling = (movieId, movieName, kinopoiskId, { skipRegister = false, useKinopoiskStatus = false } = {}) => {
         const key = getDownloadKey(movieId, kinopoiskId);
         if (!key) return;
         if (!skipRegister) registerDownload(movieId, movieName, kinopoiskId);
-        if (pollIntervals.has(key)) clearInterval(pollIntervals.get(key));
-
-        const poll = async () => {
-            try {
-                let data, response;
-                if (useKinopoiskStatus && kinopoiskId) {
-                    response = await fetch(`/api/download-status/${kinopoiskId}`);
-                } else if (movieId) {
-                    response = await fetch(`/api/library/torrent-status/${movieId}`);
-                } else return;
-
-                if (!response.ok) throw new Error('Сервер вернул ошибку статуса');
-                data = await response.json();
-
-                if (data.status === 'error' || (data.status === 'not_found' && useKinopoiskStatus)) {
-                    updateDownloadView(movieId, kinopoiskId, data);
-                    clearInterval(pollIntervals.get(key));
-                    pollIntervals.delete(key);
-                    if (data.status === 'not_found') removeDownload(movieId, kinopoiskId);
-                    return;
-                }
-
-                updateDownloadView(movieId, kinopoiskId, data);
-                const progressValue = Number.parseFloat(data.progress) || 0;
-                const statusText = (data.status || '').toLowerCase();
-                if (progressValue >= 100 || statusText.includes('seeding') || statusText.includes('completed')) {
-                    clearInterval(pollIntervals.get(key));
-                    pollIntervals.delete(key);
-                    markDownloadCompleted(movieId, kinopoiskId);
-                }
-            } catch (error) {
-                console.error('Ошибка при опросе статуса торрента:', error);
-                updateDownloadView(movieId, kinopoiskId, { status: 'error', message: 'Нет связи с qBittorrent' });
-                if (pollIntervals.has(key)) {
-                    clearInterval(pollIntervals.get(key));
-                    pollIntervals.delete(key);
-                }
-            }
-        };
+        const current = trackedStatuses.get(key);
+        if (current && current.useKinopoiskStatus === useKinopoiskStatus) return;
 
-        poll();
-        const intervalId = setInterval(poll, 3000);
-        pollIntervals.set(key, intervalId);
+        trackedStatuses.set(key, { movieId, kinopoiskId, useKinopoiskStatus });
+        if (!statusPollTimer && !eventsConnected) statusPollTimer = setInterval(pollTrackedStatuses, STATUS_POLL_INTERVAL);
+        scheduleStatusPoll();
     };
 
     const initializeStoredDownloads = () => {
@@ -280,8 +351,10 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/api/active-downloads');
             if (!response.ok) return;
             const payload = await response.json();
+            updateStaleNotice(payload);
             const downloads = Array.isArray(payload.downloads) ? payload.downloads : [];
-            downloads.forEach((item) => {
+            const queued = Array.isArray(payload.queued) ? payload.queued : [];
+            downloads.concat(queued).forEach((item) => {
                 const kinopoiskId = item.kinopoisk_id ? String(item.kinopoisk_id) : '';
                 if (!kinopoiskId) return;
                 const card = gallery.querySelector(`.gallery-item[data-kinopoisk-id="${kinopoiskId}"]`);
@@ -297,6 +370,59 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
+    // --- ПОТОК СОБЫТИЙ (SSE) ---
+    // Пока поток открыт, прогресс загрузок приходит с сервера сам,
+    // а опрос по таймерам приостанавливается.
+
+    const handleTorrentEvent = (data) => {
+        const kinopoiskId = data.kinopoisk_id ? String(data.kinopoisk_id) : '';
+        let handled = false;
+        trackedStatuses.forEach((entry, key) => {
+            const matches = entry.useKinopoiskStatus && entry.kinopoiskId
+                ? kinopoiskId === String(entry.kinopoiskId)
+                : data.category === `library-${entry.movieId}`;
+            if (matches) {
+                handled = true;
+                applyStatusUpdate(key, entry, data);
+            }
+        });
+        if (handled || !kinopoiskId || data.status === 'not_found' || !gallery || !widget) return;
+        const card = gallery.querySelector(`.gallery-item[data-kinopoisk-id="${kinopoiskId}"]`);
+        if (!card) return;
+        const { movieId } = card.dataset;
+        const movieName = card.dataset.movieName || data.name;
+        registerDownload(movieId, movieName, kinopoiskId);
+        startTorrentStatusPolling(movieId, movieName, kinopoiskId, { skipRegister: true, useKinopoiskStatus: true });
+    };
+
+    const setEventsConnected = (connected) => {
+        eventsConnected = connected;
+        if (connected && statusPollTimer) {
+            clearInterval(statusPollTimer);
+            statusPollTimer = null;
+        } else if (!connected && !statusPollTimer && trackedStatuses.size) {
+            statusPollTimer = setInterval(pollTrackedStatuses, STATUS_POLL_INTERVAL);
+        }
+    };
+
+    const connectEvents = () => {
+        if (!window.EventSource || !widget) return;
+        const source = new EventSource('/api/events?types=torrent,resync');
+        source.addEventListener('open', () => {
+            setEventsConnected(true);
+            scheduleStatusPoll();
+        });
+        source.addEventListener('error', () => setEventsConnected(false));
+        source.addEventListener('torrent', (event) => {
+            const data = safeJsonParse(event.data);
+            if (data) handleTorrentEvent(data);
+        });
+        source.addEventListener('resync', () => {
+            scheduleStatusPoll();
+            syncExternalDownloads();
+        });
+    };
+
     const formatDateBadges = () => {
         if (!gallery) return;
         const formatter = new Intl.DateTimeFormat('ru-RU', { day: '2-digit', month: '2-digit', year: 'numeric' });
@@ -314,6 +440,90 @@ document.addEventListener('DOMContentLoaded', () => {
         emptyMessage.style.display = gallery.querySelector('.gallery-item') ? 'none' : 'block';
     };
 
+    // --- ПОДГРУЗКА СЛЕДУЮЩИХ СТРАНИЦ ---
+
+    const sentinel = document.querySelector('.gallery-sentinel');
+    let nextCursor = gallery ? gallery.dataset.nextCursor || '' : '';
+    let pageLoading = false;
+    let pageObserver = null;
+
+    const createLibraryCard = (movie) => {
+        const item = document.createElement('div');
+        item.className = 'gallery-item library-card';
+        if (movie.is_on_client) item.classList.add('has-torrent-on-client');
+        item.dataset.movieId = movie.id;
+        item.dataset.kinopoiskId = movie.kinopoisk_id || '';
+        item.dataset.movieName = movie.name || '';
+        item.dataset.movieYear = movie.year || '';
+        item.dataset.moviePoster = movie.poster || '';
+        item.dataset.movieDescription = (movie.description || '').replace(/\n/g, ' ');
+        item.dataset.movieRating = movie.rating_kp != null ? movie.rating_kp.toFixed(1) : '';
+        item.dataset.movieGenres = movie.genres || '';
+        item.dataset.movieCountries = movie.countries || '';
+        item.dataset.addedAt = movie.added_at || '';
+        item.dataset.hasMagnet = movie.has_magnet ? 'true' : 'false';
+        item.dataset.magnetLink = movie.magnet_link || '';
+        item.dataset.isOnClient = movie.is_on_client ? 'true' : 'false';
+        item.dataset.torrentHash = movie.torrent_hash || '';
+
+        item.innerHTML = `
+            <div class="torrent-status-indicator"></div>
+            <div class="action-buttons">
+                <button type="button" class="icon-button download-button" title="Скачать торрент" aria-label="Скачать торрент"><svg class="icon-svg icon-download" viewBox="0 0 24 24"><use href="#icon-download"></use></svg></button>
+                <button type="button" class="icon-button search-button" title="Искать торрент" aria-label="Искать торрент"><svg class="icon-svg icon-search" viewBox="0 0 24 24"><use href="#icon-search"></use></svg></button>
+                <button type="button" class="icon-button delete-button" title="Удалить из библиотеки" aria-label="Удалить из библиотеки"><svg class="icon-svg icon-delete" viewBox="0 0 24 24"><use href="#icon-delete"></use></svg></button>
+            </div>
+            <div class="date-badge" data-date="${escapeAttr(movie.added_at || '')}"></div>
+            <img src="${escapeAttr(posterUrl(movie.poster) || placeholderPoster)}" alt="${escapeHtml(movie.name)}" loading="lazy">`;
+
+        item.querySelector('.download-button').style.display = movie.has_magnet ? 'inline-flex' : 'none';
+        item.querySelector('.search-button').style.display = movie.has_magnet ? 'none' : 'inline-flex';
+        return item;
+    };
+
+    const sentinelIsNearViewport = () => sentinel && sentinel.getBoundingClientRect().top < window.innerHeight + 600;
+
+    const loadNextPage = async () => {
+        if (!nextCursor || pageLoading) return;
+        pageLoading = true;
+        try {
+            const response = await fetch(`/api/library?cursor=${encodeURIComponent(nextCursor)}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const data = await response.json();
+            (data.items || []).forEach((movie) => {
+                if (gallery.querySelector(`.gallery-item[data-movie-id="${movie.id}"]`)) return;
+                gallery.appendChild(createLibraryCard(movie));
+            });
+            nextCursor = data.next_cursor || '';
+            formatDateBadges();
+            ensureEmptyState();
+        } catch (error) {
+            console.error('Не удалось загрузить следующую страницу библиотеки:', error);
+            return;
+        } finally {
+            pageLoading = false;
+        }
+        if (!nextCursor) {
+            if (pageObserver) pageObserver.disconnect();
+        } else if (sentinelIsNearViewport()) {
+            // Страница не заполнила экран - наблюдатель сам не сработает ещё раз
+            loadNextPage();
+        }
+    };
+
+    const initInfiniteScroll = () => {
+        if (!gallery || !sentinel || !nextCursor) return;
+        if ('IntersectionObserver' in window) {
+            pageObserver = new IntersectionObserver((entries) => {
+                if (entries.some(entry => entry.isIntersecting)) loadNextPage();
+            }, { rootMargin: '600px 0px' });
+            pageObserver.observe(sentinel);
+        } else {
+            window.addEventListener('scroll', () => { if (sentinelIsNearViewport()) loadNextPage(); }, { passive: true });
+            if (sentinelIsNearViewport()) loadNextPage();
+        }
+    };
+
     const closeModal = () => {
         if (!modalOverlay) return;
         modalOverlay.style.display = 'none';
@@ -383,6 +593,28 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
+    // Операции с qBittorrent сервер выполняет в фоне и возвращает id задачи;
+    // если задача в итоге не удалась, сообщаем об этом отдельно
+    const watchJob = (jobId, onFailed) => {
+        if (!jobId) return;
+        const check = async () => {
+            try {
+                const response = await fetch(`/api/jobs/${jobId}`);
+                if (!response.ok) return;
+                const job = await response.json();
+                if (job.status === 'failed') {
+                    showToast(`Ошибка qBittorrent: ${job.error}`, 'error');
+                    if (onFailed) onFailed(job);
+                } else if (job.status !== 'done') {
+                    setTimeout(check, 2000);
+                }
+            } catch (error) {
+                setTimeout(check, 5000);
+            }
+        };
+        setTimeout(check, 1000);
+    };
+
     const handleDownload = async (card) => {
         if (!card) return;
         const { movieId, kinopoiskId, movieName, hasMagnet } = card.dataset;
@@ -399,7 +631,8 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await response.json();
             if (data.success) {
                 startTorrentStatusPolling(movieId, movieName, kinopoiskId, { skipRegister: true });
-                showToast('Загрузка началась.', 'success');
+                showToast(data.message || 'Загрузка началась.', 'success');
+                if (data.status !== 'done') watchJob(data.job_id, () => removeDownload(movieId, kinopoiskId));
             } else {
                 showToast(data.message || 'Не удалось начать загрузку.', 'error');
                 removeDownload(movieId, kinopoiskId);
@@ -419,6 +652,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await response.json();
             showToast(data.message, data.success ? 'success' : 'error');
             if (data.success) {
+                if (data.status !== 'done') watchJob(data.job_id);
                 card.classList.remove('has-torrent-on-client');
                 card.dataset.isOnClient = 'false';
                 if (modalOverlay.style.display === 'flex') renderModal(card);
@@ -496,7 +730,7 @@ document.addEventListener('DOMContentLoaded', () => {
         modalBody.innerHTML = `
             <div class="winner-card">
                 <div class="winner-poster">
-                    <img src="${escapeAttr(ds.moviePoster || placeholderPoster)}" alt="Постер ${escapeAttr(ds.movieName)}">
+                    <img src="${escapeAttr(posterUrl(ds.moviePoster, 'modal') || placeholderPoster)}" alt="Постер ${escapeAttr(ds.movieName)}">
                     ${ratingBadge}
                 </div>
                 <div class="winner-details">
@@ -573,11 +807,13 @@ document.addEventListener('DOMContentLoaded', () => {
     initializeCardStates();
     formatDateBadges();
     ensureEmptyState();
+    initInfiniteScroll();
     initializeStoredDownloads();
     ensureWidgetState();
     syncExternalDownloads();
+    connectEvents();
     if (widget) {
-        setInterval(syncExternalDownloads, 5000);
+        setInterval(() => { if (!eventsConnected) syncExternalDownloads(); }, 5000);
         window.addEventListener('focus', syncExternalDownloads);
     }
 });
\ No newline at end of file
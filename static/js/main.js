@@ -5,6 +5,8 @@ var movies = [];
 document.addEventListener('DOMContentLoaded', () => {
     const movieInput = document.getElementById('movie-input');
     const addMovieBtn = document.getElementById('add-movie-btn');
+    const movieBatchInput = document.getElementById('movie-batch-input');
+    const addMovieBatchBtn = document.getElementById('add-movie-batch-btn');
     const createLotteryBtn = document.getElementById('create-lottery-btn');
     const movieListDiv = document.getElementById('movie-list');
     const loader = document.getElementById('loader');
@@ -125,7 +127,48 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
     
+    // Весь список уходит одним запросом, сервер ищет фильмы параллельно
+    const addMovieList = async () => {
+        const queries = movieBatchInput.value.split('\n').map(line => line.trim()).filter(Boolean);
+        if (queries.length === 0) return;
+
+        loader.style.display = 'block';
+        errorMessage.textContent = '';
+        addMovieBatchBtn.disabled = true;
+
+        try {
+            const response = await fetch('/fetch-movie/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ queries: queries })
+            });
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || 'Не удалось найти фильмы');
+            }
+
+            const failed = [];
+            data.results.forEach(item => {
+                if (item.movie) movies.push(item.movie);
+                else failed.push(`${item.query}: ${item.error}`);
+            });
+            renderMovieList();
+            updateCreateButtonState();
+            // В поле остаются только строки, которые не удалось найти
+            movieBatchInput.value = data.results.filter(item => !item.movie).map(item => item.query).join('\n');
+            if (failed.length > 0) {
+                errorMessage.textContent = `Не найдено: ${failed.join('; ')}`;
+            }
+        } catch (error) {
+            errorMessage.textContent = error.message;
+        } finally {
+            loader.style.display = 'none';
+            addMovieBatchBtn.disabled = false;
+        }
+    };
+
     addMovieBtn.addEventListener('click', addMovie);
+    addMovieBatchBtn.addEventListener('click', addMovieList);
     movieInput.addEventListener('keypress', (e) => {
         if (e.key === 'Enter') {
             addMovie();
@@ -22,7 +22,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     finalMovies.forEach(movie => {
         const img = document.createElement('img');
-        img.src = movie.poster || 'https://via.placeholder.com/100x150.png?text=No+Image';
+        img.src = movie.poster ? `/poster/card?url=${encodeURIComponent(movie.poster)}` : 'https://via.placeholder.com/100x150.png?text=No+Image';
         rouletteDiv.appendChild(img);
 
         const promise = new Promise((resolve, reject) => {
@@ -88,7 +88,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     // --- ИЗМЕНЕНИЕ: Уменьшили задержку перед показом результата ---
                     setTimeout(() => {
                         preDrawDiv.style.display = 'none';
-                        document.getElementById('result-poster').src = winner.poster || 'https://via.placeholder.com/200x300.png?text=No+Image';
+                        document.getElementById('result-poster').src = winner.poster ? `/poster/modal?url=${encodeURIComponent(winner.poster)}` : 'https://via.placeholder.com/200x300.png?text=No+Image';
                         document.getElementById('result-name').textContent = winner.name;
                         document.getElementById('result-year').textContent = winner.year;
                         resultDiv.style.display = 'flex';
@@ -0,0 +1,70 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def _record_statements(module):
+    statements = []
+    with module.app.app_context():
+        event.listen(module.db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    return statements
+
+
+def _movies(*posters):
+    return [{"name": f"Фильм {index}", "year": "2000", "poster": poster} for index, poster in enumerate(posters)]
+
+
+def test_create_lottery_inserts_new_posters_in_one_batch(app_module):
+    module = app_module
+    client = module.app.test_client()
+    assert client.post("/create", json={"movies": _movies("a.jpg", "b.jpg")}).status_code == 200
+    statements = _record_statements(module)
+
+    client.post("/create", json={"movies": _movies("b.jpg", "c.jpg", "c.jpg", "d.jpg", None)})
+
+    photo_inserts = [sql for sql in statements if sql.startswith("INSERT INTO background_photo")]
+    assert len(photo_inserts) == 1
+    with module.app.app_context():
+        photos = module.BackgroundPhoto.query.order_by(module.BackgroundPhoto.z_index).all()
+        assert [(photo.poster_url, photo.z_index) for photo in photos] == [
+            ("a.jpg", 1), ("b.jpg", 2), ("c.jpg", 3), ("d.jpg", 4),
+        ]
+
+
+def test_collage_is_cached_until_a_write(app_module):
+    module = app_module
+    client = module.app.test_client()
+    client.post("/create", json={"movies": _movies("a.jpg", "b.jpg")})
+
+    first = client.get("/api/background-photos")
+    statements = _record_statements(module)
+    repeated = client.get("/api/background-photos", headers={"If-None-Match": first.headers["ETag"]})
+
+    assert {photo["poster_url"] for photo in first.get_json()["photos"]} == {"a.jpg", "b.jpg"}
+    assert "max-age" in first.headers["Cache-Control"]
+    assert repeated.status_code == 304
+    assert statements == []
+
+    client.post("/create", json={"movies": _movies("c.jpg", "d.jpg")})
+    updated = client.get("/api/background-photos", headers={"If-None-Match": first.headers["ETag"]})
+
+    assert updated.status_code == 200
+    assert len(updated.get_json()["photos"]) == 4
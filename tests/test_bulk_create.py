@@ -0,0 +1,111 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def _lottery(prefix, count=3):
+    return {"movies": [{"name": f"{prefix} {index}", "year": "2000", "poster": f"{prefix}-{index}.jpg"} for index in range(count)]}
+
+
+def test_batch_creates_all_lotteries_with_constant_statements(app_module):
+    module = app_module
+    statements = []
+    with module.app.app_context():
+        event.listen(module.db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    response = module.app.test_client().post("/create/batch", json={"lotteries": [_lottery(f"L{n}") for n in range(12)]})
+
+    assert response.status_code == 200
+    created = response.get_json()["lotteries"]
+    assert len({item["id"] for item in created}) == 12
+    assert created[0]["wait_url"] == f"/wait/{created[0]['id']}"
+    assert created[0]["play_url"].endswith(f"/l/{created[0]['id']}")
+    assert len([sql for sql in statements if sql.startswith("INSERT INTO movie")]) == 1
+    assert len([sql for sql in statements if sql.startswith("SELECT lottery.id")]) == 1
+    with module.app.app_context():
+        lottery = module.db.session.get(module.Lottery, created[5]["id"])
+        assert sorted(movie.name for movie in lottery.movies) == ["L5 0", "L5 1", "L5 2"]
+        assert module.BackgroundPhoto.query.count() == 36
+
+
+def test_allocator_skips_taken_ids_in_one_query_per_round(monkeypatch, app_module):
+    module = app_module
+    with module.app.app_context():
+        module.db.session.add(module.Lottery(id="aaaaaa"))
+        module.db.session.commit()
+        candidates = iter(["aaaaaa", "bbbbbb", "aaaaaa", "cccccc"])
+        monkeypatch.setattr(module.random, "choices", lambda alphabet, k: list(next(candidates)))
+
+        assert module.allocate_lottery_ids(2) == ["bbbbbb", "cccccc"]
+
+
+def test_batch_rejects_invalid_lottery(app_module):
+    client = app_module.app.test_client()
+
+    response = client.post("/create/batch", json={"lotteries": [_lottery("ok"), {"movies": [{"name": "один"}]}]})
+
+    assert response.status_code == 400
+    assert "№2" in response.get_json()["error"]
+    with app_module.app.app_context():
+        assert app_module.Lottery.query.count() == 0
+
+
+def test_movie_without_year_is_rejected(app_module):
+    client = app_module.app.test_client()
+
+    response = client.post("/create", json={"movies": [{"name": "Первый", "year": "2000"}, {"name": "Без года"}]})
+
+    assert response.status_code == 400
+    assert "год" in response.get_json()["error"]
+
+
+def test_only_id_collisions_are_retried(monkeypatch, app_module):
+    module = app_module
+    allocations = []
+    collisions = [["aaaaaa"]]  # первый подбор отдаёт id, который занял параллельный запрос
+    allocate = module.allocate_lottery_ids
+
+    def colliding_allocate(count, length=6):
+        allocations.append(count)
+        return collisions.pop() if collisions else allocate(count, length)
+
+    monkeypatch.setattr(module, "allocate_lottery_ids", colliding_allocate)
+    with module.app.app_context():
+        module.db.session.add(module.Lottery(id="aaaaaa"))
+        module.db.session.commit()
+
+        lottery_ids = module.create_lotteries([_lottery("ok")["movies"]])
+        assert len(allocations) == 2 and lottery_ids != ["aaaaaa"]
+
+        allocations.clear()
+        with pytest.raises(module.IntegrityError):
+            module.create_lotteries([[{"name": "Без года"}, {"name": "Тоже"}]])
+        assert len(allocations) == 1
+
+
+def test_allocator_keeps_generation_order(monkeypatch, app_module):
+    module = app_module
+    with module.app.app_context():
+        candidates = iter(["zzzzzz", "0abcde", "aaaaaa", "bbbbbb"])
+        monkeypatch.setattr(module.random, "choices", lambda alphabet, k: list(next(candidates)))
+
+        # Сортировка отдала бы "0abcde" и "aaaaaa" - id смещались к начинающимся с цифры
+        assert module.allocate_lottery_ids(2) == ["zzzzzz", "0abcde"]
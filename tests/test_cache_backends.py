@@ -0,0 +1,301 @@
+import importlib
+import socket
+import socketserver
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+
+class _FakeSyncClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        return {"rid": rid + 1}
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    """Минимальный сервер по протоколу RESP: команды, которыми пользуется RedisCacheBackend."""
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _reply(self, value):
+        if value is None:
+            self.wfile.write(b"$-1\r\n")
+        elif isinstance(value, int):
+            self.wfile.write(b":%d\r\n" % value)
+        elif isinstance(value, bytes):
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+        else:
+            self.wfile.write(value.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        authenticated = server.password is None
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            name = args[0].upper().decode()
+            server.commands.append(name)
+            if server.drop_next:
+                server.drop_next = False
+                return
+            with server.lock:
+                if name == "AUTH":
+                    authenticated = args[1].decode() == server.password
+                    self._reply("+OK" if authenticated else "-WRONGPASS invalid password")
+                elif not authenticated:
+                    self._reply("-NOAUTH Authentication required")
+                elif name == "SELECT":
+                    server.selected.append(int(args[1]))
+                    self._reply("+OK")
+                elif name == "GET":
+                    value, expires_at = server.data.get(args[1], (None, None))
+                    if expires_at is not None and expires_at <= time.time():
+                        server.data.pop(args[1], None)
+                        value = None
+                    self._reply(value)
+                elif name == "SET":
+                    expires_at = None
+                    if len(args) == 5 and args[3].upper() == b"PX":
+                        expires_at = time.time() + int(args[4]) / 1000
+                    server.data[args[1]] = (args[2], expires_at)
+                    self._reply("+OK")
+                elif name == "DEL":
+                    self._reply(1 if server.data.pop(args[1], None) else 0)
+                elif name == "INCR":
+                    value = int(server.data.get(args[1], (b"0", None))[0]) + 1
+                    server.data[args[1]] = (str(value).encode(), None)
+                    self._reply(value)
+                else:
+                    self._reply(f"-ERR unknown command '{name}'")
+            self.wfile.flush()
+
+
+class _RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(("127.0.0.1", 0), _RespHandler)
+        self.password = password
+        self.data = {}
+        self.commands = []
+        self.selected = []
+        self.drop_next = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, db=0):
+        auth = f":{self.password}@" if self.password else ""
+        return f"redis://{auth}127.0.0.1:{self.server_address[1]}/{db}"
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+@pytest.fixture
+def resp_server():
+    server = _RespServer(password="secret")
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+@pytest.fixture(params=["local", "sqlite", "redis"])
+def backend_factory(request, app_module, tmp_path):
+    """Фабрика бэкендов: для sqlite и redis все вызовы смотрят в одно хранилище, как воркеры одного хоста."""
+    module = app_module
+    if request.param == "local":
+        backend = module.LocalCacheBackend(16)
+        return lambda: backend
+    if request.param == "sqlite":
+        path = str(tmp_path / "cache" / "shared.sqlite3")
+        return lambda: module.SQLiteCacheBackend(path)
+    server = _RespServer(password="secret")
+    request.addfinalizer(server.close)
+    return lambda: module.RedisCacheBackend(server.url(db=2))
+
+
+def test_values_roundtrip_and_expire(app_module, backend_factory):
+    cache = app_module.Cache(backend_factory(), prefix="test", default_ttl=60, version_ttl=0)
+    movies = cache.namespace("movies")
+
+    movies.set("q:фильм", {"name": "Фильм", "genres": ["драма"], "rating": 8.1})
+    movies.set("short", [1, 2], ttl=0.05)
+
+    assert movies.get("q:фильм") == {"name": "Фильм", "genres": ["драма"], "rating": 8.1}
+    assert movies.get("missing", "default") == "default"
+    assert cache.namespace("other").get("q:фильм") is None
+    time.sleep(0.1)
+    assert movies.get("short") is None
+
+    movies.delete("q:фильм")
+    assert movies.get("q:фильм") is None
+    assert app_module.CACHE_REQUESTS.value(namespace="movies", result="hit") == 1
+
+
+def test_invalidation_reaches_other_workers(app_module, backend_factory):
+    first = app_module.Cache(backend_factory(), prefix="test", version_ttl=0)
+    second = app_module.Cache(backend_factory(), prefix="test", version_ttl=0)
+    first.namespace("background").set("collage", ["poster"])
+
+    assert second.namespace("background").get("collage") == ["poster"]
+    second.namespace("background").clear()
+
+    assert first.namespace("background").get("collage") is None
+    assert first.version("background") == second.version("background") == 1
+
+
+def test_value_built_during_invalidation_is_not_served(app_module, backend_factory):
+    cache = app_module.Cache(backend_factory(), prefix="test", version_ttl=0)
+    pages = cache.namespace("pages")
+
+    def build():
+        # Параллельная запись в другом воркере, пока собирается значение
+        pages.clear()
+        return "stale"
+
+    assert pages.get_or_set("history", build) == "stale"
+    assert pages.get("history") is None
+    assert pages.get_or_set("history", lambda: "fresh") == "fresh"
+    assert pages.get("history") == "fresh"
+
+
+def test_version_is_rechecked_after_interval(app_module, tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    first = app_module.Cache(app_module.SQLiteCacheBackend(path), version_ttl=60)
+    second = app_module.Cache(app_module.SQLiteCacheBackend(path), version_ttl=60)
+    first.namespace("kinopoisk").set("id:1", {"name": "Фильм"})
+    assert second.namespace("kinopoisk").get("id:1") == {"name": "Фильм"}
+
+    first.namespace("kinopoisk").clear()
+    # Второй воркер ещё не перечитал версию: сброс он увидит через version_ttl
+    assert second.namespace("kinopoisk").get("id:1") == {"name": "Фильм"}
+    second._versions.clear()
+    assert second.namespace("kinopoisk").get("id:1") is None
+
+
+def test_redis_backend_authenticates_and_reconnects(app_module, resp_server):
+    backend = app_module.RedisCacheBackend(resp_server.url(db=3), timeout=1)
+
+    backend.set("key", "значение", ttl=10)
+    assert backend.get("key") == "значение"
+    assert resp_server.commands[:2] == ["AUTH", "SELECT"]
+    assert resp_server.selected == [3]
+
+    with pytest.raises(app_module.CacheBackendError):
+        backend.command("UNKNOWN")
+    assert backend.get("key") == "значение"  # ошибка команды не рвёт соединение
+
+    resp_server.drop_next = True
+    with pytest.raises(ConnectionError):
+        backend.get("key")
+    assert backend.get("key") == "значение"  # после обрыва соединение открыто заново
+    assert resp_server.commands.count("AUTH") == 2
+
+
+def test_unavailable_backend_degrades_to_miss(app_module, capsys):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    cache = app_module.Cache(app_module.RedisCacheBackend(f"redis://127.0.0.1:{port}/0", timeout=0.2))
+    pages = cache.namespace("pages")
+
+    pages.set("history", "<html>")
+    assert pages.get("history") is None
+    assert pages.get_or_set("library", lambda: "built") == "built"
+    pages.clear()
+
+    assert capsys.readouterr().out.count("недоступен") == 1
+    assert app_module.CACHE_REQUESTS.value(namespace="pages", result="error") > 0
+
+
+def test_app_uses_configured_redis_backend(monkeypatch, resp_server):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    monkeypatch.setenv("CACHE_BACKEND", "redis")
+    monkeypatch.setenv("CACHE_REDIS_URL", resp_server.url())
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    client = module.app.test_client()
+
+    assert module.shared_cache.backend.name == "redis"
+    first = client.get("/history")
+    commands = len(resp_server.commands)
+    second = client.get("/history")
+
+    assert first.status_code == second.status_code == 200
+    assert first.data == second.data
+    assert any(b":pages:" in key for key in resp_server.data)
+    assert resp_server.commands[commands:] == ["GET"]  # страница и версия взяты из кэша
+
+    photos = client.get("/api/background-photos").get_json()
+    with module.app.app_context():
+        module.db.session.add(module.BackgroundPhoto(
+            poster_url="https://example.com/p.jpg", pos_top=1, pos_left=2, rotation=3, z_index=4,
+        ))
+        module.db.session.commit()
+        module.background_collage.invalidate()
+
+    assert photos == {"photos": []}
+    assert len(client.get("/api/background-photos").get_json()["photos"]) == 1
+    assert resp_server.data[b"movie-lottery:background:version"][0] == b"1"
+
+
+@pytest.mark.parametrize("path", ["/history", "/library"])
+def test_cached_pages_follow_client_torrents(monkeypatch, app_module, path):
+    module = app_module
+    monkeypatch.setattr(module, "Client", _FakeSyncClient)
+    with module.app.app_context():
+        lottery = module.Lottery(id="abc123")
+        lottery.movies.append(module.Movie(name="Фильм", year="2001", kinopoisk_id=555, poster="p.jpg"))
+        module.db.session.add(lottery)
+        module.db.session.flush()
+        lottery.winner_movie_id = lottery.movies[0].id
+        lottery.result_name = "Фильм"
+        module.db.session.add(module.LibraryMovie(id=1, name="Фильм", year="2001", kinopoisk_id=555))
+        module.db.session.commit()
+    client = module.app.test_client()
+
+    before = client.get(path).get_data(as_text=True)
+    torrent = {"name": "x", "state": "downloading", "progress": 0.1, "category": "library-1", "tags": "kp-555"}
+    module.torrent_snapshot.apply_maindata({"rid": 50, "torrents": {"h555": torrent}})
+    after = client.get(path).get_data(as_text=True)
+
+    assert "h555" not in before
+    assert "h555" in after
@@ -0,0 +1,131 @@
+import importlib
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+
+class _FakeBreakerClient:
+    calls = 0
+    offline = False
+    added = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def _call(self):
+        _FakeBreakerClient.calls += 1
+        if _FakeBreakerClient.offline:
+            raise sys.modules["app"].qbittorrent_exceptions.APIConnectionError("offline")
+
+    def torrents_info(self, **kwargs):
+        self._call()
+        return []
+
+    def torrents_add(self, **kwargs):
+        self._call()
+        _FakeBreakerClient.added.append(kwargs)
+
+    def sync_maindata(self, rid=0):
+        self._call()
+        return {"rid": 1, "full_update": True, "torrents": {"h1": {
+            "name": "Movie", "state": "downloading", "progress": 0.4, "dlspeed": 1024 * 1024, "eta": 60,
+            "num_seeds": 2, "num_leechs": 1, "category": "library-7", "tags": "kp-301",
+        }}}
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeBreakerClient)
+    _FakeBreakerClient.calls = 0
+    _FakeBreakerClient.offline = False
+    _FakeBreakerClient.added = []
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+    module.job_worker.stop()
+
+
+def _trip(module):
+    _FakeBreakerClient.offline = True
+    for _ in range(module.qbit_breaker.failure_threshold):
+        with pytest.raises(module.qbittorrent_exceptions.APIConnectionError):
+            module.qbit_request('torrents_info')
+
+
+def test_breaker_opens_and_fails_fast(app_module):
+    module = app_module
+    _trip(module)
+    calls = _FakeBreakerClient.calls
+
+    with pytest.raises(module.CircuitOpenError):
+        module.qbit_request('torrents_info')
+
+    assert _FakeBreakerClient.calls == calls
+    assert module.qbit_breaker.snapshot()["state"] == "open"
+    assert "offline" in module.qbit_breaker.snapshot()["last_error"]
+
+
+def test_half_open_trial_closes_breaker(app_module):
+    module = app_module
+    breaker = module.qbit_breaker
+    _trip(module)
+
+    breaker.opened_at -= breaker.reset_timeout
+    with pytest.raises(module.qbittorrent_exceptions.APIConnectionError):
+        module.qbit_request('torrents_info')
+    assert breaker.state == "open"
+
+    breaker.opened_at -= breaker.reset_timeout
+    _FakeBreakerClient.offline = False
+    assert module.qbit_request('torrents_info') == []
+    assert breaker.snapshot()["state"] == "closed"
+    assert breaker.failures == 0
+
+
+def test_status_routes_serve_stale_snapshot(app_module):
+    module = app_module
+    assert module.torrent_sync.refresh() is True
+    _trip(module)
+    client = module.app.test_client()
+
+    library = client.get("/api/library/torrent-status/7").get_json()
+    by_kp = client.get("/api/download-status/301").get_json()
+    unknown = client.get("/api/torrent-status/abc123").get_json()
+    active = client.get("/api/active-downloads").get_json()
+
+    assert library["stale"] is True and library["progress"] == "40.0"
+    assert library["qbittorrent"]["state"] == "open"
+    assert by_kp["kinopoisk_id"] == 301 and by_kp["stale"] is True
+    assert unknown["status"] == "error" and unknown["stale"] is True
+    assert active["stale"] is True
+    assert active["qbittorrent"]["state"] == "open"
+
+
+def test_open_breaker_does_not_consume_job_attempts(app_module):
+    module = app_module
+    _trip(module)
+
+    with module.app.app_context():
+        job = module.enqueue_job('torrent_add', {"options": {"urls": "magnet:?xt=urn:btih:1", "category": "library-1"}})
+        module.db.session.commit()
+        job_id = job.id
+        module.submit_job(job)
+        job = module.db.session.get(module.Job, job_id)
+
+        assert job.status == "pending"
+        assert job.attempts == 0
+        assert job.run_at > datetime.utcnow()
+    assert _FakeBreakerClient.added == []
@@ -0,0 +1,150 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+
+
+class _FakeSyncClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        return {"rid": rid + 1}
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeSyncClient)
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+        lottery = module.Lottery(id="abc123")
+        lottery.movies.append(module.Movie(name="Фильм", year="2001", kinopoisk_id=11, poster="p.jpg"))
+        lottery.movies.append(module.Movie(name="Другой", year="2002", kinopoisk_id=12, poster="q.jpg"))
+        module.db.session.add(lottery)
+        module.db.session.add(module.LibraryMovie(id=1, name="Фильм", year="2001", kinopoisk_id=11))
+        module.db.session.commit()
+    yield module
+
+
+def _get(module, path, etag=None, statements=None):
+    headers = {"If-None-Match": etag} if etag else {}
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with module.app.app_context():
+        engine = module.db.engine
+        if statements is not None:
+            event.listen(engine, "before_cursor_execute", _record)
+        try:
+            return module.app.test_client().get(path, headers=headers)
+        finally:
+            if statements is not None:
+                event.remove(engine, "before_cursor_execute", _record)
+
+
+def test_repeat_result_poll_costs_only_version_check(app_module):
+    module = app_module
+    first = _get(module, "/api/result/abc123")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and first.headers["Last-Modified"]
+
+    statements = []
+    repeat = _get(module, "/api/result/abc123", etag, statements)
+
+    assert repeat.status_code == 304
+    assert repeat.get_data() == b""
+    assert repeat.headers["ETag"] == etag
+    assert not any("FROM movie " in statement for statement in statements)
+
+    module.app.test_client().post("/draw/abc123")
+    drawn = _get(module, "/api/result/abc123", etag)
+    assert drawn.status_code == 200
+    assert drawn.get_json()["result"]["name"] in ("Фильм", "Другой")
+
+
+def test_result_etag_follows_magnets_and_client_torrents(app_module):
+    module = app_module
+    etag = _get(module, "/api/result/abc123").headers["ETag"]
+
+    module.app.test_client().post("/api/movie-magnet", json={"kinopoisk_id": 12, "magnet_link": "magnet:?xt=12"})
+    response = _get(module, "/api/result/abc123", etag)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    torrent = {"name": "x", "state": "downloading", "progress": 0.1, "category": "lottery-abc123", "tags": "kp-11"}
+    module.torrent_snapshot.apply_maindata({"rid": 50, "torrents": {"h1": torrent}})
+    response = _get(module, "/api/result/abc123", etag)
+    assert response.status_code == 200
+    assert response.get_json()["movies"][0]["torrent_hash"] == "h1"
+    etag = response.headers["ETag"]
+
+    module.torrent_snapshot.apply_maindata({"rid": 51, "torrents": {"h1": {"progress": 0.9}}})
+    assert _get(module, "/api/result/abc123", etag).status_code == 304
+
+
+@pytest.mark.parametrize("path", ["/l/abc123", "/history", "/library"])
+def test_pages_answer_not_modified(app_module, path):
+    first = _get(app_module, path)
+    assert first.status_code == 200
+
+    assert _get(app_module, path, first.headers["ETag"]).status_code == 304
+    if path == "/l/abc123":
+        not_modified_since = app_module.app.test_client().get(
+            path, headers={"If-Modified-Since": first.headers["Last-Modified"]},
+        )
+        assert not_modified_since.status_code == 304
+    else:
+        # У коллекций нет Last-Modified: max(updated_at) не замечает удалений
+        assert "Last-Modified" not in first.headers
+
+
+def test_deleted_row_is_not_hidden_by_if_modified_since(app_module):
+    module = app_module
+    client = module.app.test_client()
+    first = _get(module, "/library")
+    assert "Фильм" in first.get_data(as_text=True)
+
+    client.delete("/api/library/1")
+    response = client.get("/library", headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+
+    assert response.status_code == 200
+
+
+def test_page_etags_change_with_their_collections(app_module):
+    module = app_module
+    history_etag = _get(module, "/history").headers["ETag"]
+    library_etag = _get(module, "/library").headers["ETag"]
+    play_etag = _get(module, "/l/abc123").headers["ETag"]
+
+    module.app.test_client().post("/draw/abc123")
+    assert _get(module, "/history", history_etag).status_code == 200
+    assert _get(module, "/l/abc123", play_etag).status_code == 200
+    assert _get(module, "/library", library_etag).status_code == 304
+
+    module.app.test_client().delete("/api/library/1")
+    assert _get(module, "/library", library_etag).status_code == 200
+
+
+@pytest.mark.parametrize("path", ["/history", "/library"])
+def test_page_etags_follow_client_torrents(app_module, path):
+    module = app_module
+    etag = _get(module, path).headers["ETag"]
+
+    torrent = {"name": "x", "state": "downloading", "progress": 0.1, "category": "lottery-abc123", "tags": "kp-11"}
+    module.torrent_snapshot.apply_maindata({"rid": 50, "torrents": {"h1": torrent}})
+
+    assert _get(module, path, etag).status_code == 200
@@ -0,0 +1,239 @@
+import importlib
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+
+class _FakeSchedulerClient:
+    added = []
+    torrents = {}
+    reject = False
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def torrents_info(self, **kwargs):
+        return []
+
+    def torrents_add(self, **kwargs):
+        if _FakeSchedulerClient.reject:
+            raise sys.modules["app"].qbittorrent_exceptions.Conflict409Error("bad torrent")
+        _FakeSchedulerClient.added.append(kwargs)
+
+    def sync_maindata(self, rid=0):
+        return {"rid": rid + 1, "full_update": True, "torrents": dict(_FakeSchedulerClient.torrents)}
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeSchedulerClient)
+    monkeypatch.setattr(module.download_scheduler, "max_active", 1)
+    _FakeSchedulerClient.added = []
+    _FakeSchedulerClient.torrents = {}
+    _FakeSchedulerClient.reject = False
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+        for movie_id, kp_id in ((1, 101), (2, 102)):
+            module.db.session.add(module.LibraryMovie(id=movie_id, kinopoisk_id=kp_id, name=f"Фильм {movie_id}", year="2000"))
+            module.db.session.add(module.MovieIdentifier(kinopoisk_id=kp_id, magnet_link=f"magnet:?xt=urn:btih:{kp_id}"))
+        lottery = module.Lottery(id="abc123")
+        lottery.movies.append(module.Movie(name="Победитель", year="2001", kinopoisk_id=301))
+        module.db.session.add(lottery)
+        module.db.session.add(module.MovieIdentifier(kinopoisk_id=301, magnet_link="magnet:?xt=urn:btih:301"))
+        module.db.session.commit()
+    yield module
+    module.job_worker.stop()
+
+
+def _fill_queue(client):
+    first = client.post("/api/library/start-download/1")
+    second = client.post("/api/library/start-download/2")
+    lottery = client.post("/api/start-download/301")
+    return first, second, lottery
+
+
+def test_downloads_wait_for_free_slot_in_priority_order(app_module):
+    client = app_module.app.test_client()
+
+    first, second, lottery = _fill_queue(client)
+
+    assert first.status_code == 200
+    assert first.get_json()["message"] == "Загрузка началась!"
+    assert [added["category"] for added in _FakeSchedulerClient.added] == ["library-1"]
+    assert second.status_code == lottery.status_code == 202
+    assert second.get_json()["queue_position"] == 1
+    # Фильм из лотереи обгоняет ранее поставленную докачку библиотеки
+    queue = client.get("/api/downloads").get_json()
+    assert [(item["category"], item["queue_position"]) for item in queue["queued"]] == [
+        ("lottery-abc123", 1), ("library-2", 2),
+    ]
+    assert [item["category"] for item in queue["active"]] == ["library-1"]
+
+    status = client.get("/api/library/torrent-status/2").get_json()
+    assert status == {"status": "queued", "queue_position": 2, "download_id": second.get_json()["download_id"]}
+    batch = client.post("/api/download-status/batch", json={"kinopoisk_ids": [301]}).get_json()
+    assert batch["kinopoisk"]["301"]["status"] == "queued"
+    active = client.get("/api/active-downloads").get_json()
+    assert [(item["kinopoisk_id"], item["queue_position"]) for item in active["queued"]] == [(301, 1), (102, 2)]
+
+
+def test_completed_torrent_promotes_next_download(app_module):
+    module = app_module
+    client = module.app.test_client()
+    _fill_queue(client)
+
+    _FakeSchedulerClient.torrents = {"h1": {"category": "library-1", "progress": 1.0, "tags": "kp-101"}}
+    with module.app.app_context():
+        module.download_scheduler.tick()
+        statuses = {d.category: d.status for d in module.DownloadRequest.query.all()}
+
+    assert statuses == {"library-1": "completed", "lottery-abc123": "active", "library-2": "queued"}
+    assert [added["category"] for added in _FakeSchedulerClient.added] == ["library-1", "lottery-abc123"]
+    assert _FakeSchedulerClient.added[1]["tags"] == "kp-301"
+
+
+def test_removed_torrent_and_failed_add_free_the_slot(monkeypatch, app_module):
+    module = app_module
+    monkeypatch.setattr(module.download_scheduler, "missing_grace", 0)
+    client = module.app.test_client()
+    _fill_queue(client)
+
+    _FakeSchedulerClient.reject = True
+    with module.app.app_context():
+        module.download_scheduler.tick()
+        statuses = {d.category: d.status for d in module.DownloadRequest.query.all()}
+
+    # library-1 пропал из клиента, а оба следующих торрента qBittorrent отклонил
+    assert statuses == {"library-1": "cancelled", "lottery-abc123": "failed", "library-2": "failed"}
+
+
+def test_rate_limits_are_applied_only_when_configured(monkeypatch, app_module):
+    module = app_module
+    monkeypatch.setattr(module, "DOWNLOAD_RATE_LIMIT_KIB", 512)
+    client = module.app.test_client()
+
+    client.post("/api/library/start-download/1")
+
+    assert _FakeSchedulerClient.added[0]["download_limit"] == 512 * 1024
+    assert "upload_limit" not in _FakeSchedulerClient.added[0]
+
+
+def test_queue_priority_can_be_changed_and_download_cancelled(app_module):
+    client = app_module.app.test_client()
+    _, second, lottery = _fill_queue(client)
+    second_id = second.get_json()["download_id"]
+
+    raised = client.patch(f"/api/downloads/{second_id}", json={"priority": 100})
+    cancelled = client.delete(f"/api/downloads/{lottery.get_json()['download_id']}")
+    active_id = client.get("/api/downloads").get_json()["active"][0]["download_id"]
+
+    assert raised.get_json()["queue_position"] == 1
+    assert cancelled.status_code == 200
+    assert [item["download_id"] for item in client.get("/api/downloads").get_json()["queued"]] == [second_id]
+    assert client.delete(f"/api/downloads/{active_id}").status_code == 409
+
+
+def test_cancel_publishes_event_and_frees_queue_position(app_module):
+    module = app_module
+    client = module.app.test_client()
+    _, second, lottery = _fill_queue(client)
+    second_id = second.get_json()["download_id"]
+    last_event_id = module.event_broker.last_id
+
+    cancelled = client.delete(f"/api/downloads/{second_id}")
+
+    assert cancelled.status_code == 200
+    events = [event for event in module.event_broker.events_since(last_event_id) if event["type"] == "download"]
+    assert [(event["data"]["download_id"], event["data"]["status"]) for event in events] == [(second_id, "cancelled")]
+    queued = client.get("/api/downloads").get_json()["queued"]
+    assert [(item["download_id"], item["queue_position"]) for item in queued] == [(lottery.get_json()["download_id"], 1)]
+    assert client.delete(f"/api/downloads/{second_id}").status_code == 409
+
+
+def test_idempotency_key_returns_the_same_download(app_module):
+    module = app_module
+    client = module.app.test_client()
+    headers = {"Idempotency-Key": "click-1"}
+
+    first = client.post("/api/library/start-download/1", headers=headers)
+    _FakeSchedulerClient.torrents = {"h1": {"category": "library-1", "progress": 1.0, "tags": "kp-101"}}
+    with module.app.app_context():
+        module.download_scheduler.tick()
+    repeated = client.post("/api/library/start-download/1", headers=headers)
+    fresh = client.post("/api/library/start-download/1")
+
+    assert first.status_code == repeated.status_code == 200
+    assert repeated.get_json()["job_id"] == first.get_json()["job_id"]
+    with module.app.app_context():
+        downloads = module.DownloadRequest.query.order_by(module.DownloadRequest.id).all()
+        assert [(d.status, d.idempotency_key) for d in downloads] == [
+            ("completed", "torrent_add:click-1"), ("active", None),
+        ]
+        assert module.db.session.get(module.Job, downloads[0].job_id).idempotency_key == "torrent_add:click-1"
+    assert fresh.get_json()["job_id"] != first.get_json()["job_id"]
+
+
+def test_concurrent_dispatches_respect_active_limit(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'scheduler.db'}")
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeSchedulerClient)
+    scheduler = module.download_scheduler
+    monkeypatch.setattr(scheduler, "max_active", 1)
+    _FakeSchedulerClient.added = []
+    with module.app.app_context():
+        module.db.create_all()
+        for kp_id in (101, 102):
+            scheduler.schedule(f"library-{kp_id}", f"magnet:?xt=urn:btih:{kp_id}", kp_id)
+        module.db.session.commit()
+
+    # Второй поток посчитал свободные места до того, как первый занял своё:
+    # он видит устаревшее "есть место" и берёт следующую строку очереди
+    first_claimed = threading.Event()
+    free_slots = scheduler._free_slots
+    stale = threading.local()
+
+    def racing_free_slots():
+        if threading.current_thread().name == "second" and not getattr(stale, "used", False):
+            stale.used = True
+            first_claimed.wait(timeout=5)
+            return 1
+        return free_slots()
+
+    monkeypatch.setattr(scheduler, "_free_slots", racing_free_slots)
+    started = []
+
+    def dispatch():
+        try:
+            with module.app.app_context():
+                started.extend(download.category for download in scheduler.dispatch())
+        finally:
+            first_claimed.set()
+
+    threads = [threading.Thread(target=dispatch, name=name) for name in ("first", "second")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    with module.app.app_context():
+        statuses = sorted(d.status for d in module.DownloadRequest.query.all())
+        module.db.session.remove()
+        module.db.engine.dispose()
+    assert statuses == ["active", "queued"]
+    assert len(started) == 1
+    assert len(_FakeSchedulerClient.added) == 1
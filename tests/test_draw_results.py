@@ -0,0 +1,93 @@
+import importlib
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+
+
+class _UnusedClient:
+    def __init__(self, *args, **kwargs):
+        raise AssertionError("qBittorrent не должен вызываться")
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _UnusedClient)
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+        for lottery_id in ("wait01", "wait02", "done01"):
+            lottery = module.Lottery(id=lottery_id)
+            lottery.movies.append(module.Movie(name=f"Фильм {lottery_id}", year="2001", poster="p.jpg"))
+            module.db.session.add(lottery)
+        module.db.session.commit()
+        done = module.db.session.get(module.Lottery, "done01")
+        done.winner = done.movies[0]
+        done.result_name, done.result_poster, done.result_year = "Фильм done01", "p.jpg", "2001"
+        module.db.session.commit()
+    yield module
+
+
+def test_batch_results_use_single_query(app_module):
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app_module.app.app_context():
+        engine = app_module.db.engine
+        event.listen(engine, "before_cursor_execute", _record)
+        try:
+            response = app_module.app.test_client().get("/api/results?ids=wait01,done01,nope99&wait=5")
+        finally:
+            event.remove(engine, "before_cursor_execute", _record)
+
+    assert response.get_json() == {
+        "drawn": {"done01": {"name": "Фильм done01", "poster": "p.jpg", "year": "2001"}},
+        "pending": ["wait01"],
+        "missing": ["nope99"],
+    }
+    assert len(statements) == 1
+
+
+def test_long_poll_returns_when_listed_lottery_is_drawn(app_module):
+    module = app_module
+    client = module.app.test_client()
+
+    def _draw():
+        time.sleep(0.2)
+        module.event_broker.publish("lottery_drawn", {"lottery_id": "other1", "result": {}})
+        module.app.test_client().post("/draw/wait02")
+
+    threading.Thread(target=_draw).start()
+    started = time.monotonic()
+    payload = client.get("/api/results?ids=wait01,wait02&wait=5").get_json()
+
+    assert time.monotonic() - started < 3
+    assert list(payload["drawn"]) == ["wait02"]
+    assert payload["pending"] == ["wait01"]
+
+
+def test_long_poll_times_out_with_pending_state(monkeypatch, app_module):
+    monkeypatch.setattr(app_module, "RESULTS_LONG_POLL_MAX", 0.2)
+
+    started = time.monotonic()
+    payload = app_module.app.test_client().get("/api/results?ids=wait01&wait=30").get_json()
+
+    assert 0.2 <= time.monotonic() - started < 2
+    assert payload == {"drawn": {}, "pending": ["wait01"], "missing": []}
+
+
+@pytest.mark.parametrize("query", ["", "?ids=", "?ids=wait01&wait=soon"])
+def test_invalid_requests_are_rejected(app_module, query):
+    assert app_module.app.test_client().get(f"/api/results{query}").status_code == 400
@@ -0,0 +1,150 @@
+import importlib
+import json
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+
+class _FakeSyncClient:
+    responses = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        if not _FakeSyncClient.responses:
+            return {"rid": rid}
+        return _FakeSyncClient.responses.pop(0)
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeSyncClient)
+    monkeypatch.setattr(module, "EVENT_STREAM_MAX_DURATION", 0.2)
+    monkeypatch.setattr(module, "EVENT_HEARTBEAT_INTERVAL", 0.05)
+    monkeypatch.setattr(module.torrent_sync, "interval", 0.05)
+    _FakeSyncClient.responses = []
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def _read_events(response):
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line and not line.startswith(":"))
+        if "event" in fields:
+            events.append((int(fields["id"]), fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_draw_is_pushed_to_filtered_subscribers(app_module):
+    module = app_module
+    with module.app.app_context():
+        lottery = module.Lottery(id="abc123")
+        lottery.movies.append(module.Movie(name="Фильм", year="2001", poster="p.jpg"))
+        module.db.session.add(lottery)
+        module.db.session.add(module.Lottery(id="other1"))
+        module.db.session.commit()
+    module.event_broker.publish("lottery_drawn", {"lottery_id": "other1", "result": {}})
+
+    client = module.app.test_client()
+    assert client.post("/draw/abc123").status_code == 200
+
+    response = client.get(
+        "/api/events?types=lottery_drawn&lottery=abc123",
+        headers={"Last-Event-ID": "0"},
+    )
+
+    assert response.mimetype == "text/event-stream"
+    events = _read_events(response)
+    assert [(event_type, data["lottery_id"]) for _, event_type, data in events] == [("lottery_drawn", "abc123")]
+    assert events[0][2]["result"]["name"] == "Фильм"
+    assert ": heartbeat" in response.get_data(as_text=True)
+
+
+def test_torrent_changes_are_streamed_and_resumable(app_module):
+    module = app_module
+    _FakeSyncClient.responses = [
+        {"rid": 1, "full_update": True, "torrents": {"h1": {
+            "name": "Movie", "state": "downloading", "progress": 0.1, "dlspeed": 0, "eta": 60,
+            "num_seeds": 1, "num_leechs": 0, "category": "library-5", "tags": "kp-42",
+        }}},
+        {"rid": 2, "torrents": {"h1": {"progress": 0.2}}},
+    ]
+    client = module.app.test_client()
+
+    events = _read_events(client.get("/api/events?kp=42", headers={"Last-Event-ID": "0"}))
+
+    assert [data["progress"] for _, event_type, data in events if event_type == "torrent"] == ["10.0", "20.0"]
+    assert all(data["kinopoisk_id"] == 42 for _, _, data in events)
+
+    resumed = _read_events(client.get("/api/events?library=5", headers={"Last-Event-ID": str(events[0][0])}))
+    assert [data["progress"] for _, _, data in resumed] == ["20.0"]
+
+
+def test_stale_last_event_id_requests_resync(app_module):
+    module = app_module
+    client = module.app.test_client()
+
+    events = _read_events(client.get("/api/events", headers={"Last-Event-ID": "999"}))
+
+    assert events[0][1] == "resync"
+
+
+def _draw_in_another_worker(monkeypatch, module):
+    """Подменяет load_draw_results: при второй проверке лотерею разыгрывает "другой воркер"."""
+    monkeypatch.setattr(module, "EVENT_DRAW_POLL_INTERVAL", 0.05)
+    with module.app.app_context():
+        module.db.session.add(module.Lottery(id="abc123"))
+        module.db.session.commit()
+    client = module.app.test_client()
+    load_draw_results = module.load_draw_results
+    checks = []
+
+    def draw_elsewhere(lottery_ids):
+        checks.append(set(lottery_ids))
+        if len(checks) == 2:
+            # Розыгрыш провёл другой воркер: в шину этого процесса он не попал
+            with module.app.app_context():
+                lottery = module.db.session.get(module.Lottery, "abc123")
+                lottery.result_name, lottery.result_year = "Фильм", "2001"
+                module.db.session.commit()
+        return load_draw_results(lottery_ids)
+
+    monkeypatch.setattr(module, "load_draw_results", draw_elsewhere)
+    return client, checks
+
+
+def test_draw_in_another_worker_reaches_event_stream(monkeypatch, app_module):
+    client, _ = _draw_in_another_worker(monkeypatch, app_module)
+
+    events = _read_events(client.get("/api/events?types=lottery_drawn&lottery=abc123"))
+
+    assert [(event_type, data["lottery_id"]) for _, event_type, data in events] == [("lottery_drawn", "abc123")]
+    assert events[0][2]["result"]["name"] == "Фильм"
+    assert app_module.event_broker.last_id == 0
+
+
+def test_draw_in_another_worker_releases_long_poll(monkeypatch, app_module):
+    client, checks = _draw_in_another_worker(monkeypatch, app_module)
+
+    started = time.monotonic()
+    results = client.get("/api/results?ids=abc123&wait=5").get_json()
+
+    assert time.monotonic() - started < 1
+    assert results["drawn"]["abc123"]["name"] == "Фильм"
+    assert len(checks) == 3
@@ -0,0 +1,99 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+
+
+class _FakeSyncClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        return {"rid": rid + 1, "full_update": True, "torrents": {}}
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeSyncClient)
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def _seed_lotteries(module, count, start=0):
+    with module.app.app_context():
+        for index in range(start, start + count):
+            lottery = module.Lottery(id=f"l{index:05d}", result_name=f"Фильм {index}-0", result_year="2000")
+            for movie_index in range(3):
+                lottery.movies.append(module.Movie(
+                    kinopoisk_id=index * 10 + movie_index, name=f"Фильм {index}-{movie_index}", year="2000",
+                ))
+            lottery.winner = lottery.movies[0]
+            module.db.session.add(lottery)
+            module.db.session.add(module.MovieIdentifier(kinopoisk_id=index * 10, magnet_link=f"magnet:?xt={index}"))
+            module.db.session.add(module.LibraryMovie(kinopoisk_id=index * 10, name=f"Фильм {index}-0", year="2000"))
+        module.db.session.commit()
+
+
+def _count_queries(module, path):
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with module.app.app_context():
+        engine = module.db.engine
+        event.listen(engine, "before_cursor_execute", _record)
+        try:
+            response = module.app.test_client().get(path)
+        finally:
+            event.remove(engine, "before_cursor_execute", _record)
+    assert response.status_code == 200
+    return response, len(statements)
+
+
+@pytest.mark.parametrize("path", ["/history", "/library"])
+def test_page_query_count_does_not_grow_with_archive(app_module, path):
+    _seed_lotteries(app_module, 2)
+    _, small = _count_queries(app_module, path)
+
+    _seed_lotteries(app_module, 30, start=2)
+    response, large = _count_queries(app_module, path)
+
+    assert large == small
+    assert "magnet:?xt=31" in response.get_data(as_text=True)
+
+
+def test_winner_is_referenced_even_with_duplicate_titles(app_module):
+    module = app_module
+    with module.app.app_context():
+        lottery = module.Lottery(id="dup001")
+        lottery.movies.append(module.Movie(name="Дюна", year="1984", kinopoisk_id=1))
+        lottery.movies.append(module.Movie(name="Дюна", year="2021", kinopoisk_id=2))
+        module.db.session.add(lottery)
+        module.db.session.commit()
+    client = module.app.test_client()
+
+    drawn = client.post("/draw/dup001").get_json()
+    result = client.get("/api/result/dup001").get_json()["result"]
+
+    assert result["year"] == drawn["year"]
+    with module.app.app_context():
+        lottery = module.db.session.get(module.Lottery, "dup001")
+        assert lottery.winner.year == drawn["year"]
+        module.db.session.delete(lottery)
+        module.db.session.commit()
+        assert module.Movie.query.count() == 0
@@ -0,0 +1,156 @@
+import importlib
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+
+class _Torrent:
+    def __init__(self, torrent_hash):
+        self.hash = torrent_hash
+
+
+class _FakeQueueClient:
+    added = []
+    deleted = []
+    failures = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def _maybe_fail(self):
+        if _FakeQueueClient.failures:
+            raise _FakeQueueClient.failures.pop(0)
+
+    def torrents_add(self, **kwargs):
+        self._maybe_fail()
+        _FakeQueueClient.added.append(kwargs)
+
+    def torrents_info(self, category=None):
+        self._maybe_fail()
+        return [_Torrent(f"hash-{category}")]
+
+    def torrents_delete(self, delete_files=False, torrent_hashes=None):
+        self._maybe_fail()
+        _FakeQueueClient.deleted.append(torrent_hashes)
+
+
+@pytest.fixture
+def app_module(monkeypatch, tmp_path):
+    # Файловая БД: потоки JobWorker открывают свои соединения, как в рабочем режиме
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'jobs.sqlite3'}")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeQueueClient)
+    _FakeQueueClient.added = []
+    _FakeQueueClient.deleted = []
+    _FakeQueueClient.failures = []
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+        module.db.session.add(module.LibraryMovie(id=1, kinopoisk_id=42, name="Фильм", year="2000"))
+        module.db.session.add(module.MovieIdentifier(kinopoisk_id=42, magnet_link="magnet:?xt=urn:btih:42"))
+        module.db.session.commit()
+    yield module
+    module.job_worker.stop()
+
+
+def _offline():
+    return sys.modules["app"].qbittorrent_exceptions.APIConnectionError("offline")
+
+
+def test_download_runs_through_queue_and_is_idempotent(app_module):
+    client = app_module.app.test_client()
+    headers = {"Idempotency-Key": "click-1"}
+
+    first = client.post("/api/library/start-download/1", headers=headers)
+    second = client.post("/api/library/start-download/1", headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert first.get_json()["job_id"] == second.get_json()["job_id"]
+    assert first.get_json()["message"] == "Загрузка началась!"
+    assert _FakeQueueClient.added == [{
+        "urls": "magnet:?xt=urn:btih:42", "category": "library-1",
+        "is_sequential_download": True, "is_first_last_piece_priority": True, "tags": "kp-42",
+    }]
+    job = client.get(f"/api/jobs/{first.get_json()['job_id']}").get_json()
+    assert job["status"] == "done" and job["attempts"] == 1
+
+
+def test_transient_failure_is_retried_with_backoff(app_module):
+    module = app_module
+    _FakeQueueClient.failures = [_offline()]
+    client = module.app.test_client()
+
+    response = client.post("/api/library/start-download/1")
+
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+    with module.app.app_context():
+        job = module.db.session.get(module.Job, job_id)
+        assert job.status == "pending" and job.attempts == 1 and "offline" in job.last_error
+        assert job.run_at > datetime.utcnow()
+        assert module.job_worker.run_pending() == 0
+
+        job.run_at = datetime.utcnow() - timedelta(seconds=1)
+        module.db.session.commit()
+        assert module.job_worker.run_pending() == 1
+        assert module.db.session.get(module.Job, job_id).status == "done"
+    assert len(_FakeQueueClient.added) == 1
+
+
+def test_rejected_torrent_fails_without_retry(app_module):
+    _FakeQueueClient.failures = [app_module.qbittorrent_exceptions.UnsupportedMediaType415Error("bad magnet")]
+
+    response = app_module.app.test_client().post("/api/library/start-download/1")
+
+    assert response.status_code == 502
+    assert response.get_json()["status"] == "failed"
+    assert "bad magnet" in response.get_json()["message"]
+
+
+def test_delete_lottery_keeps_torrent_deletion_in_outbox(app_module):
+    module = app_module
+    with module.app.app_context():
+        module.db.session.add(module.Lottery(id="abc123"))
+        module.db.session.commit()
+    _FakeQueueClient.failures = [_offline()]
+
+    response = module.app.test_client().post("/delete-lottery/abc123")
+
+    assert response.get_json()["success"] is True
+    assert response.get_json()["status"] == "pending"
+    with module.app.app_context():
+        assert module.db.session.get(module.Lottery, "abc123") is None
+        module.Job.query.update({"run_at": datetime.utcnow() - timedelta(seconds=1)})
+        module.db.session.commit()
+        module.job_worker.run_pending()
+    assert _FakeQueueClient.deleted == [["hash-lottery-abc123"]]
+
+
+def test_worker_threads_pick_up_queued_jobs(app_module):
+    module = app_module
+    with module.app.app_context():
+        job = module.enqueue_job("torrent_delete", {"hashes": ["h1"]})
+        module.db.session.commit()
+        job_id = job.id
+
+    module.job_worker.poll_interval = 0.01
+    module.job_worker.start()
+    deadline = time.monotonic() + 5
+    while not _FakeQueueClient.deleted and time.monotonic() < deadline:
+        time.sleep(0.01)
+    module.job_worker.stop()
+
+    assert _FakeQueueClient.deleted == [["h1"]]
+    with module.app.app_context():
+        assert module.db.session.get(module.Job, job_id).status == "done"
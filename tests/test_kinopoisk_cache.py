@@ -0,0 +1,140 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+
+class _FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+    def json(self):
+        return self._payload
+
+
+class _FakeKinopoiskSession:
+    def __init__(self):
+        self.calls = []
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        self.calls.append({"url": url, "params": params, "timeout": timeout})
+        if url.endswith("/movie"):
+            ids = [value for key, value in params if key == "id" and value != 404]
+            return _FakeResponse(200, {"docs": [{"id": movie_id, "name": f"Фильм {movie_id}"} for movie_id in ids]})
+        if url.endswith("/movie/404"):
+            return _FakeResponse(404, {})
+        if url.endswith("/movie/search") and params["query"] == "nothing":
+            return _FakeResponse(200, {"docs": []})
+        return _FakeResponse(200, {"docs": [{
+            "id": 326,
+            "name": "Побег из Шоушенка",
+            "year": 1994,
+            "poster": {"url": "https://example.com/326.jpg"},
+            "description": "Описание",
+            "rating": {"kp": 9.1},
+            "genres": [{"name": "драма"}],
+            "countries": [{"name": "США"}],
+        }]})
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    session = _FakeKinopoiskSession()
+    monkeypatch.setattr(module, "kinopoisk_session", session)
+    module.session_stub = session
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def test_repeated_query_is_served_from_cache(app_module):
+    client = app_module.app.test_client()
+
+    first = client.post("/fetch-movie", json={"query": "Побег  из ШОУШЕНКА"})
+    second = client.post("/fetch-movie", json={"query": "побег из шоушенка"})
+    by_link = client.post("/fetch-movie", json={"query": "https://www.kinopoisk.ru/film/326/"})
+
+    assert first.status_code == second.status_code == by_link.status_code == 200
+    assert first.get_json() == second.get_json() == by_link.get_json()
+    assert len(app_module.session_stub.calls) == 1
+    assert app_module.session_stub.calls[0]["timeout"] is not None
+    stats = client.get("/api/kinopoisk/cache-stats").get_json()
+    assert stats["memory_hits"] == 2
+    assert stats["misses"] == 1
+
+
+def test_cache_survives_process_memory_and_caches_not_found(app_module):
+    client = app_module.app.test_client()
+
+    assert client.post("/fetch-movie", json={"query": "nothing"}).status_code == 404
+    assert client.post("/fetch-movie", json={"query": "https://www.kinopoisk.ru/film/404/"}).status_code == 404
+    assert client.post("/fetch-movie", json={"query": "Побег из Шоушенка"}).status_code == 200
+    app_module.kinopoisk_cache.memory.clear()
+
+    assert client.post("/fetch-movie", json={"query": "nothing"}).status_code == 404
+    assert client.post("/fetch-movie", json={"query": "https://www.kinopoisk.ru/film/404/"}).status_code == 404
+    assert client.post("/fetch-movie", json={"query": "Побег из Шоушенка"}).get_json()["kinopoisk_id"] == 326
+
+    assert len(app_module.session_stub.calls) == 3
+    assert app_module.kinopoisk_cache.stats["db_hits"] == 3
+    assert app_module.kinopoisk_cache.stats["negative_hits"] == 2
+
+
+def test_stored_library_movie_is_used_as_warm_source(app_module):
+    module = app_module
+    with module.app.app_context():
+        module.db.session.add(module.LibraryMovie(
+            kinopoisk_id=555, name="Сталкер", year="1979", poster="https://example.com/555.jpg",
+            description="Зона", rating_kp=8.1, genres="драма", countries="СССР",
+        ))
+        module.db.session.commit()
+
+    response = module.app.test_client().post("/fetch-movie", json={"query": "https://www.kinopoisk.ru/film/555/"})
+
+    assert response.get_json()["name"] == "Сталкер"
+    assert module.session_stub.calls == []
+    assert module.kinopoisk_cache.stats["warm_hits"] == 1
+
+
+def test_batch_resolves_queries_in_order_with_one_id_lookup(app_module):
+    client = app_module.app.test_client()
+
+    response = client.post("/fetch-movie/batch", json={"queries": [
+        "https://www.kinopoisk.ru/film/10/",
+        "Побег из Шоушенка",
+        "nothing",
+        "https://www.kinopoisk.ru/film/404/",
+        "https://www.kinopoisk.ru/film/20/",
+        "побег  из шоушенка",
+    ]})
+
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [item.get("movie", {}).get("name") for item in results] == [
+        "Фильм 10", "Побег из Шоушенка", None, None, "Фильм 20", "Побег из Шоушенка",
+    ]
+    assert results[2] == {"query": "nothing", "error": "Фильм не найден"}
+    assert results[3]["error"] == "Фильм не найден"
+
+    calls = app_module.session_stub.calls
+    id_calls = [call for call in calls if call["url"].endswith("/movie")]
+    assert len(id_calls) == 1
+    assert ("id", 10) in id_calls[0]["params"] and ("id", 404) in id_calls[0]["params"]
+    assert len(calls) == 3
+
+    assert client.post("/fetch-movie", json={"query": "https://www.kinopoisk.ru/film/404/"}).status_code == 404
+    assert len(app_module.session_stub.calls) == 3
@@ -0,0 +1,102 @@
+import importlib
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+
+class _FakeResponse:
+    status_code = 404
+
+    def raise_for_status(self):
+        return None
+
+
+class _FakeKinopoiskSession:
+    def get(self, url, headers=None, params=None, timeout=None):
+        return _FakeResponse()
+
+
+class _FakeMetricsClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        return {"rid": 1, "full_update": True, "torrents": {"h1": {
+            "name": "Movie", "state": "downloading", "progress": 0.5, "category": "lottery-abc123", "tags": "kp-7",
+        }}}
+
+    def torrents_info(self, category=None):
+        raise sys.modules["app"].qbittorrent_exceptions.APIConnectionError("offline")
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeMetricsClient)
+    monkeypatch.setattr(module, "kinopoisk_session", _FakeKinopoiskSession())
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+        lottery = module.Lottery(id="abc123")
+        lottery.movies.append(module.Movie(name="Фильм", year="2001", kinopoisk_id=7))
+        module.db.session.add(lottery)
+        module.db.session.commit()
+    yield module
+
+
+def _sample(text, name, **labels):
+    for line in text.splitlines():
+        if line.startswith(name + ("{" if labels else " ")) and all(f'{key}="{value}"' in line for key, value in labels.items()):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_metrics_cover_routes_sql_and_upstreams(app_module):
+    client = app_module.app.test_client()
+    assert client.get("/api/result/abc123").status_code == 200
+    assert client.get("/api/result/abc123").status_code == 200
+    client.get("/api/torrent-status/abc123")
+    with app_module.app.app_context():
+        assert app_module.get_movie_data_from_kinopoisk("https://www.kinopoisk.ru/film/404/") is None
+
+    response = client.get("/metrics")
+
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert _sample(text, "movie_lottery_http_requests_total", endpoint="get_result_data", status="200") == 2
+    assert _sample(text, "movie_lottery_http_request_duration_seconds_count", endpoint="get_result_data") == 2
+    assert _sample(text, "movie_lottery_http_request_duration_seconds_bucket", endpoint="get_result_data", le="+Inf") == 2
+    assert _sample(text, "movie_lottery_http_request_sql_queries_sum", endpoint="get_result_data") >= 4
+    assert _sample(text, "movie_lottery_sql_queries_total") > 0
+    assert _sample(text, "movie_lottery_qbittorrent_requests_total", operation="sync_maindata", outcome="ok") == 1
+    assert _sample(text, "movie_lottery_qbittorrent_requests_total", operation="torrents_info", outcome="APIConnectionError") == 1
+    assert _sample(text, "movie_lottery_kinopoisk_requests_total", outcome="not_found") == 1
+    assert _sample(text, "movie_lottery_kinopoisk_cache_lookups_total", result="misses") == 1
+    assert _sample(text, "movie_lottery_torrents_tracked") == 1
+    assert _sample(text, "movie_lottery_torrent_sync_lag_seconds") >= 0
+    assert re.search(r"^# TYPE movie_lottery_http_request_duration_seconds histogram$", text, re.M)
+
+
+def test_histogram_buckets_are_cumulative_and_labels_escaped(app_module):
+    registry = app_module.MetricsRegistry()
+    histogram = registry.histogram("demo_seconds", "Демо.", ("path",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, path='a"b\\c')
+
+    lines = registry.render().splitlines()
+
+    assert 'demo_seconds_bucket{path="a\\"b\\\\c",le="0.1"} 1' in lines
+    assert 'demo_seconds_bucket{path="a\\"b\\\\c",le="1"} 2' in lines
+    assert 'demo_seconds_bucket{path="a\\"b\\\\c",le="+Inf"} 3' in lines
+    assert 'demo_seconds_sum{path="a\\"b\\\\c"} 5.55' in lines
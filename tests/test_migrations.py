@@ -0,0 +1,92 @@
+import importlib
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from sqlalchemy import inspect
+
+
+HOT_INDEXES = {
+    "movie": {"ix_movie_kinopoisk_id", "ix_movie_lottery_id"},
+    "lottery": {"ix_lottery_created_at_id"},
+    "library_movie": {"ix_library_movie_added_at_id", "ix_library_movie_name_year"},
+    "background_photo": {"ix_background_photo_added_at"},
+}
+
+
+@pytest.fixture
+def app_module(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'legacy.db'}")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    yield module
+
+
+def _make_legacy_schema(module):
+    """Схема, какой она была до индексов, журнала миграций и версий."""
+    with module.app.app_context():
+        module.db.create_all()
+        with module.db.engine.begin() as connection:
+            for table in module.db.metadata.sorted_tables:
+                for index in table.indexes:
+                    if index.name in set().union(*HOT_INDEXES.values()):
+                        index.drop(connection)
+            module.KinopoiskCacheEntry.__table__.drop(connection)
+            module.SchemaMigration.__table__.drop(connection)
+            connection.exec_driver_sql(
+                "CREATE TABLE lottery_legacy AS SELECT id, created_at, result_name, result_poster, result_year FROM lottery"
+            )
+            connection.exec_driver_sql("DROP TABLE lottery")
+            connection.exec_driver_sql("ALTER TABLE lottery_legacy RENAME TO lottery")
+            connection.exec_driver_sql("ALTER TABLE movie_identifier DROP COLUMN updated_at")
+            connection.exec_driver_sql(
+                "INSERT INTO lottery (id, created_at, result_name) VALUES ('old001', '2020-01-01 00:00:00', 'Победитель')"
+            )
+            connection.exec_driver_sql(
+                "INSERT INTO movie (id, name, year, kinopoisk_id, lottery_id) VALUES "
+                "(1, 'Старый фильм', '1999', 1, 'old001'), (2, 'Победитель', '2001', 2, 'old001')"
+            )
+
+
+def _index_names(module, table):
+    with module.app.app_context():
+        return {index["name"] for index in inspect(module.db.engine).get_indexes(table)}
+
+
+def test_migrations_add_indexes_in_place(app_module):
+    module = app_module
+    _make_legacy_schema(module)
+    assert not HOT_INDEXES["movie"] & _index_names(module, "movie")
+
+    with module.app.app_context():
+        assert module.run_migrations() == [1, 2, 3, 4, 5, 6, 7, 8, 9]
+        assert module.run_migrations() == []
+        lottery = module.db.session.get(module.Lottery, "old001")
+        assert [movie.name for movie in lottery.movies] == ["Старый фильм", "Победитель"]
+        assert lottery.winner.id == 2
+        assert lottery.version == 1
+        assert lottery.updated_at == datetime(2020, 1, 1)
+        assert inspect(module.db.engine).has_table("kinopoisk_cache")
+        assert inspect(module.db.engine).has_table("download_request")
+        assert "ix_download_request_idempotency_key" in _index_names(module, "download_request")
+        assert inspect(module.db.engine).has_table("service_lease")
+
+    for table, names in HOT_INDEXES.items():
+        assert names <= _index_names(module, table)
+
+
+def test_migrate_db_cli_command(app_module):
+    module = app_module
+    _make_legacy_schema(module)
+    runner = module.app.test_cli_runner()
+
+    first = runner.invoke(args=["migrate-db"])
+    second = runner.invoke(args=["migrate-db"])
+
+    assert "Применено миграций: 9" in first.output
+    assert "уже актуальна" in second.output
@@ -0,0 +1,94 @@
+import importlib
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+
+class _FakeSyncClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        return {"rid": rid + 1, "full_update": True, "torrents": {}}
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeSyncClient)
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def _walk(client, path, limit):
+    seen, cursor = [], None
+    while True:
+        url = f"{path}?limit={limit}" + (f"&cursor={cursor}" if cursor else "")
+        payload = client.get(url).get_json()
+        seen.append([item["id"] for item in payload["items"]])
+        cursor = payload["next_cursor"]
+        if not cursor:
+            return seen
+
+
+def test_history_pages_follow_created_at_then_id(app_module):
+    module = app_module
+    base = datetime(2024, 1, 1)
+    with module.app.app_context():
+        # Три лотереи с одинаковым временем проверяют разбор «ничьих» по id
+        for index, lottery_id in enumerate(["aaa001", "aaa002", "aaa003", "bbb001", "ccc001"]):
+            created_at = base + timedelta(minutes=min(index, 2))
+            lottery = module.Lottery(id=lottery_id, created_at=created_at)
+            if lottery_id == "bbb001":
+                lottery.result_name = "Фильм"
+                lottery.winner = module.Movie(name="Фильм", year="2000", kinopoisk_id=7)
+                lottery.movies.append(lottery.winner)
+                module.db.session.add(module.MovieIdentifier(kinopoisk_id=7, magnet_link="magnet:?xt=7"))
+            module.db.session.add(lottery)
+        module.db.session.commit()
+    client = module.app.test_client()
+
+    pages = _walk(client, "/api/history", limit=2)
+
+    assert pages == [["ccc001", "bbb001"], ["aaa003", "aaa002"], ["aaa001"]]
+    first = client.get("/api/history?limit=2").get_json()["items"]
+    assert first[1]["result"]["magnet_link"] == "magnet:?xt=7"
+    assert first[0]["result"] is None
+
+
+def test_first_page_is_server_rendered_with_cursor(monkeypatch, app_module):
+    module = app_module
+    monkeypatch.setattr(module, "LIBRARY_PAGE_SIZE", 2)
+    with module.app.app_context():
+        for index in range(3):
+            module.db.session.add(module.LibraryMovie(
+                name=f"Фильм {index}", year="2000", added_at=datetime(2024, 1, 1, 0, index),
+            ))
+        module.db.session.commit()
+    client = module.app.test_client()
+
+    html = client.get("/library").get_data(as_text=True)
+
+    assert "Фильм 2" in html and "Фильм 1" in html and "Фильм 0" not in html
+    assert 'data-next-cursor=""' not in html
+    assert _walk(client, "/api/library", limit=2) == [[3, 2], [1]]
+
+
+def test_invalid_cursor_is_rejected(app_module):
+    client = app_module.app.test_client()
+
+    assert client.get("/api/history?cursor=%%%").status_code == 400
+    assert client.get("/api/library?cursor=bm90LWEtY3Vyc29y").status_code == 400
@@ -0,0 +1,149 @@
+import importlib
+import io
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+
+class _PosterServer:
+    """Локальная замена CDN Кинопоиска."""
+
+    def __init__(self):
+        self.images = {}
+        self.hits = []
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.hits.append(self.path)
+                body = server.images.get(self.path)
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def add(self, path, body):
+        self.images[path] = body
+        return self.base_url + path
+
+
+@pytest.fixture
+def poster_server():
+    server = _PosterServer()
+    yield server
+    server.httpd.shutdown()
+
+
+@pytest.fixture
+def app_module(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    monkeypatch.setenv("POSTER_CACHE_DIR", str(tmp_path / "posters"))
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def _remember(module, *urls):
+    with module.app.app_context():
+        for index, url in enumerate(urls):
+            module.db.session.add(module.LibraryMovie(name=f"Фильм {index}", poster=url))
+        module.db.session.commit()
+
+
+def test_poster_is_fetched_once_and_served_with_http_caching(app_module, poster_server):
+    url = poster_server.add("/a.png", b"\x89PNG-a" * 100)
+    _remember(app_module, url)
+    client = app_module.app.test_client()
+
+    first = client.get("/poster/card", query_string={"url": url})
+    again = client.get("/poster/card", query_string={"url": url})
+    modal = client.get("/poster/modal", query_string={"url": url})
+    conditional = client.get("/poster/card", query_string={"url": url}, headers={"If-None-Match": first.headers["ETag"]})
+
+    assert first.status_code == 200
+    assert first.data == b"\x89PNG-a" * 100
+    assert first.headers["ETag"] == again.headers["ETag"]
+    assert "immutable" in first.headers["Cache-Control"]
+    assert "max-age" in first.headers["Cache-Control"]
+    assert modal.status_code == 200
+    assert conditional.status_code == 304
+    assert poster_server.hits == ["/a.png"]
+
+
+def test_unknown_and_unreachable_posters(app_module, poster_server):
+    client = app_module.app.test_client()
+    stranger = poster_server.add("/stranger.png", b"x")
+    missing = poster_server.base_url + "/missing.png"
+    _remember(app_module, missing)
+
+    assert client.get("/poster/card", query_string={"url": stranger}).status_code == 404
+    assert client.get("/poster/huge", query_string={"url": missing}).status_code == 404
+    fallback = client.get("/poster/card", query_string={"url": missing})
+
+    assert fallback.status_code == 302
+    assert fallback.headers["Location"] == missing
+    assert poster_server.hits == ["/missing.png"]
+
+
+def test_least_recently_used_posters_are_evicted(app_module, poster_server):
+    urls = [poster_server.add(f"/{name}.png", name.encode() * 400) for name in ("a", "b", "c")]
+    _remember(app_module, *urls)
+    app_module.poster_cache.max_bytes = 1000
+    client = app_module.app.test_client()
+
+    for url in urls:
+        assert client.get("/poster/card", query_string={"url": url}).status_code == 200
+
+    assert app_module.poster_cache.lookup(urls[0], "card") is None
+    assert app_module.poster_cache.lookup(urls[2], "card") is not None
+    assert client.get("/poster/card", query_string={"url": urls[0]}).data == b"a" * 400
+    assert poster_server.hits.count("/a.png") == 2
+
+
+def test_variants_are_resized_when_pillow_is_available(app_module, poster_server):
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.effect_noise((1200, 1800), 64).convert("RGB").save(buffer, "PNG")
+    url = poster_server.add("/big.png", buffer.getvalue())
+    _remember(app_module, url)
+
+    response = app_module.app.test_client().get("/poster/card", query_string={"url": url})
+
+    assert response.mimetype == "image/jpeg"
+    assert Image.open(io.BytesIO(response.data)).size == (300, 450)
+
+
+def test_disabled_proxy_redirects_only_to_known_posters(monkeypatch, app_module):
+    monkeypatch.setattr(app_module, "POSTER_PROXY_ENABLED", False)
+    known = "https://posters.example/known.jpg"
+    _remember(app_module, known)
+    client = app_module.app.test_client()
+
+    redirected = client.get("/poster/card", query_string={"url": known})
+    foreign = client.get("/poster/card", query_string={"url": "https://evil.example/phish"})
+
+    assert redirected.status_code == 302
+    assert redirected.headers["Location"] == known
+    assert foreign.status_code == 404
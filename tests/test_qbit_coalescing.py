@@ -0,0 +1,123 @@
+import importlib
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+
+class _SlowClient:
+    calls = []
+    release = None
+    error = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def torrents_info(self, **kwargs):
+        _SlowClient.calls.append(kwargs)
+        if _SlowClient.release is not None:
+            _SlowClient.release.wait(timeout=5)
+        if _SlowClient.error is not None:
+            raise _SlowClient.error
+        return [{"hash": "h1", **kwargs}]
+
+    def torrents_delete(self, **kwargs):
+        _SlowClient.calls.append(("delete", kwargs))
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _SlowClient)
+    _SlowClient.calls = []
+    _SlowClient.release = None
+    _SlowClient.error = None
+    yield module
+
+
+def _run_concurrently(module, count, **kwargs):
+    results = [None] * count
+    errors = [None] * count
+
+    def worker(index):
+        try:
+            results[index] = module.qbit_request('torrents_info', **kwargs)
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def _wait_for_waiters(module, count):
+    for _ in range(500):
+        if module.QBIT_COALESCED.value(operation='torrents_info', source='inflight') >= count:
+            return
+        threading.Event().wait(0.01)
+
+
+def test_concurrent_identical_reads_share_one_call(app_module):
+    module = app_module
+    _SlowClient.release = threading.Event()
+
+    threads, results, errors = _run_concurrently(module, 5, category="library-1")
+    _wait_for_waiters(module, 4)
+    _SlowClient.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert errors == [None] * 5
+    assert _SlowClient.calls == [{"category": "library-1"}]
+    assert all(result == [{"hash": "h1", "category": "library-1"}] for result in results)
+    assert len({id(result) for result in results}) == 5
+    assert module.QBIT_COALESCED.value(operation='torrents_info', source='inflight') == 4
+
+    # Ответ ещё держится в микрокэше, другой ключ идёт отдельным вызовом
+    module.qbit_request('torrents_info', category="library-1")
+    module.qbit_request('torrents_info', tag="kp-1")
+    assert len(_SlowClient.calls) == 2
+    assert module.QBIT_COALESCED.value(operation='torrents_info', source='cache') == 1
+
+
+def test_errors_are_shared_but_not_cached(app_module):
+    module = app_module
+    _SlowClient.release = threading.Event()
+    _SlowClient.error = module.qbittorrent_exceptions.APIConnectionError("offline")
+
+    threads, _, errors = _run_concurrently(module, 3)
+    _wait_for_waiters(module, 2)
+    _SlowClient.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(_SlowClient.calls) == 1
+    assert all(isinstance(error, module.qbittorrent_exceptions.APIConnectionError) for error in errors)
+
+    _SlowClient.release = None
+    _SlowClient.error = None
+    assert module.qbit_request('torrents_info') == [{"hash": "h1"}]
+    assert len(_SlowClient.calls) == 2
+
+
+def test_writes_invalidate_micro_cache(app_module):
+    module = app_module
+
+    module.qbit_request('torrents_info', category="library-1")
+    module.qbit_request('torrents_delete', torrent_hashes=["h1"])
+    module.qbit_request('torrents_info', category="library-1")
+
+    assert [call for call in _SlowClient.calls if call == {"category": "library-1"}] == [
+        {"category": "library-1"}, {"category": "library-1"},
+    ]
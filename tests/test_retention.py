@@ -0,0 +1,173 @@
+import importlib
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+DAY = 24 * 3600
+
+
+class _FakeRetentionClient:
+    torrents = {}
+    server_state = {}
+    deleted = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        return {
+            "rid": rid + 1, "full_update": True,
+            "torrents": dict(_FakeRetentionClient.torrents), "server_state": dict(_FakeRetentionClient.server_state),
+        }
+
+    def torrents_delete(self, delete_files=False, torrent_hashes=None):
+        _FakeRetentionClient.deleted.append(list(torrent_hashes))
+
+
+def _torrent(category, days_ago, size=100, progress=1.0, tags=""):
+    now = time.time()
+    return {
+        "name": category, "category": category, "tags": tags, "progress": progress, "size": size,
+        "completed": int(size * progress), "added_on": int(now - days_ago * DAY - 3600),
+        "completion_on": int(now - days_ago * DAY) if progress >= 1 else -1,
+    }
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeRetentionClient)
+    _FakeRetentionClient.torrents = {}
+    _FakeRetentionClient.server_state = {"free_space_on_disk": 10 ** 12}
+    _FakeRetentionClient.deleted = []
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+    module.job_worker.stop()
+
+
+def test_old_completed_torrents_are_deleted_but_library_and_active_kept(monkeypatch, app_module):
+    module = app_module
+    monkeypatch.setattr(module.retention_manager, "max_age", timedelta(days=30))
+    _FakeRetentionClient.torrents = {
+        "old": _torrent("lottery-old", 40, tags="kp-1"),
+        "fresh": _torrent("lottery-new", 1),
+        "lib": _torrent("library-7", 100),
+        "partial": _torrent("lottery-partial", 90, progress=0.5),
+        "foreign": _torrent("tv", 365),
+    }
+
+    with module.app.app_context():
+        report = module.retention_manager.run()
+
+    assert [(item["hash"], item["reason"]) for item in report["deleted"]] == [("old", "age")]
+    assert report["freed_bytes"] == 100
+    assert report["usage"]["categories"]["library-7"] == 100
+    assert report["usage"]["kinopoisk"] == {"1": 100}
+    assert report["usage"]["managed_bytes"] == 350
+    assert _FakeRetentionClient.deleted == [["old"]]
+    assert module.RETENTION_FREED.value(reason="age") == 100
+
+
+def test_disk_limits_evict_least_recently_used_in_batches(monkeypatch, app_module):
+    module = app_module
+    manager = module.retention_manager
+    monkeypatch.setattr(manager, "max_total_bytes", 250)
+    monkeypatch.setattr(manager, "batch_size", 2)
+    _FakeRetentionClient.torrents = {
+        "a": _torrent("lottery-a", 30),
+        "b": _torrent("lottery-b", 20),
+        "c": _torrent("lottery-c", 10),
+    }
+    with module.app.app_context():
+        # Самую старую загрузку недавно смотрели: она остаётся, удаляется следующая
+        manager.touch("lottery-a")
+        assert [item["hash"] for item in manager.run()["deleted"]] == ["b"]
+
+        monkeypatch.setattr(manager, "min_free_bytes", 500)
+        _FakeRetentionClient.server_state = {"free_space_on_disk": 250}
+        module.torrent_snapshot.updated_at = None
+        report = manager.run()
+
+    assert [item["hash"] for item in report["deleted"]] == ["b", "c", "a"]
+    assert {item["reason"] for item in report["deleted"]} == {"disk_space"}
+    assert _FakeRetentionClient.deleted == [["b"], ["b", "c"], ["a"]]
+    assert len(report["jobs"]) == 2
+
+
+def test_report_endpoint_plans_without_deleting(monkeypatch, app_module):
+    module = app_module
+    client = module.app.test_client()
+    _FakeRetentionClient.torrents = {"old": _torrent("lottery-old", 40)}
+
+    assert client.post("/api/retention/run").status_code == 400
+
+    monkeypatch.setattr(module.retention_manager, "max_age", timedelta(days=7))
+    payload = client.get("/api/retention").get_json()
+
+    assert payload["enabled"] is True
+    assert payload["plan"]["dry_run"] is True
+    assert [item["hash"] for item in payload["plan"]["deleted"]] == ["old"]
+    assert payload["last_report"] is None
+    assert _FakeRetentionClient.deleted == []
+
+    run = client.post("/api/retention/run").get_json()
+    assert run["freed_bytes"] == 100
+    assert client.get("/api/retention").get_json()["last_report"]["freed_bytes"] == 100
+
+
+def test_nothing_is_deleted_from_stale_snapshot(monkeypatch, app_module):
+    module = app_module
+    monkeypatch.setattr(module.retention_manager, "max_age", timedelta(days=1))
+    _FakeRetentionClient.torrents = {"old": _torrent("lottery-old", 40)}
+    with module.app.app_context():
+        module.torrent_sync.refresh()
+        module.torrent_snapshot.mark_error("offline")
+        monkeypatch.setattr(module.torrent_sync, "ensure_fresh", lambda: None)
+        report = module.retention_manager.run()
+
+    assert report["deleted"] == []
+    assert "skipped" in report
+    assert _FakeRetentionClient.deleted == []
+
+
+def test_scheduled_pass_runs_once_per_interval_across_workers(monkeypatch, app_module):
+    module = app_module
+    manager = module.retention_manager
+    monkeypatch.setattr(manager, "max_age", timedelta(days=30))
+    _FakeRetentionClient.torrents = {"old": _torrent("lottery-old", 40)}
+    # Второй воркер: свой экземпляр с той же конфигурацией и общей БД
+    other_worker = module.RetentionManager(
+        max_total_bytes=0, min_free_bytes=0, max_age=timedelta(days=30),
+        keep_library=True, interval=manager.interval, batch_size=manager.batch_size,
+    )
+
+    with module.app.app_context():
+        report = manager.run_scheduled()
+        assert other_worker.run_scheduled() is None
+        assert manager.run_scheduled() is None
+
+        lease = module.db.session.get(module.ServiceLease, "retention")
+        lease.expires_at -= timedelta(seconds=manager.interval)
+        module.db.session.commit()
+        _FakeRetentionClient.torrents = {}
+        module.torrent_snapshot.updated_at = None
+        assert other_worker.run_scheduled()["deleted"] == []
+        assert manager.last_report()["generated_at"] != report["generated_at"]
+
+    assert [item["hash"] for item in report["deleted"]] == ["old"]
+    assert _FakeRetentionClient.deleted == [["old"]]
+    assert module.RETENTION_FREED.value(reason="age") == 100
@@ -72,7 +72,7 @@ def test_start_download_calls_search_helper(monkeypatch, app_module):
         searched_queries.append(query)
         return [
             {
-
+                "magnet": "magnet:?xt=urn:btih:abc",
             }
         ]
 
@@ -104,3 +104,62 @@ def test_start_download_calls_search_helper(monkeypatch, app_module):
     assert _FakeDownloadClient.last_category == "lottery-movie1"
 
 
+def test_start_download_rejects_hits_without_magnet(monkeypatch, app_module):
+    module = app_module
+    monkeypatch.setattr(module, "Client", _FakeDownloadClient)
+    _FakeDownloadClient.added.clear()
+    monkeypatch.setattr(module, "_search_torrents", lambda query: [{"title": "Без ссылки"}])
+
+    with module.app.app_context():
+        module.db.session.add(module.Lottery(id="movie2", result_name="Фильм", result_year="1999"))
+        module.db.session.commit()
+
+    response = module.app.test_client().post("/api/start-download/movie2")
+
+    assert response.status_code == 404
+    assert response.get_json()["message"] == "Раздача без magnet-ссылки."
+    assert _FakeDownloadClient.added == []
+    with module.app.app_context():
+        assert module.DownloadRequest.query.count() == 0
+
+
+def test_start_download_skips_hits_without_magnet(monkeypatch, app_module):
+    module = app_module
+    monkeypatch.setattr(module, "Client", _FakeDownloadClient)
+    _FakeDownloadClient.added.clear()
+    monkeypatch.setattr(module, "_search_torrents", lambda query: [{}, {"magnet": "magnet:?xt=urn:btih:abc"}])
+
+    with module.app.app_context():
+        module.db.session.add(module.Lottery(id="movie3", result_name="Фильм", result_year="1999"))
+        module.db.session.commit()
+
+    response = module.app.test_client().post("/api/start-download/movie3")
+
+    assert response.status_code == 200
+    assert [entry["urls"] for entry in _FakeDownloadClient.added] == ["magnet:?xt=urn:btih:abc"]
+
+
+def test_start_download_defers_search_to_job_queue(monkeypatch, app_module):
+    module = app_module
+    monkeypatch.setattr(module, "Client", _FakeDownloadClient)
+    _FakeDownloadClient.added.clear()
+    _FakeDownloadClient.last_category = None
+    searched_queries = []
+    monkeypatch.setattr(module, "_search_torrents", lambda query: searched_queries.append(query) or [])
+    # Как в рабочем режиме: задача только будит воркеры
+    monkeypatch.setattr(module, "submit_job", lambda job: job)
+
+    with module.app.app_context():
+        module.db.session.add(module.Lottery(id="movie4", result_name="Фильм", result_year="1999"))
+        module.db.session.commit()
+
+    response = module.app.test_client().post("/api/start-download/movie4")
+
+    assert response.status_code == 202
+    assert response.get_json()["status"] == "pending"
+    assert searched_queries == []
+    assert _FakeDownloadClient.last_category is None
+    with module.app.app_context():
+        job = module.Job.query.one()
+        assert job.kind == "lottery_download"
+        assert module.DownloadRequest.query.count() == 0
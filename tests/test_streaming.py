@@ -0,0 +1,160 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+PIECE_SIZE = 16
+DATA = bytes(range(100))
+
+
+class _StreamTorrent:
+    def __init__(self, save_path, progress=0.4):
+        self.hash = "h1"
+        self.save_path = save_path
+        self.progress = progress
+        self.seq_dl = True
+        self.f_l_piece_prio = True
+
+
+class _FakeStreamClient:
+    torrent = None
+    files = []
+    piece_states = []
+    priorities = []
+    info_filters = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def torrents_info(self, **kwargs):
+        _FakeStreamClient.info_filters.append(kwargs)
+        return [_FakeStreamClient.torrent]
+
+    def torrents_files(self, torrent_hash=None):
+        return _FakeStreamClient.files
+
+    def torrents_properties(self, torrent_hash=None):
+        return {"piece_size": PIECE_SIZE}
+
+    def torrents_piece_states(self, torrent_hash=None):
+        states = _FakeStreamClient.piece_states
+        if callable(states):
+            return states()
+        return states
+
+    def torrents_file_priority(self, **kwargs):
+        _FakeStreamClient.priorities.append(kwargs)
+
+
+@pytest.fixture
+def app_module(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeStreamClient)
+    monkeypatch.setattr(module, "STREAM_WAIT_TIMEOUT", 0)
+    monkeypatch.setattr(module.qbit_reads, "ttl", 0)
+
+    (tmp_path / "Movie").mkdir()
+    (tmp_path / "Movie" / "sample.txt").write_bytes(b"x" * 10)
+    # Незавершённый файл с расширением .!qB: файл в торренте идёт вторым, со смещением 10
+    (tmp_path / "Movie" / "movie.mkv.!qB").write_bytes(DATA)
+    _FakeStreamClient.torrent = _StreamTorrent(str(tmp_path))
+    _FakeStreamClient.files = [
+        {"index": 0, "name": "Movie/sample.txt", "size": 10, "progress": 1, "priority": 1},
+        {"index": 1, "name": "Movie/movie.mkv", "size": 100, "progress": 0.4, "priority": 1},
+    ]
+    # Скачаны куски 0-2, то есть байты торрента 0..47 и байты файла 0..37
+    _FakeStreamClient.piece_states = [2, 2, 2, 0, 1, 0, 0]
+    _FakeStreamClient.priorities = []
+    _FakeStreamClient.info_filters = []
+    yield module
+
+
+def test_open_range_is_cut_at_first_missing_piece(app_module):
+    client = app_module.app.test_client()
+
+    response = client.get("/api/library/stream/5", headers={"Range": "bytes=0-"})
+
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 0-37/100"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.mimetype == "video/x-matroska"
+    assert response.data == DATA[:38]
+    assert _FakeStreamClient.info_filters == [{"category": "library-5"}]
+    assert _FakeStreamClient.priorities == [{"torrent_hash": "h1", "file_ids": 1, "priority": 7}]
+
+
+def test_closed_range_inside_downloaded_pieces(app_module):
+    client = app_module.app.test_client()
+
+    response = client.get("/api/stream/kp/301", headers={"Range": "bytes=5-9"})
+
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 5-9/100"
+    assert response.data == DATA[5:10]
+    assert _FakeStreamClient.info_filters == [{"tag": "kp-301"}]
+
+
+def test_missing_pieces_answer_416_with_retry_after(app_module):
+    client = app_module.app.test_client()
+
+    not_ready = client.get("/api/stream/abc123", headers={"Range": "bytes=60-"})
+    invalid = client.get("/api/stream/abc123", headers={"Range": "bytes=500-"})
+
+    assert not_ready.status_code == 416
+    assert not_ready.headers["Retry-After"] == str(app_module.STREAM_RETRY_AFTER)
+    assert not_ready.headers["Content-Range"] == "bytes */100"
+    assert invalid.status_code == 416
+    assert "Retry-After" not in invalid.headers
+
+
+def test_request_waits_briefly_for_pieces(monkeypatch, app_module):
+    monkeypatch.setattr(app_module, "STREAM_WAIT_TIMEOUT", 2)
+    monkeypatch.setattr(app_module, "STREAM_POLL_INTERVAL", 0.01)
+    polls = []
+
+    def states():
+        polls.append(1)
+        return [2, 2, 2, 2, 2, 2, 2] if len(polls) > 2 else [2, 2, 2, 0, 0, 0, 0]
+
+    _FakeStreamClient.piece_states = states
+    client = app_module.app.test_client()
+
+    response = client.get("/api/stream/abc123", headers={"Range": "bytes=60-69"})
+
+    assert response.status_code == 206
+    assert response.data == DATA[60:70]
+    assert len(polls) == 3
+
+
+def test_completed_file_is_served_whole(app_module, tmp_path):
+    (tmp_path / "Movie" / "movie.mkv.!qB").rename(tmp_path / "Movie" / "movie.mkv")
+    _FakeStreamClient.files[1]["progress"] = 1
+    client = app_module.app.test_client()
+
+    full = client.get("/api/stream/abc123")
+    tail = client.get("/api/stream/abc123", headers={"Range": "bytes=-10"})
+
+    assert full.status_code == 200
+    assert full.data == DATA
+    assert full.headers["Content-Length"] == "100"
+    assert tail.status_code == 206
+    assert tail.data == DATA[90:]
+    assert _FakeStreamClient.priorities == []
+
+
+def test_paths_outside_save_path_are_not_served(app_module, tmp_path):
+    (tmp_path.parent / "escape.mkv").write_bytes(DATA)
+    _FakeStreamClient.files = [{"index": 0, "name": "../escape.mkv", "size": 100, "progress": 1, "priority": 1}]
+    client = app_module.app.test_client()
+
+    assert client.get("/api/stream/abc123").status_code == 404
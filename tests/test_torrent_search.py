@@ -0,0 +1,174 @@
+import importlib
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+GIB = 1024 ** 3
+
+
+class _StandInProvider:
+    def __init__(self, name, results=(), delay=0, error=None):
+        self.name = name
+        self.results = list(results)
+        self.delay = delay
+        self.error = error
+        self.queries = []
+
+    def search(self, query, timeout):
+        self.queries.append(query)
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.results
+
+
+def _result(title, info_hash, seeders, size=2 * GIB):
+    return {"title": title, "magnet": f"magnet:?xt=urn:btih:{info_hash}", "seeders": seeders, "leechers": 0, "size": size}
+
+
+class _FakeAddClient:
+    added = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def torrents_info(self, category=None):
+        return []
+
+    def torrents_add(self, **kwargs):
+        _FakeAddClient.added.append(kwargs)
+
+
+class _ApibayServer:
+    """Локальная замена apibay.org."""
+
+    def __init__(self, payload):
+        self.queries = []
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.queries.append(parse_qs(urlparse(self.path).query))
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeAddClient)
+    _FakeAddClient.added = []
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def test_search_fans_out_ranks_and_caches(app_module):
+    fast = _StandInProvider("fast", [
+        _result("Other Movie 1980", "aaa", seeders=900),
+        _result("My Movie 1980 1080p", "bbb", seeders=40),
+        _result("My Movie 1980 sample", "ccc", seeders=50, size=50 * 1024 * 1024),
+    ])
+    slow = _StandInProvider("slow", [_result("My Movie 1980", "ddd", seeders=5000)], delay=1)
+    broken = _StandInProvider("broken", error=RuntimeError("down"))
+    search = app_module.TorrentSearch([fast, slow, broken], timeout=0.3, cache_ttl=60, cache_size=8)
+
+    started = time.monotonic()
+    results = search.search("My Movie 1980")
+
+    assert time.monotonic() - started < 0.9
+    assert [r["title"] for r in results] == ["My Movie 1980 1080p", "My Movie 1980 sample", "Other Movie 1980"]
+    assert results[0]["provider"] == "fast"
+    assert search.stats["slow_timeouts"] == 1 and search.stats["broken_errors"] == 1
+
+    assert search.search("  my movie   1980 ") == results
+    assert fast.queries == ["My Movie 1980"]
+    assert search.stats["cache_hits"] == 1
+
+
+def test_total_provider_failure_is_not_cached(app_module):
+    broken = _StandInProvider("broken", error=RuntimeError("down"))
+    search = app_module.TorrentSearch([broken], timeout=1, cache_ttl=60, cache_size=8)
+
+    assert search.search("Фильм 2000") == []
+    assert search.search("Фильм 2000") == []
+    assert len(broken.queries) == 2
+
+
+def test_apibay_provider_parses_results(app_module):
+    server = _ApibayServer([
+        {"name": "Movie 2001", "info_hash": "ABCDEF0123456789ABCDEF0123456789ABCDEF01", "seeders": "12", "leechers": "3", "size": "1000"},
+        {"name": "No results returned", "info_hash": "0" * 40, "seeders": "0", "leechers": "0", "size": "0"},
+    ])
+    try:
+        results = app_module.ApibayProvider(server.base_url).search("Movie 2001", timeout=2)
+    finally:
+        server.httpd.shutdown()
+
+    assert server.queries == [{"q": ["Movie 2001"], "cat": ["200"]}]
+    assert len(results) == 1
+    assert results[0]["magnet"].startswith("magnet:?xt=urn:btih:abcdef0123456789abcdef0123456789abcdef01&dn=Movie%202001")
+    assert results[0]["seeders"] == 12
+
+
+def test_lottery_winner_download_uses_search_and_remembers_magnet(monkeypatch, app_module):
+    module = app_module
+    provider = _StandInProvider("stand-in", [_result("Фильм 1999", "eee", seeders=10)])
+    monkeypatch.setattr(module.torrent_search, "providers", [provider])
+    with module.app.app_context():
+        lottery = module.Lottery(id="lot001")
+        movie = module.Movie(name="Фильм", year="1999", kinopoisk_id=77)
+        lottery.movies.append(movie)
+        lottery.winner = movie
+        module.db.session.add(lottery)
+        module.db.session.commit()
+    client = module.app.test_client()
+
+    response = client.post("/api/start-download/lot001")
+
+    assert response.status_code == 200
+    assert provider.queries == ["Фильм 1999"]
+    assert _FakeAddClient.added == [{
+        "urls": "magnet:?xt=urn:btih:eee", "category": "lottery-lot001",
+        "is_sequential_download": True, "is_first_last_piece_priority": True, "tags": "kp-77",
+    }]
+    with module.app.app_context():
+        assert module.db.session.get(module.MovieIdentifier, 77).magnet_link == "magnet:?xt=urn:btih:eee"
+
+
+def test_lottery_without_winner_is_rejected(app_module):
+    with app_module.app.app_context():
+        app_module.db.session.add(app_module.Lottery(id="lot002"))
+        app_module.db.session.commit()
+
+    response = app_module.app.test_client().post("/api/start-download/lot002")
+
+    assert response.status_code == 400
+    assert _FakeAddClient.added == []
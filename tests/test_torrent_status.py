@@ -1,79 +1,3 @@
-<<<<<<< HEAD
- (cd "$(git rev-parse --show-toplevel)" && git apply --3way <<'EOF' 
-diff --git a//dev/null b/tests/test_torrent_status.py
-index 0000000000000000000000000000000000000000..0cca09097118b30f3ac01f85541c164faffdea79 100644
---- a//dev/null
-+++ b/tests/test_torrent_status.py
-@@ -0,0 +1,65 @@
-+import importlib
-+import sys
-+from pathlib import Path
-+
-+import pytest
-+
-+
-+class _FakeTorrent:
-+    progress = 0.5
-+    dlspeed = 1024 * 1024  # 1 MiB/s
-+    eta = 120
-+    state = "downloading"
-+    name = "Test Torrent"
-+
-+
-+class _FakeClient:
-+    last_category = None
-+    logged_out = False
-+
-+    def __init__(self, *args, **kwargs):
-+        pass
-+
-+    def auth_log_in(self):
-+        return None
-+
-+    def auth_log_out(self):
-+        _FakeClient.logged_out = True
-+
-+    def torrents_info(self, category=None):
-+        _FakeClient.last_category = category
-+        return [_FakeTorrent()]
-+
-+
-+@pytest.fixture
-+def app_module(monkeypatch):
-+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
-+    project_root = Path(__file__).resolve().parent.parent
-+    if str(project_root) not in sys.path:
-+        sys.path.insert(0, str(project_root))
-+    sys.modules.pop("app", None)
-+    module = importlib.import_module("app")
-+    module.app.config["TESTING"] = True
-+    monkeypatch.setattr(module, "Client", _FakeClient)
-+    _FakeClient.last_category = None
-+    _FakeClient.logged_out = False
-+    yield module
-+
-+
-+def test_get_torrent_status_uses_passed_lottery_id(app_module):
-+    client = app_module.app.test_client()
-+    lottery_id = "abc123"
-+
-+    response = client.get(f"/api/torrent-status/{lottery_id}")
-+
-+    assert response.status_code == 200
-+    payload = response.get_json()
-+    assert payload == {
-+        "status": "downloading",
-+        "progress": 50.0,
-+        "speed_mbps": 1.0,
-+        "eta": "2м",
-+        "name": "Test Torrent",
-+    }
-+    assert _FakeClient.last_category == f"lottery-{lottery_id}"
-+    assert _FakeClient.logged_out is True
- 
-EOF
-)
-=======
 import importlib
 import sys
 from pathlib import Path
@@ -92,12 +16,14 @@ class _FakeTorrent:
 class _FakeClient:
     last_category = None
     logged_out = False
+    instances = 0
+    logins = 0
 
     def __init__(self, *args, **kwargs):
-        pass
+        _FakeClient.instances += 1
 
     def auth_log_in(self):
-        return None
+        _FakeClient.logins += 1
 
     def auth_log_out(self):
         _FakeClient.logged_out = True
@@ -119,6 +45,8 @@ def app_module(monkeypatch):
     monkeypatch.setattr(module, "Client", _FakeClient)
     _FakeClient.last_category = None
     _FakeClient.logged_out = False
+    _FakeClient.instances = 0
+    _FakeClient.logins = 0
     yield module
 
 
@@ -138,5 +66,80 @@ def test_get_torrent_status_uses_passed_lottery_id(app_module):
         "name": "Test Torrent",
     }
     assert _FakeClient.last_category == f"lottery-{lottery_id}"
-    assert _FakeClient.logged_out is True
->>>>>>> f80e8a49124308e5ecb61734941beed7a3369c15
+    assert _FakeClient.logged_out is False
+
+
+def test_status_polls_reuse_pooled_session(app_module):
+    client = app_module.app.test_client()
+
+    for _ in range(3):
+        assert client.get("/api/torrent-status/abc123").status_code == 200
+    assert client.get("/api/library/torrent-status/7").status_code == 200
+
+    assert _FakeClient.instances == 1
+    assert _FakeClient.logins == 1
+    assert _FakeClient.last_category == "library-7"
+
+
+def test_expired_session_is_reauthenticated(monkeypatch, app_module):
+    calls = []
+
+    class _ExpiringClient(_FakeClient):
+        def torrents_info(self, category=None):
+            calls.append(category)
+            if len(calls) == 1:
+                raise app_module.qbittorrent_exceptions.Forbidden403Error()
+            return super().torrents_info(category=category)
+
+    monkeypatch.setattr(app_module, "Client", _ExpiringClient)
+    client = app_module.app.test_client()
+
+    payload = client.get("/api/torrent-status/abc123").get_json()
+
+    assert payload["status"] == "downloading"
+    assert calls == ["lottery-abc123", "lottery-abc123"]
+    assert _FakeClient.logins == 2
+
+
+class _StatusTorrent:
+    def __init__(self, category, tags="", progress=0.5):
+        self.category = category
+        self.tags = tags
+        self.progress = progress
+        self.dlspeed = 1024 * 1024
+        self.eta = 60
+        self.state = "downloading"
+        self.name = category
+        self.num_seeds = 3
+        self.num_leechs = 1
+
+
+def test_batch_status_uses_single_torrents_info_call(monkeypatch, app_module):
+    calls = []
+
+    class _BatchClient(_FakeClient):
+        def torrents_info(self, **kwargs):
+            calls.append(kwargs)
+            return [
+                _StatusTorrent("lottery-abc123", tags="kp-301", progress=0.2),
+                _StatusTorrent("lottery-zzz999", tags="kp-301", progress=0.9),
+                _StatusTorrent("library-7"),
+            ]
+
+    monkeypatch.setattr(app_module, "Client", _BatchClient)
+    client = app_module.app.test_client()
+
+    response = client.post(
+        "/api/download-status/batch",
+        json={"kinopoisk_ids": [301, 999], "lottery_ids": ["abc123"], "library_ids": [7, 8]},
+    )
+
+    assert response.status_code == 200
+    payload = response.get_json()
+    assert calls == [{}]
+    assert payload["kinopoisk"]["301"]["progress"] == "90.0"
+    assert payload["kinopoisk"]["301"]["kinopoisk_id"] == 301
+    assert payload["kinopoisk"]["999"]["status"] == "not_found"
+    assert payload["lotteries"]["abc123"]["name"] == "lottery-abc123"
+    assert payload["library"]["7"]["peers"] == 1
+    assert payload["library"]["8"] == {"status": "not_found"}
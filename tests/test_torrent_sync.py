@@ -0,0 +1,118 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+
+class _FakeSyncClient:
+    responses = []
+    requested_rids = []
+    torrents_info_calls = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def auth_log_in(self):
+        return None
+
+    def sync_maindata(self, rid=0):
+        _FakeSyncClient.requested_rids.append(rid)
+        response = _FakeSyncClient.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def torrents_info(self, **kwargs):
+        _FakeSyncClient.torrents_info_calls += 1
+        return []
+
+
+def _torrent(**fields):
+    base = {
+        "name": "Movie",
+        "state": "downloading",
+        "progress": 0.25,
+        "dlspeed": 2 * 1024 * 1024,
+        "eta": 3700,
+        "num_seeds": 4,
+        "num_leechs": 2,
+        "category": "lottery-abc123",
+        "tags": "kp-301",
+    }
+    base.update(fields)
+    return base
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+    project_root = Path(__file__).resolve().parent.parent
+    if str(project_root) not in sys.path:
+        sys.path.insert(0, str(project_root))
+    sys.modules.pop("app", None)
+    module = importlib.import_module("app")
+    module.app.config["TESTING"] = True
+    monkeypatch.setattr(module, "Client", _FakeSyncClient)
+    _FakeSyncClient.responses = []
+    _FakeSyncClient.requested_rids = []
+    _FakeSyncClient.torrents_info_calls = 0
+    with module.app.app_context():
+        module.db.drop_all()
+        module.db.create_all()
+    yield module
+
+
+def test_snapshot_applies_full_update_and_deltas(app_module):
+    _FakeSyncClient.responses = [
+        {"rid": 1, "full_update": True, "torrents": {"h1": _torrent(), "h2": _torrent(tags="kp-302", category="library-5")}},
+        {"rid": 2, "torrents": {"h1": {"progress": 0.5, "tags": "kp-303"}}, "torrents_removed": ["h2"]},
+    ]
+    sync = app_module.torrent_sync
+    snapshot = app_module.torrent_snapshot
+
+    assert sync.refresh() is True
+    assert snapshot.kinopoisk_map() == {301: "h1", 302: "h2"}
+    assert [t.hash for t in snapshot.by_category("library-5")] == ["h2"]
+
+    assert sync.refresh() is True
+    assert _FakeSyncClient.requested_rids == [0, 1]
+    assert snapshot.kinopoisk_map() == {303: "h1"}
+    assert snapshot.by_category("library-5") == []
+    assert snapshot.by_hash("h1").progress == 0.5
+    assert snapshot.by_hash("h1").name == "Movie"
+    assert snapshot.version == 2
+
+
+def test_active_downloads_served_from_snapshot(app_module):
+    _FakeSyncClient.responses = [
+        {"rid": 1, "full_update": True, "torrents": {"h1": _torrent(), "h2": _torrent(tags="")}},
+    ]
+    client = app_module.app.test_client()
+
+    first = client.get("/api/active-downloads").get_json()
+    second = client.get("/api/active-downloads").get_json()
+
+    assert first["downloads"] == second["downloads"]
+    assert len(first["downloads"]) == 1
+    download = first["downloads"][0]
+    assert download["kinopoisk_id"] == 301
+    assert download["progress"] == "25.0"
+    assert download["eta"] == "1ч 1м"
+    assert first["snapshot_age"] is not None
+    assert _FakeSyncClient.requested_rids == [0]
+    assert _FakeSyncClient.torrents_info_calls == 0
+
+
+def test_snapshot_keeps_last_known_state_when_qbittorrent_is_down(app_module):
+    _FakeSyncClient.responses = [
+        {"rid": 1, "full_update": True, "torrents": {"h1": _torrent()}},
+        app_module.qbittorrent_exceptions.APIConnectionError("offline"),
+    ]
+    sync = app_module.torrent_sync
+
+    assert sync.refresh() is True
+    assert sync.refresh() is False
+
+    assert app_module.torrent_snapshot.kinopoisk_map() == {301: "h1"}
+    assert "offline" in app_module.torrent_snapshot.last_error